@@ -0,0 +1,257 @@
+"""
+Synthetic workloads for the benchmarks, reproducible from a seed:
+
+    python benchmarks/generate.py puzzles data/bench.csv --rows 1000000
+    python benchmarks/generate.py themes data/bench_themes.xml
+    python benchmarks/generate.py study data/bench.pgn --games 50 --depth 3 --branching 0.3 --comments 0.2
+
+The puzzles follow the lichess csv format. Their positions and moves are
+legal (they are replayed by the renderers): a pool of --pool random puzzles
+is played once and the rows draw from it, with their own id, rating and
+themes, so millions of rows are written in seconds.
+"""
+
+import argparse
+import csv
+import random
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+import chess
+import chess.pgn
+
+HEADER = [
+    "PuzzleId",
+    "FEN",
+    "Moves",
+    "Rating",
+    "RatingDeviation",
+    "Popularity",
+    "NbPlays",
+    "Themes",
+    "GameUrl",
+    "OpeningTags",
+]
+
+THEMES = [
+    "advancedPawn",
+    "advantage",
+    "attraction",
+    "backRankMate",
+    "bishopEndgame",
+    "capturingDefender",
+    "crushing",
+    "deflection",
+    "discoveredAttack",
+    "endgame",
+    "equality",
+    "fork",
+    "hangingPiece",
+    "kingsideAttack",
+    "long",
+    "mate",
+    "mateIn1",
+    "mateIn2",
+    "middlegame",
+    "oneMove",
+    "opening",
+    "pin",
+    "promotion",
+    "quietMove",
+    "rookEndgame",
+    "sacrifice",
+    "short",
+    "skewer",
+    "veryLong",
+    "zugzwang",
+]
+
+OPENINGS = ["", "Sicilian_Defense", "Italian_Game Italian_Game_Classical"]
+
+
+def random_line(rng: random.Random, board: chess.Board, length: int) -> List:
+    """
+    Up to length random legal moves from board, played on it.
+    """
+    moves = []
+    for _ in range(length):
+        legal = list(board.legal_moves)
+        if not legal:
+            break
+        move = rng.choice(legal)
+        board.push(move)
+        moves.append(move)
+    return moves
+
+
+def random_puzzle(rng: random.Random) -> Tuple[str, str]:
+    """
+    Fen and uci moves of a random puzzle: a position reached by random moves,
+    then 2 to 8 random moves, the first one played by the opponent.
+    """
+    while True:
+        board = chess.Board()
+        random_line(rng, board, rng.randint(4, 40))
+        fen = board.fen()
+        moves = random_line(rng, board, rng.randint(2, 8))
+        if len(moves) >= 2:
+            return fen, " ".join(move.uci() for move in moves)
+
+
+def puzzle_rows(rows: int, seed=0, pool=2000) -> Iterator[List]:
+    rng = random.Random(seed)
+    puzzles = [random_puzzle(rng) for _ in range(min(pool, rows))]
+    for i in range(rows):
+        fen, moves = puzzles[i % len(puzzles)]
+        yield [
+            f"s{i:07d}",
+            fen,
+            moves,
+            rng.randint(600, 2900),
+            rng.randint(70, 100),
+            rng.randint(-20, 100),
+            rng.randint(1, 50_000),
+            " ".join(rng.sample(THEMES, rng.randint(1, 5))),
+            f"https://lichess.org/s{i}#{i % 80}",
+            rng.choice(OPENINGS),
+        ]
+
+
+def write_puzzles(path: Path, rows: int, seed=0, pool=2000) -> None:
+    with open(path, "w", encoding="utf-8", newline="") as fd:
+        writer = csv.writer(fd, lineterminator="\n")
+        writer.writerow(HEADER)
+        writer.writerows(puzzle_rows(rows, seed, pool))
+
+
+def write_themes(path: Path) -> None:
+    """
+    puzzleTheme.xml describing THEMES, in the lichess format.
+    """
+    with open(path, "w", encoding="utf-8") as fd:
+        fd.write('<?xml version="1.0" encoding="utf-8"?>\n<resources>\n')
+        for tag in THEMES:
+            fd.write(f'  <string name="{tag}">{tag[0].upper() + tag[1:]}</string>\n')
+            fd.write(f'  <string name="{tag}Description">About {tag}.</string>\n')
+        fd.write("</resources>\n")
+
+
+def grow(
+    rng: random.Random,
+    node: chess.pgn.GameNode,
+    length: int,
+    depth: int,
+    branching: float,
+    comments: float,
+) -> None:
+    """
+    Add a line of length random moves after node. Each move has a
+    probability branching of getting an alternative, itself a line, while
+    depth allows more nesting, and a probability comments of a comment with
+    arrows.
+    """
+    board = node.board()
+    for _ in range(length):
+        legal = list(board.legal_moves)
+        if not legal:
+            return
+        move = rng.choice(legal)
+        child = node.add_variation(move)
+        if rng.random() < comments:
+            child.comment = (
+                f"Comment {rng.randint(0, 999)} [%cal Ge2e4,Rd7d5] [%csl Gd4]"
+            )
+        if depth > 0 and rng.random() < branching:
+            alternatives = [m for m in legal if m != move]
+            if alternatives:
+                variation = node.add_variation(rng.choice(alternatives))
+                if rng.random() < comments:
+                    variation.comment = "Side line"
+                grow(rng, variation, rng.randint(1, 8), depth - 1, branching, comments)
+        board.push(move)
+        node = child
+
+
+def write_study(
+    path: Path,
+    games: int,
+    depth=2,
+    branching=0.2,
+    comments=0.2,
+    length=40,
+    seed=0,
+) -> None:
+    """
+    Study of games random games of length moves, see grow for depth,
+    branching and comments.
+    """
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as fd:
+        for i in range(games):
+            game = chess.pgn.Game()
+            game.headers["Event"] = f"Synthetic study: chapter {i + 1}"
+            game.headers["White"] = f"Player {i % 5}"
+            game.headers["Black"] = f"Player {(i + 1) % 5}"
+            game.headers["ECO"] = f"C{40 + i % 10}"
+            if rng.random() < comments:
+                game.comment = f"Chapter {i + 1} [%csl Ge4]"
+            grow(rng, game, length, depth, branching, comments)
+            print(game, file=fd, end="\n\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic puzzle databases and studies."
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    kinds = parser.add_subparsers(dest="kind", required=True)
+
+    puzzles = kinds.add_parser("puzzles", help="Lichess format puzzle csv.")
+    puzzles.add_argument("output", type=Path)
+    puzzles.add_argument("--rows", "-n", type=int, default=100_000)
+    puzzles.add_argument(
+        "--pool",
+        type=int,
+        default=2000,
+        help="Number of distinct positions the rows draw from.",
+    )
+
+    themes = kinds.add_parser("themes", help="puzzleTheme.xml of the puzzle themes.")
+    themes.add_argument("output", type=Path)
+
+    study = kinds.add_parser("study", help="Pgn study.")
+    study.add_argument("output", type=Path)
+    study.add_argument("--games", "-g", type=int, default=20)
+    study.add_argument("--length", type=int, default=40, help="Moves per game.")
+    study.add_argument(
+        "--depth", type=int, default=2, help="Maximum nesting of the variations."
+    )
+    study.add_argument(
+        "--branching",
+        type=float,
+        default=0.2,
+        help="Probability of a move having a variation.",
+    )
+    study.add_argument(
+        "--comments",
+        type=float,
+        default=0.2,
+        help="Probability of a move having a comment.",
+    )
+
+    args = parser.parse_args()
+
+    if args.kind == "puzzles":
+        write_puzzles(args.output, args.rows, seed=args.seed, pool=args.pool)
+    elif args.kind == "themes":
+        write_themes(args.output)
+    else:
+        write_study(
+            args.output,
+            args.games,
+            depth=args.depth,
+            branching=args.branching,
+            comments=args.comments,
+            length=args.length,
+            seed=args.seed,
+        )
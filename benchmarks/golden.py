@@ -0,0 +1,213 @@
+"""
+Golden output checks: the latex of synthetic puzzle books and studies must be
+byte-identical whatever the code path producing it (csv or columnar cache,
+precomputed puzzles, DataFrame or compact store, fragment cache, several
+processes, streamed output).
+
+    python benchmarks/golden.py                       # compare the paths
+    python benchmarks/golden.py --check benchmarks/golden.json
+    python benchmarks/golden.py --save benchmarks/golden.json
+
+--check also compares the reference outputs to the hashes saved by an
+earlier revision, --save records them after a deliberate change of output.
+Exits with an error when an output differs.
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import sys
+from pathlib import Path
+
+SCRIPTS = Path(__file__).resolve().parent.parent / "pgn2tex"
+sys.path.insert(0, str(SCRIPTS))
+
+import generate  # noqa: E402
+
+
+def sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def puzzle_books(workdir: Path, seed: int):
+    """
+    Yields (book, path, latex) for each book and code path, the first path of
+    a book being its reference.
+    """
+    from board_helpers import (
+        iter_book_from_list_table_layout,
+        mk_book_from_list,
+        mk_book_from_list_table_layout,
+    )
+    from fragment_cache import FragmentCache
+    from puzzle_cache import PuzzleCache
+    from puzzle_store import PuzzleStore
+    from puzzles import load_themes, make_book, open_puzzles
+    from utils import write_template
+
+    database = workdir / f"golden_{seed}.csv"
+    themes_desc = workdir / "puzzleTheme.xml"
+    if not database.exists():
+        generate.write_puzzles(database, 3000, seed=seed, pool=500)
+    if not themes_desc.exists():
+        generate.write_themes(themes_desc)
+    themes = load_themes(themes_desc)
+
+    precomputed = PuzzleCache.open(database, directory=workdir / "precomputed")
+    precomputed.precompute()
+
+    def precomputed_rows(**f):
+        return precomputed.select(
+            f.get("min_rating"),
+            f.get("max_rating"),
+            f.get("themes"),
+            f.get("theme_query"),
+        )
+
+    sources = {
+        "csv": lambda **f: open_puzzles(database, cache=False, **f),
+        "cache": lambda **f: open_puzzles(database, **f),
+        "precomputed": lambda **f: precomputed.to_frame(precomputed_rows(**f)),
+        "compact csv": lambda **f: open_puzzles(
+            database, cache=False, compact=True, **f
+        ),
+        "compact cache": lambda **f: open_puzzles(database, compact=True, **f),
+        "compact precomputed": lambda **f: PuzzleStore.from_cache(
+            precomputed, precomputed_rows(**f)
+        ),
+    }
+
+    books = {
+        "categorized": ({}, {"problems": 6}),
+        "uncategorized": (
+            {"themes": ["fork", "pin"]},
+            {"problems": 9, "is_categorized": False, "tags": ["fork", "pin"]},
+        ),
+        "query": ({"theme_query": "mate and not short"}, {"quantiles": 3}),
+        "unique": ({}, {"problems": 12, "unique_positions": True}),
+    }
+
+    for name, (filters, options) in books.items():
+        filters = {"min_rating": 1000, "max_rating": 2500, **filters}
+        layouts = {}
+        for source, load in sources.items():
+            puzzles = load(**filters)
+            layouts[source] = make_book(
+                puzzles,
+                themes,
+                min_rating=filters["min_rating"],
+                max_rating=filters["max_rating"],
+                seed=seed,
+                **options,
+            )
+        categorized = options.get("is_categorized", True)
+        L = layouts["csv"]
+
+        yield name, "csv", mk_book_from_list_table_layout(L, is_categorized=categorized)
+        for source in sources:
+            if source != "csv":
+                yield name, source, mk_book_from_list_table_layout(
+                    layouts[source], is_categorized=categorized
+                )
+        yield name, "jobs=2", mk_book_from_list_table_layout(
+            L, is_categorized=categorized, jobs=2
+        )
+        for run in ("cold", "warm"):
+            cache = FragmentCache(workdir / f"fragments_{name}.db")
+            yield name, f"fragment cache {run}", mk_book_from_list_table_layout(
+                L, is_categorized=categorized, cache=cache
+            )
+            cache.close()
+        fd = io.StringIO()
+        write_template(
+            fd,
+            "$content",
+            iter_book_from_list_table_layout(L, is_categorized=categorized),
+        )
+        yield name, "streamed", fd.getvalue()
+
+        yield f"{name} multicol", "reference", mk_book_from_list(
+            L, is_categorized=categorized
+        )
+
+    for path in workdir.glob("fragments_*.db"):
+        path.unlink()
+
+
+def studies(workdir: Path, seed: int):
+    """
+    Yields (study, path, latex) for each study and code path.
+    """
+    from study import PgnBook
+
+    workloads = {
+        "flat": {"games": 8, "depth": 0, "branching": 0, "comments": 0.3},
+        "nested": {"games": 6, "depth": 3, "branching": 0.3, "comments": 0.2},
+    }
+    for name, parameters in workloads.items():
+        pgn = workdir / f"golden_{name}_{seed}.pgn"
+        if not pgn.exists():
+            generate.write_study(pgn, seed=seed, **parameters)
+
+        yield name, "latex", PgnBook(pgn).latex()
+        yield name, "latex jobs=2", PgnBook(pgn).latex(jobs=2)
+        for jobs in (1, 2):
+            fd = io.StringIO()
+            PgnBook(pgn).write_latex(fd.write, jobs=jobs)
+            yield name, f"write_latex jobs={jobs}", fd.getvalue()
+        yield f"{name} single", "reference", "".join(PgnBook(pgn, book=False).singles())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check that every code path produces the same latex."
+    )
+    parser.add_argument(
+        "--workdir",
+        type=Path,
+        default=Path("data/bench"),
+        help="Where the synthetic workloads are written.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--check",
+        type=Path,
+        default=None,
+        help="Also compare the outputs to the hashes saved in this file.",
+    )
+    parser.add_argument(
+        "--save",
+        type=Path,
+        default=None,
+        help="Save the hashes of the outputs to this file.",
+    )
+    args = parser.parse_args()
+    args.workdir.mkdir(parents=True, exist_ok=True)
+
+    saved = {}
+    if args.check is not None:
+        with open(args.check) as fd:
+            saved = json.load(fd)
+
+    hashes = {}
+    failures = []
+    outputs = list(puzzle_books(args.workdir, args.seed))
+    outputs += list(studies(args.workdir, args.seed))
+    for name, path, latex in outputs:
+        digest = sha256(latex)
+        if name not in hashes:
+            hashes[name] = digest
+            if args.check is not None and saved.get(name) != digest:
+                failures.append(f"{name}: differs from {args.check}")
+        elif digest != hashes[name]:
+            failures.append(f"{name}: {path} differs from the reference")
+        print(f"{name:<28} {path:<24} {len(latex):9} chars {digest[:12]}")
+
+    if args.save is not None:
+        with open(args.save, "w") as fd:
+            json.dump(hashes, fd, indent=1)
+
+    if failures:
+        sys.exit("\n".join(failures))
+    print("All outputs identical")
@@ -0,0 +1,197 @@
+"""
+Time and memory of each stage of the puzzle and study pipelines, on the
+synthetic workloads of generate.py (written to --workdir on first use):
+
+    python benchmarks/pipeline.py puzzles --rows 1000000
+    python benchmarks/pipeline.py study --games 100 --depth 3 --memory
+
+Stages of the puzzles: open_puzzles (after building the columnar cache,
+unless --no-cache), selection (make_book: sampling and puzzle records),
+mk_book_from_list_table_layout and write_template. Stages of a study:
+PgnBook.latex and write_template. Items are the rows, puzzles, games or
+characters a stage went through.
+
+--memory traces the allocations of each stage with tracemalloc, which slows
+everything down: compare times without it.
+"""
+
+import argparse
+import json
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+SCRIPTS = Path(__file__).resolve().parent.parent / "pgn2tex"
+sys.path.insert(0, str(SCRIPTS))
+
+import generate  # noqa: E402
+
+
+class Stages:
+    """
+    Wall time, cpu time and (with memory) peak of the memory allocated by
+    each stage.
+    """
+
+    def __init__(self, memory=False) -> None:
+        self.memory = memory
+        self.results = []
+
+    @contextmanager
+    def stage(self, name: str, items=None):
+        if self.memory:
+            tracemalloc.start()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            result = {
+                "stage": name,
+                "wall": time.perf_counter() - wall,
+                "cpu": time.process_time() - cpu,
+                "items": items,
+            }
+            if self.memory:
+                result["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+                tracemalloc.stop()
+            self.results.append(result)
+
+    def report(self) -> None:
+        for result in self.results:
+            line = f"{result['stage']:<32} {result['wall'] * 1000:10.1f} ms wall {result['cpu'] * 1000:10.1f} ms cpu"
+            if "peak_mb" in result:
+                line += f" {result['peak_mb']:9.1f} MB"
+            if result["items"] is not None:
+                line += f"  {result['items']} items"
+            print(line)
+        # ru_maxrss is in kB on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"{'peak rss':<32} {peak:10.1f} MB")
+
+
+def puzzle_pipeline(args, stages: Stages) -> None:
+    from board_helpers import mk_book_from_list_table_layout
+    from puzzles import load_themes, make_book, open_puzzles
+    from utils import write_template
+
+    database = args.workdir / f"puzzles_{args.rows}_{args.seed}.csv"
+    themes_desc = args.workdir / "puzzleTheme.xml"
+    if not database.exists():
+        generate.write_puzzles(database, args.rows, seed=args.seed)
+    if not themes_desc.exists():
+        generate.write_themes(themes_desc)
+    themes = load_themes(themes_desc)
+
+    # Imported by the first stage using them otherwise
+    with stages.stage("imports"):
+        import records, sampling  # noqa: F401
+        from puzzle_cache import PuzzleCache
+
+    if args.cache:
+        with stages.stage("build cache", args.rows):
+            PuzzleCache.open(database)
+    with stages.stage("open_puzzles"):
+        puzzles = open_puzzles(
+            database, args.min_rating, args.max_rating, cache=args.cache
+        )
+    stages.results[-1]["items"] = len(puzzles)
+
+    with stages.stage("selection (make_book)"):
+        book = make_book(
+            puzzles,
+            themes,
+            min_rating=args.min_rating,
+            max_rating=args.max_rating,
+            problems=args.problems,
+            seed=args.seed,
+        )
+    stages.results[-1]["items"] = sum(
+        len(section[2]) for chapter in book for section in chapter[2]
+    )
+
+    with stages.stage("mk_book_from_list_table_layout"):
+        content = mk_book_from_list_table_layout(book, jobs=args.jobs)
+
+    template = (SCRIPTS / "templates" / "book.tex").read_text()
+    with stages.stage("write_template", len(content)):
+        with open(args.workdir / "puzzles.tex", "w", encoding="utf-8") as fd:
+            write_template(fd, template, content, frontpage="")
+
+
+def study_pipeline(args, stages: Stages) -> None:
+    from study import PgnBook
+    from utils import write_template
+
+    pgn = args.workdir / (
+        f"study_{args.games}_{args.depth}_{args.branching}_{args.comments}_{args.seed}.pgn"
+    )
+    if not pgn.exists():
+        generate.write_study(
+            pgn,
+            args.games,
+            depth=args.depth,
+            branching=args.branching,
+            comments=args.comments,
+            seed=args.seed,
+        )
+
+    with stages.stage("PgnBook.latex", args.games):
+        content = PgnBook(pgn, book=True).latex(jobs=args.jobs)
+
+    template = (SCRIPTS / "templates" / "book.tex").read_text()
+    with stages.stage("write_template", len(content)):
+        with open(args.workdir / "study.tex", "w", encoding="utf-8") as fd:
+            write_template(fd, template, content, frontpage="")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time and memory of each stage of the pipelines."
+    )
+    parser.add_argument(
+        "--workdir",
+        type=Path,
+        default=Path("data/bench"),
+        help="Where the synthetic workloads and outputs are written.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--jobs", "-j", type=int, default=1)
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="Also measure the peak memory allocated by each stage (slower).",
+    )
+    parser.add_argument(
+        "--json", type=Path, default=None, help="Write the results to this file."
+    )
+    pipelines = parser.add_subparsers(dest="pipeline", required=True)
+
+    puzzles = pipelines.add_parser("puzzles")
+    puzzles.add_argument("--rows", "-n", type=int, default=100_000)
+    puzzles.add_argument("--problems", "-p", type=int, default=6)
+    puzzles.add_argument("-m", "--min-rating", type=int, default=1000)
+    puzzles.add_argument("-M", "--max-rating", type=int, default=2500)
+    puzzles.add_argument("--no-cache", dest="cache", action="store_false")
+
+    study = pipelines.add_parser("study")
+    study.add_argument("--games", "-g", type=int, default=20)
+    study.add_argument("--depth", type=int, default=2)
+    study.add_argument("--branching", type=float, default=0.2)
+    study.add_argument("--comments", type=float, default=0.2)
+
+    args = parser.parse_args()
+    args.workdir.mkdir(parents=True, exist_ok=True)
+
+    stages = Stages(memory=args.memory)
+    if args.pipeline == "puzzles":
+        puzzle_pipeline(args, stages)
+    else:
+        study_pipeline(args, stages)
+
+    stages.report()
+    if args.json is not None:
+        with open(args.json, "w") as fd:
+            json.dump(stages.results, fd, indent=1)
@@ -0,0 +1,134 @@
+"""
+Throughput of the book server (pgn2tex/server.py): sends --requests book
+requests, --concurrency at a time, and reports books per second and latency.
+
+    python pgn2tex/server.py --jobs 4 &
+    python benchmarks/service_load.py --requests 40 --concurrency 8
+
+With --cli N the same book is also generated N times by puzzles.py in fresh
+processes, the cost the server saves on every request.
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SCRIPTS = Path(__file__).resolve().parent.parent / "pgn2tex"
+sys.path.insert(0, str(SCRIPTS))
+
+from book_client import fetch_book  # noqa: E402
+
+# puzzles.py arguments of the book options
+CLI_ARGUMENTS = {
+    "min_rating": "--min-rating",
+    "max_rating": "--max-rating",
+    "step_size": "--step-size",
+    "problems": "--problems",
+    "page_number": "--page_number",
+    "seed": "--seed",
+}
+
+
+async def load(options, requests: int, concurrency: int, address):
+    """
+    Latency of each request, in seconds, and the total time.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(number: int):
+        async with semaphore:
+            start = time.perf_counter()
+            # Different seeds so every request draws its own book
+            seed = {"seed": number} if options.get("seed") is None else {}
+            await fetch_book({**options, **seed}, **address)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(number) for number in range(requests)))
+    return latencies, time.perf_counter() - start
+
+
+def cli_time(options, database: Path, runs: int) -> float:
+    """
+    Median time of runs generations of the book by puzzles.py.
+    """
+    arguments = [
+        sys.executable,
+        str(SCRIPTS / "puzzles.py"),
+        "--database",
+        str(database),
+    ]
+    for key, flag in CLI_ARGUMENTS.items():
+        if options.get(key) is not None:
+            arguments += [flag, str(options[key])]
+    if options.get("themes"):
+        arguments += ["--theme", *options["themes"]]
+    if options.get("categorized") is False:
+        arguments.append("--is_uncategorized")
+
+    times = []
+    with tempfile.TemporaryDirectory() as directory:
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(
+                arguments + ["--output", str(Path(directory) / "book.tex")],
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+            times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of the book server.")
+    parser.add_argument(
+        "options",
+        nargs="?",
+        default='{"problems": 9}',
+        help="Json options of the books.",
+    )
+    parser.add_argument("--requests", "-n", type=int, default=20)
+    parser.add_argument("--concurrency", "-c", type=int, default=4)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", type=Path, default=None)
+    parser.add_argument(
+        "--cli",
+        type=int,
+        default=0,
+        help="Also time this number of runs of puzzles.py for the same book.",
+    )
+    parser.add_argument(
+        "--database",
+        type=Path,
+        default=Path("data/lichess_db_puzzle.csv"),
+        help="Database given to puzzles.py with --cli.",
+    )
+    args = parser.parse_args()
+
+    options = json.loads(args.options)
+    if args.socket is not None:
+        address = {"socket": args.socket}
+    else:
+        address = {"host": args.host, "port": args.port}
+
+    latencies, total = asyncio.run(
+        load(options, args.requests, args.concurrency, address)
+    )
+    latencies.sort()
+    print(f"{args.requests} books in {total:.2f}s: {args.requests / total:.2f} books/s")
+    print(
+        f"latency median {statistics.median(latencies) * 1000:.0f} ms, "
+        f"p95 {latencies[int(0.95 * (len(latencies) - 1))] * 1000:.0f} ms"
+    )
+
+    if args.cli:
+        seconds = cli_time(options, args.database, args.cli)
+        print(f"puzzles.py: {seconds:.2f}s per book, {1 / seconds:.2f} books/s")
@@ -0,0 +1,132 @@
+"""
+Load time and memory of the puzzle selection backends, each measured in a
+fresh interpreter from the first import to the selected puzzles:
+
+    pandas  open_puzzles --no-cache: pandas parses the csv
+    cache   open_puzzles: the columnar cache, numpy and pandas
+    compact open_puzzles(compact=True): the cache into a PuzzleStore
+    shards  ShardStore.select: csv shards and the standard library only
+
+The size of the selection itself is also reported for the DataFrame (deep
+memory usage) and the PuzzleStore (nbytes).
+
+    python pgn2tex/puzzle_shards.py data/lichess_db_puzzle.csv data/shards
+    python benchmarks/shards.py --shards data/shards -m 1500 -M 1700
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+SCRIPTS = Path(__file__).resolve().parent.parent / "pgn2tex"
+
+# Run in the fresh interpreter, prints the selected puzzles, the puzzles read,
+# the time, the peak memory and the size of the selection as json
+CHILD = """
+import json, resource, sys, time
+sys.path.insert(0, {scripts!r})
+start = time.perf_counter()
+backend, source, lo, hi, themes = {arguments!r}
+if backend == "shards":
+    from puzzle_shards import ShardStore
+    store = ShardStore(source)
+    count = len(store.select(lo, hi, themes))
+    read = sum(s["count"] for s in store.manifest["shards"] if s["lo"] in store.shards)
+    size = None
+else:
+    from puzzles import open_puzzles
+    puzzles = open_puzzles(
+        source, lo, hi, themes, cache=backend != "pandas", compact=backend == "compact"
+    )
+    count = len(puzzles)
+    read = None
+    if backend == "compact":
+        size = puzzles.nbytes
+    else:
+        size = int(puzzles.memory_usage(deep=True).sum())
+seconds = time.perf_counter() - start
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps([count, read, seconds, peak, size]))
+"""
+
+
+def measure(backend: str, source: str, lo, hi, themes, repeat: int):
+    """
+    Selected puzzles, puzzles read, median seconds, peak memory (MB) and size
+    of the selection (MB) of repeat runs of a backend.
+    """
+    runs = []
+    for _ in range(repeat):
+        code = CHILD.format(
+            scripts=str(SCRIPTS), arguments=(backend, source, lo, hi, themes)
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", code], check=True, capture_output=True, text=True
+        ).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+    count, read, _, _, size = runs[0]
+    seconds = statistics.median(run[2] for run in runs)
+    # ru_maxrss is in kB on Linux
+    peak = statistics.median(run[3] for run in runs) / 1024
+    return count, read, seconds, peak, None if size is None else size / 2**20
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the load time and memory of the puzzle backends."
+    )
+    parser.add_argument(
+        "--database",
+        "-d",
+        default="data/lichess_db_puzzle.csv",
+        help="Lichess puzzle database of the pandas and cache backends.",
+    )
+    parser.add_argument(
+        "--shards",
+        default="data/shards",
+        help="Directory or url of the shards written by puzzle_shards.py.",
+    )
+    parser.add_argument("-m", "--min-rating", type=int, default=1500)
+    parser.add_argument("-M", "--max-rating", type=int, default=1700)
+    parser.add_argument("--theme", nargs="+", default=None)
+    parser.add_argument("--repeat", "-r", type=int, default=3)
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        choices=["pandas", "cache", "compact", "shards"],
+        default=["pandas", "cache", "compact", "shards"],
+    )
+    args = parser.parse_args()
+
+    # Python itself, the floor of every backend
+    floor = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import resource; print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)",
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    print(f"{'python':<8} {'':>10} {int(floor.stdout) / 1024:10.1f} MB")
+
+    for backend in args.backends:
+        source = args.shards if backend == "shards" else args.database
+        count, read, seconds, peak, size = measure(
+            backend,
+            source,
+            args.min_rating,
+            args.max_rating,
+            args.theme,
+            args.repeat,
+        )
+        line = f"{backend:<8} {seconds * 1000:8.1f} ms {peak:10.1f} MB  {count} puzzles"
+        if read is not None:
+            line += f" ({read} read)"
+        if size is not None:
+            line += f", {size:.1f} MB held"
+        print(line)
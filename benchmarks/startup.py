@@ -0,0 +1,105 @@
+"""
+Startup time of the pgn2tex scripts: wall time of `SCRIPT --help` in a fresh
+interpreter, which is what every run pays before doing any work.
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --repeat 20 --max-ms 100 puzzles.py
+    python benchmarks/startup.py --imports puzzles.py
+
+Exits with an error when the median of a script is above --max-ms, so it can
+guard against an eager import creeping back.
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+SCRIPTS = Path(__file__).resolve().parent.parent / "pgn2tex"
+
+
+def time_startup(script: Path, repeat: int):
+    """
+    Wall times of repeat runs of script --help, in milliseconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, str(script), "--help"],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def slowest_imports(script: Path, count: int):
+    """
+    Modules with the largest cumulative import time (in ms) when running
+    script --help, from python -X importtime.
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", str(script), "--help"],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    imports = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        imports.append((int(cumulative) / 1000, name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure the startup time of the scripts."
+    )
+    parser.add_argument(
+        "scripts",
+        nargs="*",
+        default=["puzzles.py", "study.py", "build.py"],
+        help="Scripts of pgn2tex/ to measure.",
+    )
+    parser.add_argument("--repeat", "-r", type=int, default=10)
+    parser.add_argument(
+        "--max-ms",
+        type=float,
+        default=None,
+        help="Fail when the median startup time of a script is above this.",
+    )
+    parser.add_argument(
+        "--imports",
+        action="store_true",
+        help="Also list the slowest imports of each script.",
+    )
+    args = parser.parse_args()
+
+    # Python itself, the floor of every script
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+    interpreter = (time.perf_counter() - start) * 1000 / args.repeat
+    print(f"{'python -c pass':<16} {interpreter:8.1f} ms")
+
+    failed = []
+    for name in args.scripts:
+        times = time_startup(SCRIPTS / name, args.repeat)
+        median = statistics.median(times)
+        print(
+            f"{name:<16} {median:8.1f} ms (min {min(times):.1f}, max {max(times):.1f})"
+        )
+        if args.imports:
+            for cumulative, module in slowest_imports(SCRIPTS / name, 8):
+                print(f"    {cumulative:8.1f} ms  {module}")
+        if args.max_ms is not None and median > args.max_ms:
+            failed.append(name)
+
+    if failed:
+        sys.exit(f"startup above {args.max_ms} ms: {', '.join(failed)}")
@@ -0,0 +1,415 @@
+import argparse
+import queue
+import shlex
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import chess
+import chess.engine
+import chess.pgn
+
+import profiling
+from positions import position_key
+
+# Score from white's point of view ("cp 35", "mate -2") and best line (uci
+# moves separated by spaces) of a position
+Evaluation = Tuple[str, str]
+
+# Nodes which can be annotated, see wants
+NODES = ["displayed", "mainline", "all"]
+
+
+class EvalCache:
+    """
+    Persistent cache of engine evaluations, stored in a sqlite database and
+    keyed by position (Zobrist hash), search depth and engine name, so an
+    edited study only has its new positions analysed.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self.db = sqlite3.connect(str(self.path))
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS evals ("
+            "position TEXT NOT NULL, depth INTEGER NOT NULL, engine TEXT NOT NULL, "
+            "score TEXT NOT NULL, pv TEXT NOT NULL, "
+            "PRIMARY KEY (position, depth, engine))"
+        )
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(position: int) -> str:
+        return f"{position:016x}"
+
+    def get_many(
+        self, positions: Iterable[int], depth: int, engine: str, batch=500
+    ) -> Dict[int, Evaluation]:
+        """
+        Cached evaluations of the given positions, missing ones are left out.
+        """
+        keys = {self.key(position): position for position in positions}
+        found = {}
+        names = list(keys)
+        for i in range(0, len(names), batch):
+            chunk = names[i : i + batch]
+            marks = ",".join("?" * len(chunk))
+            for key, score, pv in self.db.execute(
+                f"SELECT position, score, pv FROM evals WHERE depth = ? AND engine = ? AND position IN ({marks})",
+                [depth, engine] + chunk,
+            ):
+                found[keys[key]] = (score, pv)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(
+        self, evaluations: Dict[int, Evaluation], depth: int, engine: str
+    ) -> None:
+        self.db.executemany(
+            "INSERT OR REPLACE INTO evals (position, depth, engine, score, pv) VALUES (?, ?, ?, ?, ?)",
+            (
+                (self.key(position), depth, engine, score, pv)
+                for position, (score, pv) in evaluations.items()
+            ),
+        )
+        self.db.commit()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self) -> None:
+        self.db.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class EnginePool:
+    """
+    Pool of local UCI engine processes analysing positions concurrently, one
+    position per engine at a time.
+    """
+
+    def __init__(
+        self, command: List[str], engines=1, options: Optional[Dict] = None
+    ) -> None:
+        """
+        command: command line starting the engine, e.g. ["stockfish"]
+        engines: number of engine processes
+        options: UCI options given to every engine, e.g. {"Hash": 64}
+        """
+        self.engines = []
+        self.idle: queue.Queue = queue.Queue()
+        try:
+            for _ in range(engines):
+                engine = chess.engine.SimpleEngine.popen_uci(command)
+                self.engines.append(engine)
+                if options:
+                    engine.configure(options)
+                self.idle.put(engine)
+        except BaseException:
+            self.close()
+            raise
+        self.name = self.engines[0].id.get("name", " ".join(command))
+
+    def analyse(self, board: chess.Board, depth: int) -> Evaluation:
+        engine = self.idle.get()
+        try:
+            info = engine.analyse(board, chess.engine.Limit(depth=depth))
+        finally:
+            self.idle.put(engine)
+        return evaluation(info)
+
+    def analyse_many(
+        self, boards: Dict[int, chess.Board], depth: int
+    ) -> Iterator[Tuple[int, Evaluation]]:
+        """
+        Evaluation of each position of boards, as the engines finish them.
+        """
+        with ThreadPoolExecutor(max_workers=len(self.engines)) as pool:
+            futures = {
+                pool.submit(self.analyse, board, depth): position
+                for position, board in boards.items()
+            }
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def close(self) -> None:
+        for engine in self.engines:
+            try:
+                engine.quit()
+            except chess.engine.EngineError:
+                engine.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def evaluation(info: chess.engine.InfoDict) -> Evaluation:
+    score = info["score"].white()
+    if score.is_mate():
+        text = f"mate {score.mate()}"
+    else:
+        text = f"cp {score.score()}"
+    return text, " ".join(move.uci() for move in info.get("pv", []))
+
+
+def annotation(board: chess.Board, evaluated: Evaluation, depth: int, plies=6) -> str:
+    """
+    Comment of a position: the score in pawns (or \\#n for a mate in n) at
+    the search depth, followed by the first plies moves of the best line.
+    The comments of the studies are latex, # is escaped.
+    """
+    score, pv = evaluated
+    kind, value = score.split()
+    if kind == "mate":
+        text = f"\\#{value}"
+    else:
+        text = f"{int(value) / 100:+.2f}"
+    moves = [chess.Move.from_uci(uci) for uci in pv.split()[:plies]]
+    line = board.variation_san(moves).replace("#", "\\#") if moves else ""
+    return f"{text}/{depth} {line}".rstrip()
+
+
+def has_comment(node: chess.pgn.GameNode, scratch: chess.pgn.GameNode) -> bool:
+    """
+    Whether node has a comment once the arrows and the evaluation, which the
+    books do not display as text, are removed.
+    """
+    scratch.comment = node.comment
+    scratch.set_arrows([])
+    scratch.set_eval(None)
+    return bool(scratch.comment.strip())
+
+
+def wants(node: chess.pgn.ChildNode, nodes: str) -> bool:
+    """
+    Whether node belongs to the annotated nodes: every node ("all"), the
+    mainline moves ("mainline") or the mainline moves the books display with
+    a board ("displayed": branches and end of the game).
+    """
+    if nodes == "all":
+        return True
+    if not node.is_mainline():
+        return False
+    return nodes == "mainline" or len(node.variations) > 1 or node.is_end()
+
+
+def targets(
+    game: chess.pgn.Game, nodes="displayed"
+) -> Iterator[Tuple[chess.pgn.ChildNode, chess.Board]]:
+    """
+    Nodes of game to annotate, without comment and not ending the game, with
+    the board after their move.
+    """
+    scratch = chess.pgn.Game()
+    board = game.board()
+    stack = [iter(game.variations)]
+    while stack:
+        node = next(stack[-1], None)
+        if node is None:
+            stack.pop()
+            if stack:
+                board.pop()
+            continue
+        board.push(node.move)
+        if (
+            wants(node, nodes)
+            and not has_comment(node, scratch)
+            and not board.is_game_over()
+        ):
+            yield node, board.copy(stack=False)
+        stack.append(iter(node.variations))
+
+
+def annotate_games(
+    games: List[chess.pgn.Game],
+    pool: EnginePool,
+    cache: Optional[EvalCache] = None,
+    depth=18,
+    plies=6,
+    nodes="displayed",
+) -> Dict[str, int]:
+    """
+    Add the evaluation and best line of the engines to the positions of games
+    without comment (see targets), in place. Positions are analysed once
+    whatever the number of nodes reaching them, and only when they are not
+    in cache. Returns the number of annotated nodes, distinct positions,
+    positions found in cache and analysed.
+    """
+    profile = profiling.current()
+    found = [target for game in games for target in targets(game, nodes)]
+    boards = {}
+    for _, board in found:
+        boards.setdefault(position_key(board), board)
+
+    evaluations = {}
+    if cache is not None:
+        evaluations = cache.get_many(boards, depth, pool.name)
+    missing = {key: board for key, board in boards.items() if key not in evaluations}
+
+    with profile.stage("analyse", len(missing)):
+        analysed = dict(pool.analyse_many(missing, depth))
+    if cache is not None and analysed:
+        cache.put_many(analysed, depth, pool.name)
+    evaluations.update(analysed)
+
+    for node, board in found:
+        text = annotation(board, evaluations[position_key(board)], depth, plies)
+        node.comment = " ".join(filter(None, [node.comment.strip(), text]))
+
+    return {
+        "nodes": len(found),
+        "positions": len(boards),
+        "cached": len(boards) - len(missing),
+        "analysed": len(analysed),
+    }
+
+
+def annotate_pgn(
+    source: Path,
+    output: Path,
+    pool: EnginePool,
+    cache: Optional[EvalCache] = None,
+    depth=18,
+    plies=6,
+    nodes="displayed",
+    batch=32,
+) -> Dict[str, int]:
+    """
+    Write the games of the pgn file source to output with the engine
+    annotations of annotate_games. Games are annotated by batches of batch
+    games, the positions of a batch being analysed concurrently.
+    """
+    totals = {"games": 0, "nodes": 0, "positions": 0, "cached": 0, "analysed": 0}
+
+    def flush(games):
+        stats = annotate_games(games, pool, cache, depth, plies, nodes)
+        for name, value in stats.items():
+            totals[name] += value
+        for game in games:
+            print(game, file=out, end="\n\n")
+        totals["games"] += len(games)
+        games.clear()
+
+    with open(source) as fd, open(output, "w", encoding="utf-8") as out:
+        games = []
+        while True:
+            game = chess.pgn.read_game(fd)
+            if game is None:
+                break
+            games.append(game)
+            if len(games) >= batch:
+                flush(games)
+        flush(games)
+    return totals
+
+
+def parse_options(options: List[str]) -> Dict[str, str]:
+    parsed = {}
+    for option in options:
+        name, equal, value = option.partition("=")
+        if not equal:
+            raise ValueError(f"invalid engine option {option}, expected NAME=VALUE")
+        parsed[name.strip()] = value.strip()
+    return parsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Annotate the positions of a pgn study without comment with the evaluation and best line of a local UCI engine. The output is a pgn file to convert with study.py."
+    )
+    parser.add_argument("file", type=Path, help="PGN File to annotate")
+    parser.add_argument("-o", "--output", type=Path, required=True)
+    parser.add_argument(
+        "--engine",
+        "-e",
+        default="stockfish",
+        help="Command starting the UCI engine.",
+    )
+    parser.add_argument(
+        "--engines",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of engine processes analysing positions concurrently.",
+    )
+    parser.add_argument("--depth", "-d", type=int, default=18, help="Search depth.")
+    parser.add_argument(
+        "--line",
+        type=int,
+        default=6,
+        help="Number of moves (plies) of the best line in the comments.",
+    )
+    parser.add_argument(
+        "--nodes",
+        choices=NODES,
+        default="displayed",
+        help="Annotated positions: the mainline positions shown with a board (branches and end of the games), every mainline position or every position. Annotated positions get a board in the book.",
+    )
+    parser.add_argument(
+        "--option",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="UCI option of the engines, e.g. Hash=64. Can be repeated.",
+    )
+    parser.add_argument(
+        "--cache",
+        type=Path,
+        default=None,
+        help="Sqlite file keeping the evaluations between runs, only new positions are analysed.",
+    )
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        default=None,
+        help="Write the time, memory and counters of each stage to this json file.",
+    )
+
+    args = parser.parse_args()
+
+    try:
+        options = parse_options(args.option)
+    except ValueError as error:
+        parser.error(str(error))
+
+    profile = profiling.start() if args.profile else profiling.current()
+
+    cache = EvalCache(args.cache) if args.cache else None
+    try:
+        with EnginePool(shlex.split(args.engine), args.engines, options) as pool:
+            stats = annotate_pgn(
+                args.file,
+                args.output,
+                pool,
+                cache,
+                depth=args.depth,
+                plies=args.line,
+                nodes=args.nodes,
+            )
+    except (OSError, chess.engine.EngineError) as error:
+        parser.error(f"engine {args.engine}: {error}")
+    finally:
+        if cache is not None:
+            cache.close()
+
+    print(
+        f"{stats['nodes']} positions annotated in {stats['games']} games: "
+        f"{stats['positions']} distinct, {stats['cached']} from cache, {stats['analysed']} analysed"
+    )
+
+    if args.profile:
+        profile.write(args.profile)
+        print(profile.summary())
+        print("Profile written to", args.profile)
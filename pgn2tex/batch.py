@@ -0,0 +1,266 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from puzzle_cache import PuzzleCache
+from puzzle_store import PuzzleStore
+from puzzles import load_themes, make_book
+from board_helpers import iter_book_from_list_table_layout
+from server import BadRequest, parse_spec
+from utils import write_template
+
+# Keys of a book of the manifest besides the options of the book server
+FILE_KEYS = ["output", "template", "front_page"]
+
+# Keys of the manifest itself
+MANIFEST_KEYS = ["database", "themes_desc", "precompute", "defaults", "books"]
+
+
+class ManifestError(Exception):
+    pass
+
+
+def read_manifest(path: Path) -> Dict:
+    """
+    Manifest as a dict, from json or, when PyYAML is installed, yaml (.yaml
+    or .yml files).
+    """
+    path = Path(path)
+    with open(path, encoding="utf-8") as fd:
+        if path.suffix in (".yaml", ".yml"):
+            try:
+                import yaml
+            except ImportError:
+                raise ManifestError("Reading a yaml manifest needs PyYAML")
+            return yaml.safe_load(fd)
+        return json.load(fd)
+
+
+def plan(manifest: Dict, root: Path) -> Tuple[Dict, List[Dict]]:
+    """
+    Check a manifest and fill in the options of its books. Returns the
+    settings of the batch (database, themes_desc, precompute) and the books:
+    the options of the book server (see server.DEFAULTS) plus output,
+    template and front_page. Paths are relative to root, the directory of
+    the manifest. Raises ManifestError on invalid manifests.
+    """
+    if not isinstance(manifest, dict):
+        raise ManifestError("The manifest must be an object")
+    unknown = [key for key in manifest if key not in MANIFEST_KEYS]
+    if unknown:
+        raise ManifestError(f"Unknown keys: {', '.join(unknown)}")
+
+    settings = {
+        "database": root / manifest.get("database", "data/lichess_db_puzzle.csv"),
+        "themes_desc": root / manifest.get("themes_desc", "data/puzzleTheme.xml"),
+        "precompute": bool(manifest.get("precompute", False)),
+    }
+    try:
+        themes = load_themes(settings["themes_desc"])
+    except OSError as error:
+        raise ManifestError(f"Cannot read the themes description: {error}")
+
+    defaults = manifest.get("defaults", {})
+    books = manifest.get("books")
+    if not isinstance(defaults, dict):
+        raise ManifestError("defaults must be an object")
+    if not isinstance(books, list) or not books:
+        raise ManifestError("books must be a non empty list")
+
+    planned = []
+    outputs = set()
+    for number, book in enumerate(books, start=1):
+        if not isinstance(book, dict):
+            raise ManifestError(f"Book {number} must be an object")
+        spec = {**defaults, **book}
+        files = {key: spec.pop(key, None) for key in FILE_KEYS}
+        where = f"Book {number} ({files['output']})"
+        if files["output"] is None:
+            raise ManifestError(f"Book {number} has no output")
+        try:
+            options = parse_spec(spec, themes, root)
+        except BadRequest as error:
+            raise ManifestError(f"{where}: {error}")
+
+        options["output"] = root / files["output"]
+        if options["output"] in outputs:
+            raise ManifestError(f"{where}: output already written by another book")
+        outputs.add(options["output"])
+
+        options["template"] = "$content"
+        if files["template"] is not None:
+            try:
+                options["template"] = (root / files["template"]).read_text()
+            except OSError as error:
+                raise ManifestError(f"{where}: cannot read the template: {error}")
+
+        options["frontpage"] = ""
+        if files["front_page"] is not None:
+            # As puzzles.py, with / for latex to work in Windows
+            frontpage_path = os.path.abspath(root / files["front_page"])
+            frontpage_path = frontpage_path.replace("\\", "/")
+            options["frontpage"] = (
+                "\\includepdf[pages=1, noautoscale]{%s}" % frontpage_path
+            )
+        planned.append(options)
+    return settings, planned
+
+
+def selection(options: Dict) -> Tuple:
+    """
+    Key of the puzzles a book draws from, books with the same key share them.
+    """
+    themes = options["themes"]
+    return (
+        options["min_rating"],
+        options["max_rating"],
+        None if themes is None else tuple(themes),
+        options["theme_query"],
+    )
+
+
+def tasks(books: List[Dict], jobs=1) -> List[Tuple[Tuple, List[Dict]]]:
+    """
+    Books grouped by selection, so each group selects its puzzles once. With
+    several jobs, groups are split in at most jobs parts to keep every
+    process busy.
+    """
+    groups: Dict[Tuple, List[Dict]] = {}
+    for options in books:
+        groups.setdefault(selection(options), []).append(options)
+
+    size = -(-len(books) // jobs)
+    return [
+        (key, group[start : start + size])
+        for key, group in groups.items()
+        for start in range(0, len(group), size)
+    ]
+
+
+# State of the worker processes, loaded once by _init_worker
+_store: Optional[PuzzleCache] = None
+_themes: Dict = {}
+
+
+def _init_worker(database: Path, themes_desc: Path) -> None:
+    global _store, _themes
+    _store = PuzzleCache.open(database)
+    _store.theme_index()
+    _store.rating_index()
+    _themes = load_themes(themes_desc)
+
+
+def build_books(key: Tuple, books: List[Dict]) -> List[Tuple[Path, int, float]]:
+    """
+    Write the books sharing the selection key, from the puzzle store of the
+    worker. Returns the output, number of puzzles and seconds spent of each
+    book.
+    """
+    start = time.perf_counter()
+    min_rating, max_rating, themes, theme_query = key
+    rows = _store.select(
+        min_rating, max_rating, None if themes is None else list(themes), theme_query
+    )
+    puzzles = PuzzleStore.from_cache(_store, rows)
+    # The selection is shared, its time is counted for the first book
+    results = []
+    for options in books:
+        book = make_book(
+            puzzles,
+            _themes,
+            min_rating=options["min_rating"],
+            max_rating=options["max_rating"],
+            step_size=options["step_size"],
+            quantiles=options["quantiles"],
+            problems=options["problems"],
+            page_number=options["page_number"],
+            is_categorized=options["categorized"],
+            tags=options["themes"],
+            seed=options["seed"],
+            unique_positions=options["unique_positions"],
+        )
+        content = iter_book_from_list_table_layout(
+            book, level=0, book=True, is_categorized=options["categorized"]
+        )
+        output = options["output"]
+        output.parent.mkdir(parents=True, exist_ok=True)
+        with open(output, "w", encoding="utf-8") as fd:
+            write_template(
+                fd, options["template"], content, frontpage=options["frontpage"]
+            )
+        results.append((output, puzzle_count(book), time.perf_counter() - start))
+        start = time.perf_counter()
+    return results
+
+
+def puzzle_count(book: List) -> int:
+    """
+    Number of puzzles of a book of puzzles.book_layout.
+    """
+    count = 0
+    for _, kind, items, _ in book:
+        if kind == "list":
+            count += sum(len(section[2]) for section in items)
+        else:
+            count += len(items)
+    return count
+
+
+def run(settings: Dict, books: List[Dict], jobs=1):
+    """
+    Write every book, the puzzle database being loaded once per process.
+    Yields the output, number of puzzles and seconds spent of each book as
+    they are written.
+    """
+    # Built, checked and precomputed once here rather than by every worker
+    store = PuzzleCache.open(settings["database"])
+    if settings["precompute"]:
+        store.precompute(jobs=jobs)
+
+    initargs = (settings["database"], settings["themes_desc"])
+    if jobs == 1:
+        _init_worker(*initargs)
+        for key, group in tasks(books):
+            yield from build_books(key, group)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_worker, initargs=initargs
+    ) as pool:
+        futures = [pool.submit(build_books, *task) for task in tasks(books, jobs)]
+        for future in futures:
+            yield from future.result()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate many puzzle books from a manifest, the puzzle database is loaded once."
+    )
+    parser.add_argument(
+        "manifest",
+        type=Path,
+        help="Json (or yaml with PyYAML) manifest of the books, paths are relative to it.",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        help="Number of processes building books.",
+        default=1,
+    )
+    args = parser.parse_args()
+
+    try:
+        manifest = read_manifest(args.manifest)
+        settings, books = plan(manifest, args.manifest.parent)
+    except (OSError, ValueError, ManifestError) as error:
+        parser.error(str(error))
+
+    start = time.perf_counter()
+    for output, puzzles, seconds in run(settings, books, args.jobs):
+        print(f"{output}  {puzzles} puzzles  {seconds:.2f} s")
+    print(f"{len(books)} books in {time.perf_counter() - start:.2f} s")
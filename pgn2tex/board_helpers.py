@@ -2,15 +2,27 @@ import chess.pgn
 import chess
 import chess.svg
 import math
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Iterator
 
+import profiling
 from utils import load_pgn, get_section_from_level
+from diagrams import Diagram
+from fragment_cache import FragmentCache
+from records import PuzzleRecord, HIDDEN_THEMES, SHOWN_THEMES, as_record
 
-def mk_latex_puzzle(puzzle, counter, is_categorized=True, first_page=False):
-    board = chess.Board(fen=puzzle["FEN"])
+# Placeholder of the puzzle number in the rendered fragments, fragments do not
+# depend on the position of the puzzle in the book so they can be cached
+COUNTER = "%COUNTER%"
 
-    moves = puzzle["Moves"].split(" ")
+# Bump when the output of the renderers changes, to invalidate cached fragments
+RENDER_VERSION = 1
 
-    latex = ""
+# Width of the pre-rendered diagrams, the size of the scaled skak boards
+DIAGRAM_WIDTH = "128pt"
+
+def puzzle_margin(counter, is_categorized=True, first_page=False):
     margin = 2.2
     if counter <= 9:
         margin = 2.0
@@ -20,128 +32,241 @@ def mk_latex_puzzle(puzzle, counter, is_categorized=True, first_page=False):
     if first_page:
         margin += 0
 
+    return margin
+
+def mk_latex_puzzle(puzzle, counter, is_categorized=True, first_page=False):
+    margin = puzzle_margin(counter, is_categorized, first_page)
+    return render_puzzle(puzzle, margin).replace(COUNTER, str(counter))
+
+def board_latex(fen, diagrams=None):
+    """
+    Board of the puzzle, drawn by skak or included from the DiagramStore
+    diagrams.
+    """
+    if diagrams is not None:
+        return diagrams.latex(Diagram.from_fen(fen), DIAGRAM_WIDTH) + "\n \n"
+
+    latex = "\\fenboard{" + fen + "}"
+    latex += "\n"
+    latex += "\n \n"
+    latex += "\\scalebox{0.8}{\\showboard}"
+    latex += "\n \n"
+    return latex
+
+def render_puzzle(puzzle, margin, diagrams=None):
+    puzzle = as_record(puzzle)
+
+    latex = ""
     latex += f"\\vspace{{{margin}cm}} \n \n"
 
-    # calculate number of moves needed for one side to solve the puzzle
-    # based on len of moves variable
-    # example: len = 1, 2 --> need 1 move
-    # len = 3, 4 --> need 2 moves
-    num_of_moves = len(moves) // 2
-        
     # add section to the puzzle
-    puzzle_id = puzzle["PuzzleId"]
+    puzzle_id = puzzle.puzzle_id
     latex += "\\newgame \n"
     latex += "\n \n \n \n \n"
     latex += "\\phantomsection \n"
-    latex += f"{counter}. \\textbf{{{turn2str(board.turn)}}}, solved in {num_of_moves} moves \\pageref{{solution-{puzzle_id}}}. \n"
+    # The puzzle is shown before the opponent move
+    latex += f"{COUNTER}. \\textbf{{{turn2str(not puzzle.turn)}}}, solved in {puzzle.num_moves} moves \\pageref{{solution-{puzzle_id}}}. \n"
     latex += f"\\label{{puzzle-{puzzle_id}}} \n"
-    latex += "\\fenboard{" + board.fen() + "}"
-    latex += "\n"
-    latex += "\n \n"
-    latex += "\\scalebox{0.8}{\\showboard}"
-    latex += "\n \n"
+    latex += board_latex(puzzle.start_fen, diagrams)
 
     return latex
 
 def mk_latex_puzzle_table_cell(puzzle, counter, is_categorized=True, is_first_page=False):
-    board = chess.Board(fen=puzzle["FEN"])
+    latex = render_puzzle_table_cell(puzzle, is_first_page)
+    return latex.replace(COUNTER, str(counter)) + row_end(counter)
+
+def render_puzzle_table_cell(puzzle, is_first_page=False, diagrams=None):
+    puzzle = as_record(puzzle)
 
-    moves = puzzle["Moves"].split(" ")
-    moves = [chess.Move.from_uci(move) for move in moves]
-    board.push(moves[0])
-    
     latex = ""
     margin = 4.0
     
     if is_first_page:
         margin = 4.0
     
-    # show the first 5 themes
-    themes = puzzle["Themes"].split(" ")
-    # remove "mate", "short", "long", "oneMove", "veryLong" from the themes
-    themes = [theme for theme in themes if theme not in ["mate", "short", "long", "oneMove", "veryLong"]]
-    themes = " ".join(themes[:5])
+    # show the first 5 themes, except "mate", "short", "long", "oneMove", "veryLong"
+    themes = puzzle.shown_themes
     margin -= math.ceil(len(themes) / 34) * 0.2
 
-    # calculate number of moves needed for one side to solve the puzzle
-    # based on len of moves variable
-    # example: len = 1, 2 --> need 1 move
-    # len = 3, 4 --> need 2 moves
-    num_of_moves = len(moves) // 2
-        
     # add section to the puzzle
-    puzzle_id = puzzle["PuzzleId"]
+    puzzle_id = puzzle.puzzle_id
     latex += "\\newgame \n"
     latex += "\n \n \n \n \n"
     latex += "\\phantomsection \n"
-    latex += f"{counter}. \\textbf{{{turn2str(board.turn)}}}, {num_of_moves} moves, \\pageref{{solution-{puzzle_id}}}. \n"
+    latex += f"{COUNTER}. \\textbf{{{turn2str(puzzle.turn)}}}, {puzzle.num_moves} moves, \\pageref{{solution-{puzzle_id}}}. \n"
     latex += f"\\label{{puzzle-{puzzle_id}}} \n"
-    latex += "\\fenboard{" + board.fen() + "}"
-    latex += "\n"
-    latex += "\n \n"
-    latex += "\\scalebox{0.8}{\\showboard}"
-    latex += "\n \n"
+    latex += board_latex(puzzle.display_fen, diagrams)
     latex += f"\\noindent {themes} \n \n"
     latex += f"\\hspace{{{margin}cm}} \n \n"
 
-    num_of_cols = 3
+    return latex
+
+def row_end(counter, num_of_cols=3):
     if counter % num_of_cols == 0:
         # end of row
-        latex += "\\\\" + "\n"
+        return "\\\\" + "\n"
     else:
-        latex += "&" + "\n"
-
-    return latex
+        return "&" + "\n"
 
 def mk_latex_puzzle_solution(puzzle, counter):
-    board = chess.Board(fen=puzzle["FEN"])
+    return render_puzzle_solution(puzzle).replace(COUNTER, str(counter))
 
-    moves = puzzle["Moves"].split(" ")
-    moves = [chess.Move.from_uci(move) for move in moves]
-    board.push(moves[0])
-    solution = board.variation_san(moves[1:])
-    # escape the # character
-    solution = solution.replace("#", "\\#")
+def render_puzzle_solution(puzzle, diagrams=None):
+    puzzle = as_record(puzzle)
 
-    latex = f"\\noindent \\textbf{{{counter}. {turn2str(board.turn)} to move. }}\n"
+    latex = f"\\noindent \\textbf{{{COUNTER}. {turn2str(puzzle.turn)} to move. }}\n"
     latex += "\\phantomsection \n"
-    latex += f"\\noindent \\label{{solution-{puzzle['PuzzleId']}}}\n \n"
+    latex += f"\\noindent \\label{{solution-{puzzle.puzzle_id}}}\n \n"
     latex += "\n \n"
-    latex += "\\noindent {" + solution + "} \n \n"
+    latex += "\\noindent {" + puzzle.solution + "} \n \n"
     # show theme of the puzzle
-    # latex += f"\\noindent Theme: {puzzle['Themes']} \n \n"
-    latex += f"\\noindent Puzzle: \\pageref{{puzzle-{puzzle['PuzzleId']}}}"
+    # latex += f"\\noindent Theme: {puzzle.themes} \n \n"
+    latex += f"\\noindent Puzzle: \\pageref{{puzzle-{puzzle.puzzle_id}}}"
     latex += "\n \n"
     latex += "\\vspace{0.2cm} \n \n"
 
     return latex
 
-def mk_book_from_list(L, level=0, book=True, is_categorized=True) -> str:
-    latex = ""
+def _render(task, diagrams=None):
+    renderer, puzzle, counter, options = task
+    return renderer(puzzle, *options, diagrams=diagrams)
+
+def _task_key(task, diagrams=None):
+    renderer, puzzle, counter, options = task
+    if isinstance(puzzle, PuzzleRecord):
+        fields = (puzzle.puzzle_id, puzzle.fen, puzzle.moves, puzzle.themes)
+    else:
+        fields = (puzzle["PuzzleId"], puzzle["FEN"], puzzle["Moves"], puzzle["Themes"])
+    hidden = (HIDDEN_THEMES, SHOWN_THEMES) if renderer is render_puzzle_table_cell else ()
+    if diagrams is not None:
+        fields += (diagrams,)
+    return FragmentCache.key(RENDER_VERSION, renderer.__name__, options, hidden, *fields)
+
+def _task_diagram(task):
+    """
+    Diagram drawn by a rendering task, None for the solutions.
+    """
+    renderer, puzzle, counter, options = task
+    if renderer is render_puzzle:
+        return Diagram.from_fen(as_record(puzzle).start_fen)
+    if renderer is render_puzzle_table_cell:
+        return Diagram.from_fen(as_record(puzzle).display_fen)
+    return None
+
+def render_fragments(items, jobs=1, chunksize=64, cache=None, diagrams=None) -> Iterator[str]:
+    """
+    Turn a layout, made of latex strings and (renderer, puzzle, counter,
+    options) puzzle rendering tasks, into latex fragments.
+
+    With a FragmentCache the fragments already rendered by a previous run are
+    reused and only the missing ones are rendered. With jobs > 1 they are
+    rendered in a pool of jobs processes, by chunks of chunksize tasks. The
+    fragments are put back at their place in the layout.
+
+    With a DiagramStore the boards are pre-rendered diagrams, the missing
+    ones are rendered by jobs processes.
+    """
+    render = partial(_render, diagrams=diagrams)
+    profile = profiling.current()
+
+    if jobs <= 1 and cache is None:
+        rendered = 0
+        for item in items:
+            if isinstance(item, str):
+                yield item
+            else:
+                yield render(item).replace(COUNTER, str(item[2]))
+                rendered += 1
+        profile.count("render", "fragments", rendered)
+        if diagrams is not None:
+            profile.count("render", "diagrams written", diagrams.render())
+        return
+
+    items = list(items)
+    tasks = [item for item in items if not isinstance(item, str)]
+
+    if diagrams is not None:
+        # Cached fragments include diagrams too, make sure they all exist
+        written = diagrams.render(filter(None, map(_task_diagram, tasks)), jobs=jobs)
+        profile.count("render", "diagrams written", written)
+
+    if cache is not None:
+        keys = [_task_key(task, diagrams) for task in tasks]
+        fragments = cache.get_many(keys)
+    else:
+        keys = list(range(len(tasks)))
+        fragments = {}
+
+    missing = {}
+    for key, task in zip(keys, tasks):
+        if key not in fragments:
+            missing.setdefault(key, task)
+
+    if jobs > 1 and len(missing) > 1:
+        # The tasks of a puzzle are sent together, in the same chunk they
+        # share its record, so a deferred record is derived once
+        groups = {}
+        for key, task in missing.items():
+            groups.setdefault(id(task[1]), []).append(key)
+        order = [key for keys in groups.values() for key in keys]
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            rendered = pool.map(render, [missing[key] for key in order], chunksize=chunksize)
+            rendered = dict(zip(order, rendered))
+    else:
+        rendered = {key: render(task) for key, task in missing.items()}
+
+    fragments.update(rendered)
+    if cache is not None:
+        cache.put_many(rendered)
+    profile.count("render", "fragments", len(tasks))
+    profile.count("render", "cached", len(tasks) - len(missing))
+
+    results = (fragments[key].replace(COUNTER, str(task[2])) for key, task in zip(keys, tasks))
+    for item in items:
+        yield item if isinstance(item, str) else next(results)
+
+def mk_book_from_list(L, level=0, book=True, is_categorized=True, jobs=1, cache=None, diagrams=None) -> str:
+    return "".join(iter_book_from_list(L, level, book, is_categorized, jobs, cache, diagrams))
+
+def iter_book_from_list(L, level=0, book=True, is_categorized=True, jobs=1, cache=None, diagrams=None) -> Iterator[str]:
+    """
+    Yield the latex of the book described by L fragment by fragment, so it
+    can be written as it is produced (see utils.write_template). Puzzles are
+    rendered by jobs processes, through the FragmentCache cache if any, with
+    the diagrams of the DiagramStore diagrams if any.
+    """
+    layout = _layout_list(L, level, book, is_categorized)
+    yield from render_fragments(layout, jobs, cache=cache, diagrams=diagrams)
+
+def _layout_list(L, level=0, book=True, is_categorized=True):
+    """
+    Layout of the book: latex strings and (renderer, puzzle, counter, options)
+    tasks rendering the puzzles, see render_fragments.
+    """
     for l in L:
         if l[1] == "puzzles":
             is_first_page = True
 
-            latex += "\\newpage \n"
-            latex += get_section_from_level(l[0], level, book)
-            latex += "\n"
-            latex += l[3]
+            yield "\\newpage \n"
+            yield get_section_from_level(l[0], level, book)
+            yield "\n"
+            yield l[3]
             # if is_categorized is False, show the first 6 puzzles in the first page
             if not is_categorized:
-                latex += "\\begin{multicols}{3} \n"
+                yield "\\begin{multicols}{3} \n"
                 counter = 1
                 for p in l[2]:
                     if counter < 7:
-                        latex += "\\begin{samepage} \n"
-                        latex += mk_latex_puzzle(p, counter, is_categorized, is_first_page)
-                        latex += "\\end{samepage}"
+                        yield "\\begin{samepage} \n"
+                        yield (render_puzzle, p, counter, (puzzle_margin(counter, is_categorized, is_first_page),))
+                        yield "\\end{samepage}"
                         counter += 1
                 # new page after 6 puzzles
-                latex += "\\end{multicols} \n"
-                latex += "\\newpage \n"
-                latex += l[3]
+                yield "\\end{multicols} \n"
+                yield "\\newpage \n"
+                yield l[3]
 
-            latex += "\\begin{multicols}{3} \n"
+            yield "\\begin{multicols}{3} \n"
             counter = 1
             for p in l[2]:
                 # if is_categorized is False, skip the first 6 puzzles
@@ -154,68 +279,77 @@ def mk_book_from_list(L, level=0, book=True, is_categorized=True) -> str:
                         is_first_page = False
                         counter = 1
 
-                latex += "\\begin{samepage} \n"
-                latex += mk_latex_puzzle(p, counter, is_categorized)
-                latex += "\\end{samepage}"
+                yield "\\begin{samepage} \n"
+                yield (render_puzzle, p, counter, (puzzle_margin(counter, is_categorized),))
+                yield "\\end{samepage}"
                 # new page after 9 puzzles
                 if counter % 9 == 0 and counter < len(l[2]):
-                    latex += "\\end{multicols} \n"
-                    latex += "\\newpage \n"
-                    latex += "\n"
-                    latex += l[3]
-                    latex += "\n"
-                    latex += "\\begin{multicols}{3} \n"
+                    yield "\\end{multicols} \n"
+                    yield "\\newpage \n"
+                    yield "\n"
+                    yield l[3]
+                    yield "\n"
+                    yield "\\begin{multicols}{3} \n"
                 counter += 1
-            latex += "\\end{multicols} \n"
+            yield "\\end{multicols} \n"
             # put solution to separate page
-            latex += "\\newpage \n"
-            latex += f"\\noindent\\textbf{{Solution for {l[0]}}} % Custom heading \n"
-            latex += "\n"
-            latex += l[3]
+            yield "\\newpage \n"
+            yield f"\\noindent\\textbf{{Solution for {l[0]}}} % Custom heading \n"
+            yield "\n"
+            yield l[3]
             counter = 1
-            latex += "\\begin{multicols}{3} \n"
+            yield "\\begin{multicols}{3} \n"
             for p in l[2]:
-                latex += "\\begin{samepage} \n"
-                latex += mk_latex_puzzle_solution(p, counter)
-                latex += "\\end{samepage}"
-                latex += "\n \n"
+                yield "\\begin{samepage} \n"
+                yield (render_puzzle_solution, p, counter, ())
+                yield "\\end{samepage}"
+                yield "\n \n"
 
                 counter += 1
-            latex += "\\end{multicols} \n"
+            yield "\\end{multicols} \n"
 
         else:
-            latex += get_section_from_level(l[0], level, book)
-            latex += "\n"
-            latex += l[3]
-            latex += mk_book_from_list(l[2], level=level + 1, book=book, is_categorized=is_categorized)
+            yield get_section_from_level(l[0], level, book)
+            yield "\n"
+            yield l[3]
+            yield from _layout_list(l[2], level=level + 1, book=book, is_categorized=is_categorized)
 
-    return latex
 
-def mk_book_from_list_table_layout(L, level=0, book=True, is_categorized=True) -> str:
-    latex = ""
+def mk_book_from_list_table_layout(L, level=0, book=True, is_categorized=True, jobs=1, cache=None, diagrams=None) -> str:
+    return "".join(iter_book_from_list_table_layout(L, level, book, is_categorized, jobs, cache, diagrams))
+
+def iter_book_from_list_table_layout(L, level=0, book=True, is_categorized=True, jobs=1, cache=None, diagrams=None) -> Iterator[str]:
+    """
+    Same as iter_book_from_list with the puzzles laid out in a 3 columns table.
+    """
+    layout = _layout_table(L, level, book, is_categorized)
+    yield from render_fragments(layout, jobs, cache=cache, diagrams=diagrams)
+
+def _layout_table(L, level=0, book=True, is_categorized=True):
     for l in L:
         if l[1] == "puzzles":
             is_first_page_included = False
 
-            latex += "\\newpage \n"
-            latex += get_section_from_level(l[0], level, book)
-            latex += "\n"
-            latex += l[3]
+            yield "\\newpage \n"
+            yield get_section_from_level(l[0], level, book)
+            yield "\n"
+            yield l[3]
             # if is_categorized is False, show the first 6 puzzles in the first page
             if not is_categorized:
                 is_first_page_included = True
-                latex += "\\begin{longtable}{p{0.32\\textwidth}p{0.32\\textwidth}p{0.32\\textwidth}} \n"
+                yield "\\begin{longtable}{p{0.32\\textwidth}p{0.32\\textwidth}p{0.32\\textwidth}} \n"
                 counter = 1
                 for p in l[2]:
                     if counter < 7:
-                        latex += mk_latex_puzzle_table_cell(p, counter, is_categorized, is_first_page_included)
+                        yield (render_puzzle_table_cell, p, counter, (is_first_page_included,))
+                        yield row_end(counter)
                         counter += 1
                 # new page after 6 puzzles
-                latex += "\\end{longtable} \n"
-                latex += "\\newpage \n"
-                latex += l[3]
+                yield "\\end{longtable} \n"
+                yield "\\newpage \n"
+                yield l[3]
 
-            latex += "\\begin{longtable}{p{0.32\\textwidth}p{0.32\\textwidth}p{0.32\\textwidth}} \n"
+            yield "\\begin{longtable}{p{0.32\\textwidth}p{0.32\\textwidth}p{0.32\\textwidth}} \n"
             counter = 1
             for p in l[2]:
                 # if is_categorized is False, skip the first 6 puzzles
@@ -225,7 +359,8 @@ def mk_book_from_list_table_layout(L, level=0, book=True, is_categorized=True) -
                         counter += 1
                         continue
 
-                latex += mk_latex_puzzle_table_cell(p, counter, is_categorized)
+                yield (render_puzzle_table_cell, p, counter, (False,))
+                yield row_end(counter)
                 # new page after 9 puzzles
                 is_end_of_page = False
                 if (is_first_page_included and (counter - 6) % 9 == 0):
@@ -233,37 +368,36 @@ def mk_book_from_list_table_layout(L, level=0, book=True, is_categorized=True) -
                 elif (not is_first_page_included and counter % 9 == 0):
                     is_end_of_page = True;
                 if is_end_of_page and counter < len(l[2]):
-                    latex += "\\end{longtable} \n"
-                    latex += "\\newpage \n"
-                    latex += "\n"
-                    latex += l[3]
-                    latex += "\n"
-                    latex += "\\begin{longtable}{p{0.32\\textwidth}p{0.32\\textwidth}p{0.32\\textwidth}} \n"
+                    yield "\\end{longtable} \n"
+                    yield "\\newpage \n"
+                    yield "\n"
+                    yield l[3]
+                    yield "\n"
+                    yield "\\begin{longtable}{p{0.32\\textwidth}p{0.32\\textwidth}p{0.32\\textwidth}} \n"
                 counter += 1
-            latex += "\\end{longtable} \n"
+            yield "\\end{longtable} \n"
             # put solution to separate page
-            latex += "\\newpage \n"
-            latex += f"\\noindent\\textbf{{Solution for {l[0]}}} % Custom heading \n"
-            latex += "\n"
-            latex += l[3]
+            yield "\\newpage \n"
+            yield f"\\noindent\\textbf{{Solution for {l[0]}}} % Custom heading \n"
+            yield "\n"
+            yield l[3]
             counter = 1
-            latex += "\\begin{multicols}{3} \n"
+            yield "\\begin{multicols}{3} \n"
             for p in l[2]:
-                latex += "\\begin{samepage} \n"
-                latex += mk_latex_puzzle_solution(p, counter)
-                latex += "\\end{samepage}"
-                latex += "\n \n"
+                yield "\\begin{samepage} \n"
+                yield (render_puzzle_solution, p, counter, ())
+                yield "\\end{samepage}"
+                yield "\n \n"
 
                 counter += 1
-            latex += "\\end{multicols} \n"
+            yield "\\end{multicols} \n"
 
         else:
-            latex += get_section_from_level(l[0], level, book)
-            latex += "\n"
-            latex += l[3]
-            latex += mk_book_from_list(l[2], level=level + 1, book=book, is_categorized=is_categorized)
+            yield get_section_from_level(l[0], level, book)
+            yield "\n"
+            yield l[3]
+            yield from _layout_list(l[2], level=level + 1, book=book, is_categorized=is_categorized)
 
-    return latex
 
 def turn2str(turn):
     if turn == chess.WHITE:
@@ -0,0 +1,131 @@
+import argparse
+import asyncio
+import json
+import sys
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+
+class ServiceError(Exception):
+    pass
+
+
+async def _request(
+    method: str,
+    target: str,
+    body: bytes = b"",
+    host="127.0.0.1",
+    port=8765,
+    socket: Optional[Path] = None,
+) -> Tuple[int, bytes]:
+    """
+    Status and body of an HTTP request to the book server (see server.py).
+    """
+    if socket is not None:
+        reader, writer = await asyncio.open_unix_connection(str(socket))
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(
+            f"{method} {target} HTTP/1.1\r\n"
+            f"Host: {host}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+
+        status = int((await reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding") == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).strip(), 16)
+                if size == 0:
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            data = b"".join(chunks)
+        elif "content-length" in headers:
+            data = await reader.readexactly(int(headers["content-length"]))
+        else:
+            data = await reader.read()
+    finally:
+        writer.close()
+    return status, data
+
+
+async def fetch_book(options: Dict, **address) -> str:
+    """
+    Latex of the book described by options (see server.DEFAULTS). address is
+    host and port, or socket, of the server.
+    """
+    status, data = await _request(
+        "POST", "/book", json.dumps(options).encode("utf-8"), **address
+    )
+    if status != 200:
+        try:
+            message = json.loads(data)["error"]
+        except (ValueError, KeyError):
+            message = data.decode("utf-8", "replace")
+        raise ServiceError(f"{status}: {message}")
+    return data.decode("utf-8")
+
+
+async def fetch_health(**address) -> Dict:
+    status, data = await _request("GET", "/health", **address)
+    return json.loads(data)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Ask a book server (server.py) for a puzzle book."
+    )
+    parser.add_argument(
+        "options",
+        nargs="?",
+        default=None,
+        help='Json options of the book, e.g. \'{"themes": ["fork"], "problems": 9}\', or @FILE to read them from a file.',
+    )
+    parser.add_argument("--output", "-o", type=Path, help="Output file", default=None)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", type=Path, default=None)
+    parser.add_argument(
+        "--health", action="store_true", help="Print the statistics of the server."
+    )
+
+    args = parser.parse_args()
+    if args.socket is not None:
+        address = {"socket": args.socket}
+    else:
+        address = {"host": args.host, "port": args.port}
+
+    if args.health:
+        print(json.dumps(asyncio.run(fetch_health(**address)), indent=2))
+        sys.exit()
+
+    text = args.options or "{}"
+    if text.startswith("@"):
+        text = Path(text[1:]).read_text()
+    try:
+        options = json.loads(text)
+    except ValueError as error:
+        parser.error(f"invalid json options: {error}")
+
+    try:
+        latex = asyncio.run(fetch_book(options, **address))
+    except (ServiceError, OSError) as error:
+        sys.exit(str(error))
+
+    if args.output is None:
+        sys.stdout.write(latex)
+    else:
+        args.output.write_text(latex, encoding="utf-8")
@@ -0,0 +1,354 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from utils import add_includeonly, insert_preamble
+
+_INCLUDE = re.compile(r"^[ \t]*\\include\{([^}]*)\}[ \t]*$", re.MULTILINE)
+_INCLUDEONLY = re.compile(r"^[ \t]*\\includeonly\{[^}]*\}[ \t]*\n?", re.MULTILINE)
+
+# Each \pgnbuildmark writes the number of pages shipped out so far to
+# \jobname.pages, it tells which pages of a unit belong to which chapter
+_MARKS = r"""\newwrite\pgnbuildpages
+\AtBeginDocument{\immediate\openout\pgnbuildpages=\jobname.pages}
+\newcommand\pgnbuildmark{\clearpage\immediate\write\pgnbuildpages{\the\ReadonlyShipoutCounter}}
+\AtEndDocument{\pgnbuildmark}"""
+
+
+class BuildError(Exception):
+    pass
+
+
+class Unit:
+    """
+    Part of the book compiled on its own, in its own directory: the master
+    document restricted to some of its chapters with \\includeonly. The aux
+    files of the other chapters are copied in before each pass so page
+    numbers, references and the table of contents are the ones of the whole
+    book.
+    """
+
+    def __init__(self, name: str, directory: Path, includes: List[str]) -> None:
+        """
+        name: name of the unit, also its directory in the build directory
+        includes: chapters of the unit, as given to \\include
+        """
+        self.name = name
+        self.directory = directory
+        self.includes = includes
+        # Checksum of the inputs of the last pass, see inputs
+        self.compiled: Optional[str] = None
+        self.passes = 0
+        self.seconds = 0.0
+
+    @property
+    def pdf(self) -> Path:
+        return self.directory / "main.pdf"
+
+    def inputs(self, root: Path, chapters: List[str]) -> str:
+        """
+        Checksum of what a pass reads: the unit source, the sources of its
+        chapters and the .aux / .toc files. A pass is only needed when it
+        differs from the one of the previous pass.
+        """
+        sha = hashlib.sha256()
+        files = [self.directory / "main.tex", self.directory / "main.aux"]
+        files += [self.directory / "main.toc"]
+        files += [root / f"{include}.tex" for include in self.includes]
+        files += [self.directory / f"{include}.aux" for include in chapters]
+        for path in files:
+            sha.update(str(path).encode("utf-8") + b"\0")
+            if path.exists():
+                sha.update(path.read_bytes())
+            sha.update(b"\0")
+        return sha.hexdigest()
+
+    def page_marks(self) -> List[int]:
+        """
+        Pages shipped out before the first chapter, after each chapter and at
+        the end of the document.
+        """
+        return [
+            int(line) for line in (self.directory / "main.pages").read_text().split()
+        ]
+
+
+def split_units(master: str, unit_size=1) -> List[List[str]]:
+    """
+    Chapters (\\include) of the master document, grouped by units of
+    unit_size chapters.
+    """
+    includes = _INCLUDE.findall(master)
+    return [includes[i : i + unit_size] for i in range(0, len(includes), unit_size)]
+
+
+def unit_source(master: str, includes: List[str]) -> str:
+    """
+    Master document restricted to the given chapters, with a page mark before
+    the first chapter and after every chapter. An \\includeonly of the master
+    (study.py --include-only) is replaced.
+    """
+    master = _INCLUDEONLY.sub("", master)
+    marked = []
+    position = 0
+    for number, match in enumerate(_INCLUDE.finditer(master)):
+        marked.append(master[position : match.start()])
+        if number == 0:
+            marked.append("\\pgnbuildmark\n")
+        marked.append(match.group(0) + "\n\\pgnbuildmark")
+        position = match.end()
+    marked.append(master[position:])
+
+    source = insert_preamble("".join(marked), _MARKS)
+    return add_includeonly(source, includes)
+
+
+def run_latex(engine: str, root: Path, directory: Path, source: Path) -> float:
+    """
+    One pass of engine over source, run from root so the paths of the master
+    document still work, with the output written to directory. Returns the
+    time it took.
+    """
+    start = time.perf_counter()
+    process = subprocess.run(
+        [
+            engine,
+            "-interaction=nonstopmode",
+            "-halt-on-error",
+            f"-output-directory={directory}",
+            f"-jobname={source.stem}",
+            str(source),
+        ],
+        cwd=root,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+    )
+    if process.returncode != 0:
+        tail = "\n".join(process.stdout.splitlines()[-20:])
+        raise BuildError(f"{engine} failed on {source}:\n{tail}")
+    return time.perf_counter() - start
+
+
+def merge_source(units: List[Unit], split: bool) -> str:
+    """
+    Document putting the pages of every unit back together with pdfpages: the
+    pages before the first chapter and after the last one come from the first
+    and the last unit, the pages of each chapter from the unit compiling it.
+    """
+    if not split:
+        ranges = [(units[0], 1, None)]
+    else:
+        ranges = []
+        first = 0
+        for unit in units:
+            marks = unit.page_marks()
+            if unit is units[0] and marks[0] > 0:
+                ranges.append((unit, 1, marks[0]))
+            last = first + len(unit.includes)
+            if marks[last] > marks[first]:
+                ranges.append((unit, marks[first] + 1, marks[last]))
+            if unit is units[-1] and marks[-1] > marks[last]:
+                ranges.append((unit, marks[last] + 1, marks[-1]))
+            first = last
+
+    lines = ["\\documentclass{article}", "\\usepackage{pdfpages}", "\\begin{document}"]
+    for unit, start, end in ranges:
+        pages = f"{start}-" if end is None else f"{start}-{end}"
+        pdf = Path(os.path.relpath(unit.pdf, unit.directory.parent.parent)).as_posix()
+        lines.append(f"\\includepdf[pages={{{pages}}}, fitpaper]{{{pdf}}}")
+    lines.append("\\end{document}")
+    return "\n".join(lines) + "\n"
+
+
+def build(
+    master: Path,
+    build_dir: Optional[Path] = None,
+    output: Optional[Path] = None,
+    jobs=1,
+    unit_size=1,
+    max_passes=5,
+    engine="xelatex",
+    log=print,
+) -> Dict:
+    """
+    Compile the master document into output (master with a .pdf suffix by
+    default). Its \\include'd chapters (study.py --incremental, puzzles.py
+    --chapters) are split in units of unit_size chapters compiled in parallel
+    by jobs processes, the pdf of the units are then merged. A document
+    without \\include is compiled as a single unit.
+
+    A unit is compiled again only when the checksum of its sources and of its
+    .aux / .toc files changed since its previous pass, within max_passes
+    passes. The state is kept in build_dir so the next build starts from the
+    .aux files of this one. Returns the timings of the build.
+    """
+    if shutil.which(engine) is None:
+        raise BuildError(f"{engine} not found, a TeX installation is needed")
+
+    master = Path(master).resolve()
+    root = master.parent
+    build_dir = Path(build_dir or root / f"{master.stem}_build").resolve()
+    output = Path(output) if output else master.with_suffix(".pdf")
+    text = master.read_text()
+    start = time.perf_counter()
+
+    groups = split_units(text, unit_size)
+    split = bool(groups)
+    chapters = [include for group in groups for include in group]
+    if not split:
+        groups = [[]]
+
+    state_path = build_dir / "build.json"
+    try:
+        state = json.loads(state_path.read_text())
+    except (OSError, ValueError):
+        state = {}
+
+    # Latest aux file of every chapter, written by the unit compiling it
+    store = build_dir / "aux"
+    units = []
+    for number, includes in enumerate(groups):
+        name = f"unit{number + 1:03d}"
+        unit = Unit(name, build_dir / "units" / name, includes)
+        unit.compiled = state.get("units", {}).get(name, {}).get("compiled")
+        unit.directory.mkdir(parents=True, exist_ok=True)
+        for include in chapters:
+            (unit.directory / include).parent.mkdir(parents=True, exist_ok=True)
+            (store / include).parent.mkdir(parents=True, exist_ok=True)
+        # Only written when it changed, its checksum is part of the inputs
+        source = unit_source(text, includes) if split else text
+        main = unit.directory / "main.tex"
+        if not main.exists() or main.read_text() != source:
+            main.write_text(source)
+        units.append(unit)
+
+    def compile_unit(unit: Unit) -> None:
+        unit.compiled = unit.inputs(root, chapters)
+        unit.seconds += run_latex(
+            engine, root, unit.directory, unit.directory / "main.tex"
+        )
+        unit.passes += 1
+        for include in unit.includes:
+            aux = unit.directory / f"{include}.aux"
+            if aux.exists():
+                shutil.copyfile(aux, store / f"{include}.aux")
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for _ in range(max_passes):
+            for unit in units:
+                for include in chapters:
+                    aux = store / f"{include}.aux"
+                    if include not in unit.includes and aux.exists():
+                        shutil.copyfile(aux, unit.directory / f"{include}.aux")
+            dirty = [
+                unit
+                for unit in units
+                if not unit.pdf.exists() or unit.compiled != unit.inputs(root, chapters)
+            ]
+            if not dirty:
+                break
+            list(pool.map(compile_unit, dirty))
+        else:
+            log(f"Still changing after {max_passes} passes, stopping there")
+
+    merge_start = time.perf_counter()
+    if len(units) == 1 and not split:
+        shutil.copyfile(units[0].pdf, output)
+    else:
+        merge = build_dir / "merge.tex"
+        merge.write_text(merge_source(units, split))
+        run_latex(engine, build_dir, build_dir, merge)
+        shutil.copyfile(build_dir / "merge.pdf", output)
+    merge_seconds = time.perf_counter() - merge_start
+
+    timings = {
+        "units": {
+            unit.name: {
+                "chapters": unit.includes,
+                "passes": unit.passes,
+                "seconds": round(unit.seconds, 3),
+                "compiled": unit.compiled,
+            }
+            for unit in units
+        },
+        "merge_seconds": round(merge_seconds, 3),
+        "total_seconds": round(time.perf_counter() - start, 3),
+    }
+    state_path.write_text(json.dumps(timings, indent=2))
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compile a latex book made by pgn2tex. The chapters included with \\include (study.py --incremental, puzzles.py --chapters) are compiled in parallel units and merged, passes are only rerun when the .aux / .toc files changed."
+    )
+    parser.add_argument("master", type=Path, help="Master latex document")
+    parser.add_argument(
+        "--output",
+        "-o",
+        type=Path,
+        default=None,
+        help="Output pdf, MASTER.pdf by default",
+    )
+    parser.add_argument(
+        "--build-dir",
+        "-b",
+        type=Path,
+        default=None,
+        help="Directory of the intermediate files, kept between builds. MASTER_build by default",
+    )
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=1, help="Number of units compiled at once."
+    )
+    parser.add_argument(
+        "--unit-size",
+        "-u",
+        type=int,
+        default=1,
+        help="Number of chapters compiled together in one unit.",
+    )
+    parser.add_argument(
+        "--max-passes",
+        type=int,
+        default=5,
+        help="Maximum number of passes over a unit.",
+    )
+    parser.add_argument("--engine", default="xelatex", help="Latex engine to use.")
+
+    args = parser.parse_args()
+
+    try:
+        timings = build(
+            args.master,
+            build_dir=args.build_dir,
+            output=args.output,
+            jobs=args.jobs,
+            unit_size=max(args.unit_size, 1),
+            max_passes=args.max_passes,
+            engine=args.engine,
+        )
+    except BuildError as error:
+        sys.exit(str(error))
+
+    for name, unit in timings["units"].items():
+        chapters = unit["chapters"]
+        if not chapters:
+            chapters = "whole document"
+        elif len(chapters) == 1:
+            chapters = chapters[0]
+        else:
+            chapters = f"{chapters[0]} to {chapters[-1]}"
+        print(f"{name}: {unit['passes']} passes, {unit['seconds']:.1f}s ({chapters})")
+    print(f"merge: {timings['merge_seconds']:.1f}s")
+    print(f"total: {timings['total_seconds']:.1f}s")
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+import chess
+import chess.svg
+
+# Bump when the drawing of the diagrams changes, it is part of their names
+DIAGRAM_VERSION = 1
+
+FORMATS = ["pdf", "svg"]
+
+# Last move highlighted in red, like the red!50 of the skak boards
+COLORS = {
+    "square light lastmove": "#ff9f8f",
+    "square dark lastmove": "#e07a66",
+}
+
+
+class Diagram(NamedTuple):
+    """
+    Everything drawn on a diagram: the position, the last move and the arrows
+    (circles are arrows whose tail is their head). Squares and moves are kept
+    as text so the diagram hashes the same in every process.
+    """
+
+    board_fen: str
+    lastmove: Optional[str] = None
+    arrows: Tuple[Tuple[str, str, str], ...] = ()
+
+    @classmethod
+    def of(
+        cls,
+        board_fen: str,
+        lastmove: Optional[chess.Move] = None,
+        arrows: Iterable[chess.svg.Arrow] = (),
+    ):
+        return cls(
+            board_fen,
+            None if lastmove is None else lastmove.uci(),
+            tuple(
+                (chess.square_name(a.tail), chess.square_name(a.head), a.color)
+                for a in arrows
+            ),
+        )
+
+    @classmethod
+    def from_fen(cls, fen: str):
+        """
+        Diagram of the position of a fen, without markup.
+        """
+        return cls(fen.split(" ")[0])
+
+    def svg(self) -> str:
+        return chess.svg.board(
+            chess.BaseBoard(self.board_fen),
+            lastmove=(
+                None if self.lastmove is None else chess.Move.from_uci(self.lastmove)
+            ),
+            arrows=[
+                chess.svg.Arrow(
+                    chess.parse_square(tail), chess.parse_square(head), color=color
+                )
+                for tail, head, color in self.arrows
+            ],
+            colors=COLORS,
+        )
+
+
+def check_format(fmt: str) -> None:
+    """
+    Raise ValueError when the diagrams can not be written in format fmt.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown diagram format {fmt}, use one of {FORMATS}")
+    if fmt == "pdf":
+        try:
+            import cairosvg  # noqa: F401
+        except ImportError:
+            raise ValueError(
+                "pdf diagrams need cairosvg (pip install cairosvg), or use the svg format"
+            )
+
+
+def _render_file(task) -> None:
+    path, diagram, fmt = task
+    svg = diagram.svg()
+    if fmt == "pdf":
+        import cairosvg
+
+        data = cairosvg.svg2pdf(bytestring=svg.encode("utf-8"))
+    else:
+        data = svg.encode("utf-8")
+
+    # Written under a temporary name so a concurrent run never includes a
+    # partial file
+    path = Path(path)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+class DiagramStore:
+    """
+    Pre-rendered board diagrams, used instead of drawing the boards with skak
+    when the latex is compiled. Each diagram is a file of directory named
+    after a hash of everything it shows, so a file is rendered once and
+    reused by every later run and every book drawing the same diagram.
+
+    latex() gives the \\includegraphics of a diagram and remembers it, render()
+    then writes the files that do not exist yet.
+    """
+
+    def __init__(self, directory: Path, prefix: Optional[str] = None, fmt="pdf"):
+        """
+        directory: where the diagrams are written
+        prefix: path of directory in the latex, relative to the compiled
+            document. directory itself when None
+        fmt: pdf (vector pdf through cairosvg) or svg (needs the latex svg
+            package and inkscape at compile time)
+        """
+        self.directory = Path(directory)
+        self.prefix = Path(directory).as_posix() if prefix is None else prefix
+        self.fmt = fmt
+        # Diagrams given to latex() and not rendered yet, by file name
+        self.requested: Dict[str, Diagram] = {}
+
+    def __repr__(self) -> str:
+        return f"DiagramStore({self.prefix!r}, fmt={self.fmt!r}, version={DIAGRAM_VERSION})"
+
+    def name(self, diagram: Diagram) -> str:
+        key = json.dumps([DIAGRAM_VERSION, list(diagram)])
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()[:24] + "." + self.fmt
+
+    def latex(self, diagram: Diagram, width: str) -> str:
+        """
+        Latex including the diagram with the given width.
+        """
+        name = self.name(diagram)
+        self.requested[name] = diagram
+        if self.fmt == "svg":
+            return f"\\includesvg[width={width}]{{{self.prefix}/{name[:-4]}}}"
+        return f"\\includegraphics[width={width}]{{{self.prefix}/{name}}}"
+
+    def render(self, diagrams: Iterable[Diagram] = (), jobs=1) -> int:
+        """
+        Write the files of the requested diagrams and of the given ones that
+        do not exist yet, with a pool of jobs processes. Returns the number of
+        files written.
+        """
+        wanted = dict(self.requested)
+        wanted.update((self.name(diagram), diagram) for diagram in diagrams)
+        self.requested = {}
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tasks = [
+            (self.directory / name, diagram, self.fmt)
+            for name, diagram in wanted.items()
+            if not (self.directory / name).exists()
+        ]
+        if jobs > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                list(pool.map(_render_file, tasks, chunksize=16))
+        else:
+            for task in tasks:
+                _render_file(task)
+        return len(tasks)
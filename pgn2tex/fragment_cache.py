@@ -0,0 +1,120 @@
+import hashlib
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Iterable
+
+
+class FragmentCache:
+    """
+    Persistent cache of rendered latex fragments, stored in a sqlite database.
+
+    Fragments are content addressed: the key is a hash of everything the
+    rendering depends on (see FragmentCache.key). The total size of the
+    fragments is bounded, the least recently used ones are evicted when the
+    cache is closed.
+    """
+
+    def __init__(self, path: Path, max_size: int = 256 * 2**20) -> None:
+        """
+        path: sqlite database file, created if needed
+        max_size: maximum total size of the cached fragments, in bytes
+        """
+        self.path = Path(path)
+        self.max_size = max_size
+
+        self.db = sqlite3.connect(str(self.path))
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS fragments ("
+            "key TEXT PRIMARY KEY, latex TEXT NOT NULL, "
+            "size INTEGER NOT NULL, used REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS fragments_used ON fragments(used)")
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(*parts) -> str:
+        sha = hashlib.sha256()
+        for part in parts:
+            sha.update(str(part).encode("utf-8"))
+            sha.update(b"\0")
+        return sha.hexdigest()
+
+    def get_many(self, keys: Iterable[str], batch=500) -> Dict[str, str]:
+        """
+        Cached fragments of the given keys, missing keys are left out.
+        """
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        for i in range(0, len(keys), batch):
+            chunk = keys[i : i + batch]
+            marks = ",".join("?" * len(chunk))
+            found.update(
+                self.db.execute(
+                    f"SELECT key, latex FROM fragments WHERE key IN ({marks})", chunk
+                )
+            )
+
+        now = time.time()
+        self.db.executemany(
+            "UPDATE fragments SET used = ? WHERE key = ?", ((now, k) for k in found)
+        )
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, fragments: Dict[str, str]) -> None:
+        now = time.time()
+        self.db.executemany(
+            "INSERT OR REPLACE INTO fragments (key, latex, size, used) VALUES (?, ?, ?, ?)",
+            (
+                (key, latex, len(latex.encode("utf-8")), now)
+                for key, latex in fragments.items()
+            ),
+        )
+
+    def size(self) -> int:
+        return self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM fragments"
+        ).fetchone()[0]
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used fragments until the cache fits in
+        max_size.
+        """
+        excess = self.size() - self.max_size
+        if excess <= 0:
+            return
+
+        evicted = []
+        for key, size in self.db.execute(
+            "SELECT key, size FROM fragments ORDER BY used"
+        ).fetchall():
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+        self.db.executemany("DELETE FROM fragments WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def close(self) -> None:
+        self.evict()
+        self.db.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
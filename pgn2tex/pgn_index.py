@@ -0,0 +1,162 @@
+import json
+import os
+import sqlite3
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+from utils import scan_headers
+
+INDEX_VERSION = 1
+
+# Headers stored in the index, one column each
+HEADERS = ["Event", "Site", "Date", "White", "Black", "WhiteElo", "BlackElo", "ECO"]
+
+
+def index_path(path: Path) -> Path:
+    """
+    Sidecar file holding the index of the pgn file found at path.
+    """
+    path = Path(path)
+    return path.with_name(path.name + ".index")
+
+
+def _source(path: Path) -> dict:
+    stat = os.stat(path)
+    return {
+        "version": INDEX_VERSION,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def _like(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class PgnIndex:
+    """
+    Index of the games of a pgn file: the offset of each game in the file and
+    its main headers, stored in a sqlite database next to the file. It is built
+    once with a scan of the headers only, games are then selected from their
+    headers and read back from their offset without parsing the rest of the
+    file.
+    """
+
+    def __init__(self, db: sqlite3.Connection) -> None:
+        self.db = db
+
+    @classmethod
+    def open(cls, path: Path, index: Optional[Path] = None):
+        """
+        Open the index of the pgn file found at path, (re)building it when it
+        is missing or when the file changed (size or mtime).
+        """
+        path = Path(path)
+        index = index_path(path) if index is None else Path(index)
+        source = _source(path)
+
+        if index.exists():
+            db = sqlite3.connect(str(index))
+            try:
+                (stored,) = db.execute(
+                    "SELECT value FROM meta WHERE key = 'source'"
+                ).fetchone()
+                if json.loads(stored) == source:
+                    return cls(db)
+            except (sqlite3.DatabaseError, TypeError, ValueError):
+                pass
+            db.close()
+
+        build_index(path, index, source)
+        return cls(sqlite3.connect(str(index)))
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM games").fetchone()[0]
+
+    def select(
+        self,
+        games: Optional[Iterable[int]] = None,
+        event: Optional[str] = None,
+        player: Optional[str] = None,
+        eco: Optional[str] = None,
+    ) -> List[Tuple[int, int]]:
+        """
+        Position in the file (starting at 0) and offset of the games matching
+        every given selector, in the order of the file.
+
+        games: positions of the games
+        event: part of the Event header, case insensitive
+        player: part of the White or Black header, case insensitive
+        eco: start of the ECO code, "B9" selects B90 to B99
+        """
+        clauses = []
+        params = []
+        if games is not None:
+            games = list(games)
+            clauses.append(f"number IN ({','.join('?' * len(games))})")
+            params += games
+        if event:
+            clauses.append("Event LIKE ? ESCAPE '\\'")
+            params.append(f"%{_like(event)}%")
+        if player:
+            clauses.append("(White LIKE ? ESCAPE '\\' OR Black LIKE ? ESCAPE '\\')")
+            params += [f"%{_like(player)}%"] * 2
+        if eco:
+            clauses.append("ECO LIKE ? ESCAPE '\\'")
+            params.append(f"{_like(eco)}%")
+
+        query = "SELECT number, offset FROM games"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        return self.db.execute(query + " ORDER BY number", params).fetchall()
+
+    def headers(self, number: int) -> Optional[dict]:
+        """
+        Indexed headers of the game at position number, None if there is none.
+        """
+        row = self.db.execute(
+            f"SELECT {', '.join(HEADERS)} FROM games WHERE number = ?", (number,)
+        ).fetchone()
+        return None if row is None else dict(zip(HEADERS, row))
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def build_index(path: Path, index: Path, source: Optional[dict] = None) -> None:
+    """
+    Scan the headers of the pgn file found at path and write its index. The
+    index is written under a temporary name first so concurrent readers never
+    see a partial file.
+    """
+    source = _source(path) if source is None else source
+    tmp = index.with_name(index.name + ".tmp")
+    if tmp.exists():
+        tmp.unlink()
+
+    db = sqlite3.connect(str(tmp))
+    db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    db.execute(
+        "CREATE TABLE games (number INTEGER PRIMARY KEY, offset INTEGER NOT NULL, "
+        + ", ".join(f"{name} TEXT" for name in HEADERS)
+        + ")"
+    )
+    db.executemany(
+        f"INSERT INTO games VALUES ({', '.join('?' * (len(HEADERS) + 2))})",
+        (
+            (number, offset, *(headers.get(name) for name in HEADERS))
+            for number, (offset, headers) in enumerate(scan_headers(path))
+        ),
+    )
+    db.execute(
+        "INSERT INTO meta VALUES ('source', ?)", (json.dumps(source, sort_keys=True),)
+    )
+    db.commit()
+    db.close()
+    os.replace(tmp, index)
@@ -0,0 +1,84 @@
+from typing import Callable, Dict, List, Optional
+
+import chess
+import chess.polyglot
+
+
+def position_key(board: chess.Board) -> int:
+    """
+    Zobrist hash of the position of board: pieces, side to move, castling
+    rights and en passant square.
+    """
+    return chess.polyglot.zobrist_hash(board)
+
+
+def fen_key(fen: str) -> int:
+    return position_key(chess.Board(fen))
+
+
+def position_label(key: int) -> str:
+    """
+    Latex label of the first diagram of a position.
+    """
+    return f"pos-{key:016x}"
+
+
+class PositionRegistry:
+    """
+    Positions already shown in a book, keyed by their Zobrist hash. The first
+    occurrence of a position is the one displayed, later ones (transpositions,
+    repeated puzzles) refer to it or are dropped.
+    """
+
+    def __init__(self) -> None:
+        # Key -> number of times the position was seen
+        self.seen: Dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.seen)
+
+    def __contains__(self, key: int) -> bool:
+        return key in self.seen
+
+    def add(self, key: int) -> Optional[str]:
+        """
+        Register an occurrence of the position key. Returns the label of its
+        first occurrence when it was already seen, None otherwise.
+        """
+        count = self.seen.get(key, 0)
+        self.seen[key] = count + 1
+        return position_label(key) if count else None
+
+    @property
+    def repeated(self) -> int:
+        """
+        Number of occurrences of positions seen before.
+        """
+        return sum(self.seen.values()) - len(self.seen)
+
+
+def unique_records(
+    rows, count: int, records: Callable, registry: PositionRegistry, multiple=1
+) -> List:
+    """
+    Puzzle records of the first rows, in order, whose position to solve is
+    not in registry yet, each position kept once: a puzzle of a repeated
+    position is replaced by the next row. At most count records are kept,
+    rounded down to a multiple of multiple like the samples, and registered.
+
+    records(rows) gives the records of a slice of rows, they are built as
+    the rows are needed.
+    """
+    kept = {}
+    start = 0
+    while len(kept) < count and start < len(rows):
+        batch = rows[start : start + count - len(kept)]
+        start += len(batch)
+        for record in records(batch):
+            key = fen_key(record.display_fen)
+            if key not in registry and key not in kept:
+                kept[key] = record
+    keys = list(kept)[: len(kept) - len(kept) % multiple]
+    for key in keys:
+        registry.add(key)
+    return [kept[key] for key in keys]
@@ -0,0 +1,232 @@
+"""
+Stage timings and counters of a run, collected by the code of pgn2tex while
+a Profile is active and written by --profile out.json:
+
+    from profiling import profiled
+
+    with profiled() as profile:
+        puzzles = open_puzzles(path)
+        book = make_book(puzzles, themes)
+    profile.write("out.json")
+
+Stages record their calls, wall time, cpu time, items processed and the peak
+RSS of the process at their end. Times are exclusive: the time of a stage
+run inside another one only counts for the inner stage. Counters are grouped
+by scope, e.g. the puzzles of a rating bucket or the nodes of a chapter.
+The stages and counters of worker processes are merged into the profile of
+the main process, their times add up over the processes.
+
+Without an active profile, current() is a profile doing nothing, so the
+instrumented code only pays a function call per stage.
+"""
+
+import json
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+
+def peak_rss() -> Optional[int]:
+    """
+    Peak resident memory of the process in bytes, None when unknown.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Stage:
+    __slots__ = ("calls", "wall", "cpu", "items", "peak_rss")
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.items = 0
+        self.peak_rss: Optional[int] = None
+
+    def to_dict(self) -> Dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Profile:
+    enabled = True
+
+    def __init__(self) -> None:
+        self.stages: Dict[str, Stage] = {}
+        self.counters: Dict[str, Dict[str, int]] = {}
+        # [wall, cpu] of the stages run inside each running stage
+        self._nested = []
+        self._start = (time.perf_counter(), time.process_time())
+
+    def _enter(self):
+        self._nested.append([0.0, 0.0])
+        return time.perf_counter(), time.process_time()
+
+    def _exit(self, name: str, start, items: int, calls=1) -> Stage:
+        wall = time.perf_counter() - start[0]
+        cpu = time.process_time() - start[1]
+        nested_wall, nested_cpu = self._nested.pop()
+        if self._nested:
+            self._nested[-1][0] += wall
+            self._nested[-1][1] += cpu
+
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = Stage()
+        stage.calls += calls
+        stage.wall += wall - nested_wall
+        stage.cpu += cpu - nested_cpu
+        stage.items += items
+        stage.peak_rss = peak_rss()
+        return stage
+
+    @contextmanager
+    def stage(self, name: str, items=0):
+        """
+        Time the block as a call of the stage name, processing items items.
+        The block can add the items it processed to the Stage it gets.
+        """
+        counted = Stage()
+        start = self._enter()
+        try:
+            yield counted
+        finally:
+            self._exit(name, start, items + counted.items)
+
+    def iterate(self, name: str, iterable: Iterable) -> Iterator:
+        """
+        Iterate over iterable, timing the production of its items (e.g. the
+        fragments of a generator) as one call of the stage name.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = self._enter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self._exit(name, start, 0, calls=1)
+                return
+            except BaseException:
+                self._exit(name, start, 0, calls=1)
+                raise
+            self._exit(name, start, 1, calls=0)
+            yield item
+
+    def count(self, scope: str, name: str, value=1) -> None:
+        counters = self.counters.setdefault(scope, {})
+        counters[name] = counters.get(name, 0) + value
+
+    def merge(self, data: Dict) -> None:
+        """
+        Add the stages and counters of another profile, given by to_dict (the
+        profile of a worker process).
+        """
+        for name, values in data["stages"].items():
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = Stage()
+            stage.calls += values["calls"]
+            stage.wall += values["wall"]
+            stage.cpu += values["cpu"]
+            stage.items += values["items"]
+            if values["peak_rss"] is not None:
+                stage.peak_rss = max(stage.peak_rss or 0, values["peak_rss"])
+        for scope, counters in data["counters"].items():
+            for name, value in counters.items():
+                self.count(scope, name, value)
+
+    def to_dict(self) -> Dict:
+        return {
+            "wall": time.perf_counter() - self._start[0],
+            "cpu": time.process_time() - self._start[1],
+            "peak_rss": peak_rss(),
+            "stages": {name: stage.to_dict() for name, stage in self.stages.items()},
+            "counters": self.counters,
+        }
+
+    def write(self, path: Path) -> None:
+        with open(path, "w") as fd:
+            json.dump(self.to_dict(), fd, indent=1)
+
+    def summary(self) -> str:
+        """
+        One line per stage, the slowest first.
+        """
+        lines = []
+        stages = sorted(self.stages.items(), key=lambda item: -item[1].wall)
+        for name, stage in stages:
+            lines.append(
+                f"{name:<20} {stage.wall * 1000:10.1f} ms wall {stage.cpu * 1000:10.1f} ms cpu"
+                f" {stage.calls:6} calls {stage.items:8} items"
+            )
+        return "\n".join(lines)
+
+
+class _NoProfile:
+    """
+    Profile of the runs without --profile: stages and counters are ignored.
+    """
+
+    enabled = False
+
+    @contextmanager
+    def stage(self, name: str, items=0):
+        yield Stage()
+
+    def iterate(self, name: str, iterable: Iterable) -> Iterable:
+        return iterable
+
+    def count(self, scope: str, name: str, value=1) -> None:
+        pass
+
+    def merge(self, data: Dict) -> None:
+        pass
+
+
+_NO_PROFILE = _NoProfile()
+_current = _NO_PROFILE
+
+
+def current():
+    """
+    The active Profile, or a profile ignoring everything.
+    """
+    return _current
+
+
+def start(profile: Optional[Profile] = None) -> Profile:
+    """
+    Make profile (a new one when None) the active profile, until stop().
+    """
+    global _current
+    _current = Profile() if profile is None else profile
+    return _current
+
+
+def stop() -> None:
+    global _current
+    _current = _NO_PROFILE
+
+
+@contextmanager
+def profiled(profile: Optional[Profile] = None):
+    """
+    Make profile (a new one when None) the active profile inside the block.
+    """
+    global _current
+    previous = _current
+    try:
+        yield start(profile)
+    finally:
+        _current = previous
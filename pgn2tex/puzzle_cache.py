@@ -0,0 +1,481 @@
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from puzzle_index import RatingIndex, ThemeIndex
+from records import DERIVED_COLUMNS, HIDDEN_THEMES, SHOWN_THEMES, derive_many
+
+# Bump when the on-disk layout changes, older caches are then rebuilt
+CACHE_VERSION = 2
+
+# Options used to parse the lichess puzzle csv, shared by the cache builder
+# and the plain pandas loader
+CSV_OPTIONS = dict(
+    encoding="utf-8",
+    dtype={
+        "Rating": "float64",
+        "RatingDeviation": "float64",
+        "Popularity": "float64",
+        "NbPlays": "float64",
+    },
+    na_values=["", "NA", "null"],  # Handle common non-numeric values as NaN
+)
+
+# Numeric columns and the type used to store them in the cache
+NUMERIC_COLUMNS = {
+    "Rating": "int16",
+    "RatingDeviation": "int16",
+    "Popularity": "int8",
+    "NbPlays": "int32",
+}
+
+# Columns where values repeat a lot, they are dictionary encoded: one int32
+# code per row and the list of distinct values
+CATEGORY_COLUMNS = ["Themes", "OpeningTags"]
+
+
+def read_puzzle_chunks(path: Path, chunksize=200_000) -> Iterator[pd.DataFrame]:
+    """
+    Stream the puzzle csv by chunks of chunksize rows. Compressed files
+    (.bz2 as shipped by lichess, .gz, .zst...) are decompressed on the fly.
+    """
+    return pd.read_csv(path, chunksize=chunksize, compression="infer", **CSV_OPTIONS)
+
+
+def puzzle_mask(
+    frame: pd.DataFrame, min_rating=None, max_rating=None, themes=None, theme_query=None
+):
+    """
+    Boolean mask of the puzzles with min_rating <= Rating < max_rating, having
+    at least one of the given themes and matching the theme query (see
+    ThemeIndex.query). None disables a predicate.
+    """
+    mask = np.ones(len(frame), dtype=bool)
+    if min_rating is not None:
+        mask &= (frame["Rating"] >= min_rating).to_numpy()
+    if max_rating is not None:
+        mask &= (frame["Rating"] < max_rating).to_numpy()
+    if themes is not None or theme_query is not None:
+        index = ThemeIndex.from_themes(frame["Themes"])
+        if themes is not None:
+            mask &= index.mask(index.any(themes))
+        if theme_query is not None:
+            mask &= index.mask(index.query(theme_query))
+    return mask
+
+
+def cache_path(path: Path) -> Path:
+    """
+    Directory holding the cache of the puzzle database found at path.
+    """
+    path = Path(path)
+    return path.with_name(path.name + ".cache")
+
+
+def file_sha1(path: Path, block_size=1 << 20) -> str:
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as fd:
+        block = fd.read(block_size)
+        while block:
+            sha1.update(block)
+            block = fd.read(block_size)
+    return sha1.hexdigest()
+
+
+def source_fingerprint(path: Path, with_hash=True) -> Dict:
+    stat = os.stat(path)
+    fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if with_hash:
+        fingerprint["sha1"] = file_sha1(path)
+    return fingerprint
+
+
+def _map(path: Path, dtype) -> np.ndarray:
+    # np.memmap refuses empty files
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+class _StringColumnWriter:
+    """
+    Writes a string column as one utf-8 buffer and the offsets of each value
+    in it (n + 1 int64 values).
+    """
+
+    def __init__(self, directory: Path, name: str) -> None:
+        self.data = open(directory / f"{name}.data", "wb")
+        self.offsets = open(directory / f"{name}.offsets", "wb")
+        self.end = 0
+        np.array([0], dtype="int64").tofile(self.offsets)
+
+    def write(self, values) -> None:
+        encoded = [v.encode("utf-8") for v in values]
+        self.data.write(b"".join(encoded))
+        ends = self.end + np.cumsum(np.fromiter(map(len, encoded), dtype="int64"))
+        ends.tofile(self.offsets)
+        if len(ends):
+            self.end = int(ends[-1])
+
+    def close(self) -> None:
+        self.data.close()
+        self.offsets.close()
+
+
+def build_cache(path: Path, directory: Optional[Path] = None, chunksize=200_000):
+    """
+    Convert the puzzle csv found at path into a columnar cache. The csv is read
+    by chunks so the conversion itself does not need to hold the whole
+    database in memory. The cache is written to a temporary directory which
+    replaces the previous cache only once complete.
+
+    Puzzles without rating are left out: they belong to no rating range, so
+    the csv loader never selects them either.
+    """
+    path = Path(path)
+    directory = cache_path(path) if directory is None else Path(directory)
+    tmp = directory.with_name(directory.name + ".tmp")
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    tmp.mkdir(parents=True)
+
+    # The fingerprint is taken before reading so a file modified during the
+    # conversion is detected as stale on the next open
+    fingerprint = source_fingerprint(path)
+
+    columns = None
+    strings = {}
+    numerics = {}
+    codes = {}
+    categories: Dict[str, Dict[str, int]] = {name: {} for name in CATEGORY_COLUMNS}
+    rows = 0
+
+    for chunk in read_puzzle_chunks(path, chunksize):
+        if columns is None:
+            columns = list(chunk.columns)
+            for name in columns:
+                if name in NUMERIC_COLUMNS:
+                    numerics[name] = open(tmp / f"{name}.values", "wb")
+                elif name in CATEGORY_COLUMNS:
+                    codes[name] = open(tmp / f"{name}.codes", "wb")
+                else:
+                    strings[name] = _StringColumnWriter(tmp, name)
+
+        if "Rating" in chunk:
+            chunk = chunk[chunk["Rating"].notna()]
+
+        for name, fd in numerics.items():
+            chunk[name].fillna(0).astype(NUMERIC_COLUMNS[name]).to_numpy().tofile(fd)
+
+        for name, fd in codes.items():
+            lookup = categories[name]
+            np.fromiter(
+                (
+                    lookup.setdefault(v, len(lookup)) if isinstance(v, str) else -1
+                    for v in chunk[name]
+                ),
+                dtype="int32",
+                count=len(chunk),
+            ).tofile(fd)
+
+        for name, writer in strings.items():
+            writer.write(chunk[name].fillna("").astype(str))
+
+        rows += len(chunk)
+
+    for fd in list(numerics.values()) + list(codes.values()):
+        fd.close()
+    for writer in strings.values():
+        writer.close()
+
+    for name in codes:
+        writer = _StringColumnWriter(tmp, f"{name}.categories")
+        writer.write(list(categories[name]))
+        writer.close()
+
+    meta = {
+        "version": CACHE_VERSION,
+        "rows": rows,
+        "columns": columns or [],
+        "numeric": {name: NUMERIC_COLUMNS[name] for name in numerics},
+        "categories": list(codes),
+        "strings": list(strings),
+        "source": fingerprint,
+    }
+    with open(tmp / "meta.json", "w") as fd:
+        json.dump(meta, fd, indent=2)
+
+    if directory.exists():
+        shutil.rmtree(directory)
+    tmp.rename(directory)
+
+    return PuzzleCache(directory, meta)
+
+
+def _decode(data: np.ndarray, offsets: np.ndarray, rows=None) -> List[str]:
+    if rows is None:
+        blob = data.tobytes()
+        text = blob.decode("utf-8")
+        starts = offsets[:-1].tolist()
+        ends = offsets[1:].tolist()
+        # For pure ascii buffers byte offsets are also character offsets,
+        # slicing the decoded text is much faster than decoding each value
+        if len(text) == len(blob):
+            return [text[a:b] for a, b in zip(starts, ends)]
+        return [blob[a:b].decode("utf-8") for a, b in zip(starts, ends)]
+
+    rows = np.asarray(rows, dtype="int64")
+    starts = offsets[rows].tolist()
+    ends = offsets[rows + 1].tolist()
+    return [data[a:b].tobytes().decode("utf-8") for a, b in zip(starts, ends)]
+
+
+class PuzzleCache:
+    """
+    Read access to a columnar cache built by build_cache. Columns are memory
+    mapped, only the rows which are asked for are decoded.
+    """
+
+    def __init__(self, directory: Path, meta: Dict) -> None:
+        self.directory = Path(directory)
+        self.meta = meta
+        # Indexes loaded by theme_index and rating_index, kept for later calls
+        self._theme_index: Optional[ThemeIndex] = None
+        self._rating_index: Optional[RatingIndex] = None
+
+    @classmethod
+    def open(cls, path: Path, directory: Optional[Path] = None, verify=False):
+        """
+        Open the cache of the puzzle database found at path, (re)building it
+        when it is missing or when the source file changed. A changed size or
+        mtime triggers a hash of the source, the cache is only rebuilt when the
+        content differs. With verify=True the hash is always checked.
+        """
+        path = Path(path)
+        directory = cache_path(path) if directory is None else Path(directory)
+
+        meta = cls.read_meta(directory)
+        if meta is None:
+            return build_cache(path, directory)
+
+        fingerprint = source_fingerprint(path, with_hash=False)
+        source = meta["source"]
+        unchanged = (
+            fingerprint["size"] == source["size"]
+            and fingerprint["mtime_ns"] == source["mtime_ns"]
+        )
+        if unchanged and not verify:
+            return cls(directory, meta)
+
+        if fingerprint["size"] != source["size"] or file_sha1(path) != source["sha1"]:
+            return build_cache(path, directory)
+
+        # Same content with a new mtime (copy, touch...), keep the cache
+        meta["source"].update(fingerprint)
+        cache = cls(directory, meta)
+        cache.write_meta()
+        return cache
+
+    @staticmethod
+    def read_meta(directory: Path) -> Optional[Dict]:
+        try:
+            with open(Path(directory) / "meta.json") as fd:
+                meta = json.load(fd)
+        except (OSError, ValueError):
+            return None
+        if meta.get("version") != CACHE_VERSION:
+            return None
+        return meta
+
+    def write_meta(self) -> None:
+        tmp = self.directory / "meta.json.tmp"
+        with open(tmp, "w") as fd:
+            json.dump(self.meta, fd, indent=2)
+        os.replace(tmp, self.directory / "meta.json")
+
+    def __len__(self) -> int:
+        return self.meta["rows"]
+
+    def numeric(self, name: str) -> np.ndarray:
+        dtype = self.meta["numeric"].get(name) or DERIVED_COLUMNS[name]
+        return _map(self.directory / f"{name}.values", dtype)
+
+    def has_derived(self) -> bool:
+        """
+        Whether the derived puzzle fields were precomputed, with the current
+        theme display settings.
+        """
+        derived = self.meta.get("derived")
+        return (
+            derived is not None
+            and derived["hidden_themes"] == HIDDEN_THEMES
+            and derived["shown_themes"] == SHOWN_THEMES
+        )
+
+    def precompute(self, jobs=1, chunksize=20_000) -> None:
+        """
+        Compute the derived fields of every puzzle (displayed fen, side to
+        move, san solution, displayed themes... see records.derive) and store
+        them as extra columns of the cache, so the puzzles never have to be
+        replayed again when rendering. With jobs > 1 the chunks of chunksize
+        puzzles are processed by a pool of processes.
+        """
+        if self.has_derived():
+            return
+
+        strings = {}
+        numerics = {}
+        for name, kind in DERIVED_COLUMNS.items():
+            if kind == "string":
+                strings[name] = _StringColumnWriter(self.directory, name)
+            else:
+                numerics[name] = open(self.directory / f"{name}.values", "wb")
+
+        def chunks():
+            for start in range(0, len(self), chunksize):
+                rows = np.arange(start, min(start + chunksize, len(self)))
+                yield (
+                    self.strings("FEN", rows),
+                    self.strings("Moves", rows),
+                    self.categorical("Themes", rows).astype(object),
+                )
+
+        def write(derived):
+            columns = list(zip(*derived)) or [()] * len(DERIVED_COLUMNS)
+            for name, values in zip(DERIVED_COLUMNS, columns):
+                if name in strings:
+                    strings[name].write(values)
+                else:
+                    np.array(values, dtype=DERIVED_COLUMNS[name]).tofile(numerics[name])
+
+        if jobs > 1:
+            # Submit a few chunks at a time to bound the memory used
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                pending = []
+                for chunk in chunks():
+                    pending.append(pool.submit(derive_many, *chunk))
+                    if len(pending) >= 2 * jobs:
+                        write(pending.pop(0).result())
+                for future in pending:
+                    write(future.result())
+        else:
+            for chunk in chunks():
+                write(derive_many(*chunk))
+
+        for writer in strings.values():
+            writer.close()
+        for fd in numerics.values():
+            fd.close()
+
+        self.meta["derived"] = {
+            "columns": list(DERIVED_COLUMNS),
+            "hidden_themes": HIDDEN_THEMES,
+            "shown_themes": SHOWN_THEMES,
+        }
+        self.write_meta()
+
+    def buffers(self, name: str):
+        """
+        Memory mapped utf-8 buffer of the string column name and the offsets
+        of its values.
+        """
+        return (
+            _map(self.directory / f"{name}.data", "uint8"),
+            _map(self.directory / f"{name}.offsets", "int64"),
+        )
+
+    def strings(self, name: str, rows=None) -> List[str]:
+        return _decode(*self.buffers(name), rows)
+
+    def codes(self, name: str) -> np.ndarray:
+        return _map(self.directory / f"{name}.codes", "int32")
+
+    def categories(self, name: str) -> List[str]:
+        return self.strings(f"{name}.categories")
+
+    def categorical(self, name: str, rows=None) -> pd.Categorical:
+        codes = self.codes(name)
+        codes = np.array(codes if rows is None else codes[rows])
+        return pd.Categorical.from_codes(codes, categories=self.categories(name))
+
+    def theme_index(self) -> ThemeIndex:
+        """
+        Inverted index of the Themes column, built on first use and stored in
+        the cache directory.
+        """
+        if self._theme_index is not None:
+            return self._theme_index
+        index = ThemeIndex.load(self.directory, "Themes.index", len(self))
+        if index is None:
+            index = ThemeIndex.from_codes(
+                self.codes("Themes"), self.categories("Themes")
+            )
+            index.save(self.directory, "Themes.index")
+        self._theme_index = index
+        return index
+
+    def rating_index(self) -> RatingIndex:
+        """
+        Rows sorted by rating, built on first use and stored in the cache
+        directory.
+        """
+        if self._rating_index is not None:
+            return self._rating_index
+        dtype = self.meta["numeric"]["Rating"]
+        index = RatingIndex.load(self.directory, "Rating.index", dtype)
+        if index is None:
+            index = RatingIndex.from_ratings(self.numeric("Rating"))
+            index.save(self.directory, "Rating.index")
+        self._rating_index = index
+        return index
+
+    def select(
+        self, min_rating=None, max_rating=None, themes=None, theme_query=None
+    ) -> np.ndarray:
+        """
+        Row ids of the puzzles matching the predicates, see puzzle_mask. Only
+        the rating and theme indexes are read.
+        """
+        if min_rating is not None or max_rating is not None:
+            mask = np.zeros(len(self), dtype=bool)
+            mask[self.rating_index().range(min_rating, max_rating)] = True
+        else:
+            mask = np.ones(len(self), dtype=bool)
+        if themes is not None or theme_query is not None:
+            index = self.theme_index()
+            if themes is not None:
+                mask &= index.mask(index.any(themes))
+            if theme_query is not None:
+                mask &= index.mask(index.query(theme_query))
+        return np.flatnonzero(mask)
+
+    def to_frame(self, rows=None) -> pd.DataFrame:
+        """
+        Materialize the cache, or only the given rows, as a DataFrame with the
+        same columns as the csv, and the derived columns when they were
+        precomputed.
+        """
+        columns = list(self.meta["columns"])
+        if self.has_derived():
+            columns += list(DERIVED_COLUMNS)
+
+        data = {}
+        for name in columns:
+            if (
+                name in self.meta["numeric"]
+                or DERIVED_COLUMNS.get(name, "string") != "string"
+            ):
+                values = self.numeric(name)
+                data[name] = np.array(values if rows is None else values[rows])
+            elif name in self.meta["categories"]:
+                data[name] = self.categorical(name, rows)
+            else:
+                data[name] = self.strings(name, rows)
+        return pd.DataFrame(data, columns=columns)
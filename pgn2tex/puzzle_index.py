@@ -0,0 +1,282 @@
+import os
+from pathlib import Path
+from typing import Iterable, List, Sequence
+
+import numpy as np
+import pandas as pd
+
+from theme_query import ThemeQuery
+
+
+def split_theme_lists(categories: Sequence[str]):
+    """
+    Distinct space separated theme lists as tag ids: the sorted tags, the
+    ids of the tags of every list, in their order, one list after the other
+    (uint8, uint16 beyond 256 tags) and the offset of each list in them.
+    """
+    split = [str(c).split() for c in categories]
+    tags = sorted({tag for c in split for tag in c})
+    lookup = {tag: i for i, tag in enumerate(tags)}
+    lengths = np.fromiter(map(len, split), dtype="int64", count=len(split))
+    list_tags = np.fromiter(
+        (lookup[tag] for c in split for tag in c),
+        dtype="uint8" if len(tags) <= 256 else "uint16",
+        count=int(lengths.sum()),
+    )
+    list_offsets = np.concatenate(([0], np.cumsum(lengths))).astype("int32")
+    return tags, list_tags, list_offsets
+
+
+class ThemeIndex:
+    """
+    Inverted index of the puzzle themes: for each exact theme tag the sorted
+    list of the rows having it. Theme selections are then set operations on
+    these lists instead of string scans of the Themes column.
+
+    The lists are stored as one array of row ids, sorted by tag then row, and
+    the offsets of each tag in it.
+    """
+
+    def __init__(
+        self, tags: List[str], offsets: np.ndarray, rows: np.ndarray, size: int
+    ) -> None:
+        """
+        tags: theme tags, in the order of their lists
+        offsets: start of the list of each tag in rows (len(tags) + 1 values)
+        rows: concatenated row id lists
+        size: number of rows of the indexed column, needed for NOT queries
+        """
+        self.tags = tags
+        self.offsets = offsets
+        self.rows = rows
+        self.size = size
+        self.lookup = {tag: i for i, tag in enumerate(tags)}
+
+    @classmethod
+    def from_codes(cls, codes: np.ndarray, categories: Sequence[str]):
+        """
+        Build the index of a dictionary encoded Themes column: one code per row
+        (-1 for missing values) and the distinct space separated theme lists.
+        """
+        return cls.from_tag_lists(codes, *split_theme_lists(categories))
+
+    @classmethod
+    def from_tag_lists(
+        cls,
+        codes: np.ndarray,
+        tags: List[str],
+        list_tags: np.ndarray,
+        list_offsets: np.ndarray,
+    ):
+        """
+        Build the index of a Themes column whose distinct theme lists are
+        given as tag ids, see split_theme_lists.
+        """
+        codes = np.asarray(codes)
+        category_lengths = np.diff(list_offsets).astype("int64")
+        category_tags = np.asarray(list_tags, dtype="int32")
+        category_offsets = np.asarray(list_offsets, dtype="int64")
+
+        # Expand to one (row, tag) pair per theme of each row
+        present = np.flatnonzero(codes >= 0)
+        lengths = category_lengths[codes[present]]
+        row_ids = np.repeat(present, lengths)
+        starts = np.repeat(category_offsets[codes[present]], lengths)
+        positions = np.arange(len(row_ids)) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths
+        )
+        tag_ids = category_tags[starts + positions]
+
+        # Stable sort by tag keeps the rows of each tag sorted
+        order = np.argsort(tag_ids, kind="stable")
+        rows = row_ids[order].astype("int32")
+        counts = np.bincount(tag_ids, minlength=len(tags))
+        offsets = np.concatenate(([0], np.cumsum(counts))).astype("int64")
+
+        return cls(list(tags), offsets, rows, len(codes))
+
+    @classmethod
+    def from_themes(cls, themes: Iterable):
+        """
+        Build the index of a Themes column (space separated tags per row).
+        """
+        categorical = pd.Categorical(themes)
+        return cls.from_codes(categorical.codes, list(categorical.categories))
+
+    def __contains__(self, tag: str) -> bool:
+        return tag in self.lookup
+
+    def rows_with(self, tag: str) -> np.ndarray:
+        """
+        Sorted ids of the rows having the theme tag.
+        """
+        i = self.lookup.get(tag)
+        if i is None:
+            return np.empty(0, dtype="int32")
+        return self.rows[self.offsets[i] : self.offsets[i + 1]]
+
+    def count(self, tag: str) -> int:
+        i = self.lookup.get(tag)
+        return 0 if i is None else int(self.offsets[i + 1] - self.offsets[i])
+
+    def any(self, tags: Iterable[str]) -> np.ndarray:
+        """
+        Sorted ids of the rows having at least one of the tags.
+        """
+        lists = [self.rows_with(tag) for tag in tags]
+        if not lists:
+            return np.empty(0, dtype="int32")
+        return np.unique(np.concatenate(lists))
+
+    def all(self, tags: Iterable[str]) -> np.ndarray:
+        """
+        Sorted ids of the rows having every tag.
+        """
+        # Intersect the shortest lists first
+        lists = sorted((self.rows_with(tag) for tag in tags), key=len)
+        if not lists:
+            return np.arange(self.size, dtype="int32")
+        result = lists[0]
+        for rows in lists[1:]:
+            result = np.intersect1d(result, rows, assume_unique=True)
+        return result
+
+    def query(self, expression: str) -> np.ndarray:
+        """
+        Sorted ids of the rows matching a boolean theme expression, made of
+        theme tags, and / or / not and parentheses. For instance
+        "fork and not (mate or endgame)", see theme_query.ThemeQuery.
+        """
+        everything = np.arange(self.size, dtype="int32")
+        return ThemeQuery(expression).evaluate(
+            lambda tag: np.asarray(self.rows_with(tag)),
+            np.union1d,
+            lambda a, b: np.intersect1d(a, b, assume_unique=True),
+            lambda a: np.setdiff1d(everything, a, assume_unique=True),
+        )
+
+    def mask(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Boolean mask over all the indexed rows, true for the given row ids.
+        """
+        result = np.zeros(self.size, dtype=bool)
+        result[rows] = True
+        return result
+
+    def save(self, directory: Path, name: str) -> None:
+        """
+        Write the index as raw arrays in directory, files are written under a
+        temporary name first so concurrent readers never see partial files.
+        """
+        directory = Path(directory)
+        for suffix, values in (("offsets", self.offsets), ("rows", self.rows)):
+            tmp = directory / f"{name}.{suffix}.tmp"
+            values.tofile(tmp)
+            os.replace(tmp, directory / f"{name}.{suffix}")
+        tmp = directory / f"{name}.tags.tmp"
+        tmp.write_text("\n".join(self.tags) + "\n")
+        os.replace(tmp, directory / f"{name}.tags")
+
+    @classmethod
+    def load(cls, directory: Path, name: str, size: int):
+        """
+        Load an index written by save, the row lists are memory mapped.
+        Returns None when it is missing.
+        """
+        directory = Path(directory)
+        try:
+            tags = (directory / f"{name}.tags").read_text().split()
+            offsets = np.fromfile(directory / f"{name}.offsets", dtype="int64")
+            rows_path = directory / f"{name}.rows"
+            if os.path.getsize(rows_path):
+                rows = np.memmap(rows_path, dtype="int32", mode="r")
+            else:
+                rows = np.empty(0, dtype="int32")
+        except OSError:
+            return None
+        return cls(tags, offsets, rows, size)
+
+
+class RatingIndex:
+    """
+    Permutation of the rows sorting them by rating. A rating range [lo, hi) is
+    then resolved with two binary searches to a contiguous slice of the
+    permutation.
+    """
+
+    def __init__(self, order: np.ndarray, ratings: np.ndarray) -> None:
+        """
+        order: row ids sorted by rating
+        ratings: the sorted ratings, ratings[i] is the rating of row order[i]
+        """
+        self.order = order
+        self.ratings = ratings
+
+    @classmethod
+    def from_ratings(cls, ratings: np.ndarray):
+        ratings = np.asarray(ratings)
+        # Stable so the rows of a same rating keep their order
+        order = np.argsort(ratings, kind="stable").astype("int32")
+        return cls(order, ratings[order])
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def bounds(self, lo=None, hi=None):
+        """
+        Start and end in order of the rows with lo <= rating < hi, None for an
+        open bound.
+        """
+        start = 0 if lo is None else int(np.searchsorted(self.ratings, lo, "left"))
+        end = (
+            len(self) if hi is None else int(np.searchsorted(self.ratings, hi, "left"))
+        )
+        return start, max(start, end)
+
+    def range(self, lo=None, hi=None) -> np.ndarray:
+        """
+        Ids of the rows with lo <= rating < hi, sorted by rating.
+        """
+        start, end = self.bounds(lo, hi)
+        return self.order[start:end]
+
+    def quantile_edges(self, buckets: int) -> List[int]:
+        """
+        Edges of at most buckets rating ranges holding about the same number
+        of rows, computed in one pass over the rating histogram. The first edge
+        is the lowest rating and the last one is above the highest rating so
+        the ranges [edges[i], edges[i + 1]) cover every row.
+        """
+        ratings = np.asarray(self.ratings, dtype="float64")
+        ratings = ratings[~np.isnan(ratings)].astype("int64")
+        if not len(ratings) or buckets < 1:
+            return []
+
+        low = int(ratings.min())
+        histogram = np.bincount(ratings - low)
+        cumulative = np.cumsum(histogram)
+        targets = len(ratings) * np.arange(1, buckets) / buckets
+        # Edge = smallest rating v with at least target rows below v
+        edges = low + np.searchsorted(cumulative, targets, "left") + 1
+        edges = np.concatenate(([low], edges, [low + len(histogram)]))
+        return [int(edge) for edge in np.unique(edges)]
+
+    def save(self, directory: Path, name: str) -> None:
+        directory = Path(directory)
+        for suffix, values in (("order", self.order), ("sorted", self.ratings)):
+            tmp = directory / f"{name}.{suffix}.tmp"
+            values.tofile(tmp)
+            os.replace(tmp, directory / f"{name}.{suffix}")
+
+    @classmethod
+    def load(cls, directory: Path, name: str, dtype):
+        """
+        Load an index written by save. Returns None when it is missing.
+        """
+        directory = Path(directory)
+        try:
+            order = np.fromfile(directory / f"{name}.order", dtype="int32")
+            ratings = np.fromfile(directory / f"{name}.sorted", dtype=dtype)
+        except OSError:
+            return None
+        return cls(order, ratings)
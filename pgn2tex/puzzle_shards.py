@@ -0,0 +1,484 @@
+"""
+Puzzle database split in small csv shards by rating band, selected with the
+standard library only (csv, array, bisect, random). It is the backend of
+puzzles.py --shards and of the browser (Pyodide), where pandas is a heavy
+download and the whole csv can not be fetched.
+
+    python pgn2tex/puzzle_shards.py data/lichess_db_puzzle.csv data/shards
+
+writes data/shards/manifest.json and one csv per band of --band rating points
+(data/shards/1000.csv holds the puzzles rated 1000 to 1099...). A selection
+only reads the shards its rating range overlaps, from a directory or an url.
+"""
+
+import argparse
+import bz2
+import csv
+import io
+import json
+import math
+import random
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from pathlib import Path
+from typing import Dict, IO, Iterator, List, Optional
+
+import profiling
+from theme_query import ThemeQuery
+
+# Bump when the format of the shards changes
+SHARDS_VERSION = 1
+
+MANIFEST = "manifest.json"
+
+# Lichess columns kept in the shards, the ones the books use
+COLUMNS = ["PuzzleId", "FEN", "Moves", "Rating", "Themes"]
+
+
+def read_puzzle_rows(path: Path) -> Iterator[Dict[str, str]]:
+    """
+    Rows of the lichess csv, or of the .bz2 lichess ships, as dicts.
+    """
+    path = Path(path)
+    opener = bz2.open if path.suffix == ".bz2" else open
+    with opener(path, "rt", encoding="utf-8", newline="") as fd:
+        yield from csv.DictReader(fd)
+
+
+def write_shards(source: Path, directory: Path, band=100, chunk_rows=100_000) -> Dict:
+    """
+    Split the puzzles of the csv source in one shard per band of ratings,
+    sorted by rating, and write the manifest describing them. Returns the
+    manifest.
+
+    Rows are appended to a temporary file per band every chunk_rows rows,
+    then each shard is sorted on its own, so at most a chunk and a shard are
+    held in memory rather than the whole database.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    counts: Counter = Counter()
+    bands: Dict[int, List] = {}
+
+    def spill():
+        for lo, rows in bands.items():
+            with open(
+                directory / f"{lo}.csv.tmp", "a", encoding="utf-8", newline=""
+            ) as fd:
+                csv.writer(fd).writerows(rows)
+            counts[lo] += len(rows)
+        bands.clear()
+
+    # Leftovers of an interrupted run would be appended to
+    for tmp in directory.glob("*.csv.tmp"):
+        tmp.unlink()
+
+    pending = 0
+    for row in read_puzzle_rows(source):
+        try:
+            rating = int(row["Rating"])
+        except (TypeError, ValueError):
+            continue
+        bands.setdefault(rating // band * band, []).append(
+            [row.get(name) or "" for name in COLUMNS]
+        )
+        pending += 1
+        if pending >= chunk_rows:
+            spill()
+            pending = 0
+    spill()
+
+    rating = COLUMNS.index("Rating")
+    tags = COLUMNS.index("Themes")
+    shards = []
+    themes: Counter = Counter()
+    for lo in sorted(counts):
+        tmp = directory / f"{lo}.csv.tmp"
+        with open(tmp, encoding="utf-8", newline="") as fd:
+            rows = list(csv.reader(fd))
+        # Stable, the puzzles of a same rating keep the order of the database
+        rows.sort(key=lambda row: int(row[rating]))
+        name = f"{lo}.csv"
+        with open(directory / name, "w", encoding="utf-8", newline="") as fd:
+            writer = csv.writer(fd)
+            writer.writerow(COLUMNS)
+            writer.writerows(rows)
+        tmp.unlink()
+        for row in rows:
+            themes.update(row[tags].split())
+        shards.append({"file": name, "lo": lo, "hi": lo + band, "count": len(rows)})
+
+    manifest = {
+        "version": SHARDS_VERSION,
+        "band": band,
+        "columns": COLUMNS,
+        "shards": shards,
+        "themes": dict(sorted(themes.items())),
+    }
+    with open(directory / MANIFEST, "w") as fd:
+        json.dump(manifest, fd, indent=1)
+    return manifest
+
+
+def _is_url(location: str) -> bool:
+    return location.startswith(("http://", "https://"))
+
+
+def open_location(location: str, name: str) -> IO[str]:
+    """
+    Text file name of location, a directory or an url. Urls are fetched with
+    pyodide.http.open_url in the browser and urllib elsewhere.
+    """
+    if not _is_url(location):
+        return open(Path(location) / name, encoding="utf-8", newline="")
+
+    url = location.rstrip("/") + "/" + name
+    try:
+        from pyodide.http import open_url
+    except ImportError:
+        from urllib.request import urlopen
+
+        with urlopen(url) as response:
+            return io.StringIO(response.read().decode("utf-8"), newline=None)
+    return open_url(url)
+
+
+class _Shard:
+    """
+    Columns of a loaded shard, rows sorted by rating.
+    """
+
+    __slots__ = ("ratings", "ids", "fens", "moves", "themes")
+
+    def __init__(self, fd: IO[str]) -> None:
+        reader = csv.reader(fd)
+        header = next(reader)
+        index = [header.index(name) for name in COLUMNS]
+        columns: List[List[str]] = [[] for _ in COLUMNS]
+        for row in reader:
+            for column, i in zip(columns, index):
+                column.append(row[i])
+        self.ids, self.fens, self.moves, ratings, self.themes = columns
+        self.ratings = array("H", map(int, ratings))
+
+
+class PuzzleSelection:
+    """
+    Selected puzzles, as columns sorted by rating. Rows are identified by
+    their position 0 <= row < len(selection).
+    """
+
+    def __init__(self) -> None:
+        self.ratings = array("H")
+        self.ids: List[str] = []
+        self.fens: List[str] = []
+        self.moves: List[str] = []
+        self.themes: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.ratings)
+
+    def append(self, shard: _Shard, rows) -> None:
+        for row in rows:
+            self.ratings.append(shard.ratings[row])
+            self.ids.append(shard.ids[row])
+            self.fens.append(shard.fens[row])
+            self.moves.append(shard.moves[row])
+            self.themes.append(shard.themes[row])
+
+    def range(self, lo=None, hi=None) -> range:
+        """
+        Rows with lo <= rating < hi, None for an open bound.
+        """
+        start = 0 if lo is None else bisect_left(self.ratings, lo)
+        end = len(self) if hi is None else bisect_left(self.ratings, hi)
+        return range(start, max(start, end))
+
+    def quantile_edges(self, buckets: int) -> List[int]:
+        """
+        Edges of at most buckets rating ranges holding about the same number
+        of rows, like RatingIndex.quantile_edges.
+        """
+        if not len(self) or buckets < 1:
+            return []
+        edges = [self.ratings[0]]
+        for i in range(1, buckets):
+            # Smallest rating v with at least len * i / buckets rows below v
+            target = math.ceil(len(self) * i / buckets)
+            edges.append(self.ratings[target - 1] + 1)
+        edges.append(self.ratings[-1] + 1)
+        return sorted(set(edges))
+
+    def records(self, rows) -> List:
+        """
+        Deferred PuzzleRecord of the given rows, in that order.
+        """
+        from records import PuzzleRecord
+
+        return [
+            PuzzleRecord.deferred(
+                self.ids[row], self.fens[row], self.moves[row], self.themes[row]
+            )
+            for row in rows
+        ]
+
+
+class ShardStore:
+    """
+    Sharded puzzle database written by write_shards, in a directory or at an
+    url. Shards are read on first use and kept, so the selections of a session
+    only fetch each shard once.
+    """
+
+    def __init__(self, location, opener=open_location) -> None:
+        """
+        location: directory or url of the shards
+        opener: opener(location, name) -> text file of the shard name
+        """
+        self.location = str(location)
+        self.opener = opener
+        with opener(self.location, MANIFEST) as fd:
+            self.manifest = json.load(fd)
+        if self.manifest.get("version") != SHARDS_VERSION:
+            raise ValueError(
+                f"{self.location} holds shards of version "
+                f"{self.manifest.get('version')}, rebuild them with puzzle_shards.py"
+            )
+        self.shards: Dict[int, _Shard] = {}
+
+    def __len__(self) -> int:
+        return sum(shard["count"] for shard in self.manifest["shards"])
+
+    @property
+    def themes(self) -> Dict[str, int]:
+        """
+        Theme tag -> number of puzzles having it.
+        """
+        return self.manifest["themes"]
+
+    def shard(self, lo: int) -> _Shard:
+        if lo not in self.shards:
+            info = next(s for s in self.manifest["shards"] if s["lo"] == lo)
+            with self.opener(self.location, info["file"]) as fd:
+                self.shards[lo] = _Shard(fd)
+        return self.shards[lo]
+
+    def select(
+        self,
+        min_rating: Optional[int] = None,
+        max_rating: Optional[int] = None,
+        themes: Optional[List[str]] = None,
+        theme_query: Optional[str] = None,
+    ) -> PuzzleSelection:
+        """
+        Puzzles with min_rating <= Rating < max_rating having at least one of
+        the given themes and matching the theme query (None disables a
+        filter), like open_puzzles. Only the shards overlapping the rating
+        range are read.
+        """
+        wanted = set(themes) if themes is not None else None
+        query = ThemeQuery(theme_query) if theme_query else None
+
+        selection = PuzzleSelection()
+        for info in self.manifest["shards"]:
+            if min_rating is not None and info["hi"] <= min_rating:
+                continue
+            if max_rating is not None and info["lo"] >= max_rating:
+                continue
+            shard = self.shard(info["lo"])
+            start = 0 if min_rating is None else bisect_left(shard.ratings, min_rating)
+            end = (
+                len(shard.ratings)
+                if max_rating is None
+                else bisect_left(shard.ratings, max_rating)
+            )
+            rows = range(start, end)
+            if wanted is not None or query is not None:
+                rows = [
+                    row
+                    for row in rows
+                    if _matches(shard.themes[row].split(), wanted, query)
+                ]
+            selection.append(shard, rows)
+        return selection
+
+
+def _matches(tags: List[str], wanted, query) -> bool:
+    if wanted is not None and wanted.isdisjoint(tags):
+        return False
+    return query is None or query.matches(set(tags))
+
+
+def stratified_order(
+    size: int,
+    buckets: List[range],
+    cells: Optional[List[set]],
+    themes: List[str],
+    bucket_limit: Optional[int] = None,
+    seed: Optional[int] = None,
+) -> List[List[List[int]]]:
+    """
+    sampling.stratified_order with random instead of numpy. Shard books are
+    not seed-compatible with puzzles.make_book: a seed draws other puzzles,
+    the same ones for the same shards and seed. Each row gets one random key
+    and the rows of each (bucket, cell) are sorted by it.
+
+    size: number of candidate rows
+    buckets: rows of each bucket
+    cells: tags of each cell, a row is in a cell when it has one of them.
+        None for a single cell holding every row
+    themes: themes of each row, the space separated lichess field
+    """
+    rng = random.Random(seed)
+    keys = [rng.random() for _ in range(size)]
+
+    ordered = []
+    for rows in buckets:
+        order = sorted(rows, key=keys.__getitem__)
+        if bucket_limit is not None and bucket_limit > 0:
+            order = order[:bucket_limit]
+
+        if cells is None:
+            ordered.append([order])
+            continue
+        drawn = [[] for _ in cells]
+        for row in order:
+            tags = themes[row].split()
+            for cell, cell_tags in zip(drawn, cells):
+                if not cell_tags.isdisjoint(tags):
+                    cell.append(row)
+        ordered.append(drawn)
+    return ordered
+
+
+def sample_size(available: int, cell_limit: Optional[int] = None, multiple=1) -> int:
+    """
+    sampling.sample_size, without numpy.
+    """
+    count = available
+    if cell_limit is not None and cell_limit > 0:
+        count = min(count, cell_limit)
+    return count - count % multiple
+
+
+def stratified_sample(
+    size: int,
+    buckets: List[range],
+    cells: Optional[List[set]],
+    themes: List[str],
+    bucket_limit: Optional[int] = None,
+    cell_limit: Optional[int] = None,
+    multiple: int = 1,
+    seed: Optional[int] = None,
+) -> List[List[List[int]]]:
+    """
+    sampling.stratified_sample with random instead of numpy: the first rows
+    of each (bucket, cell) of stratified_order.
+    """
+    ordered = stratified_order(size, buckets, cells, themes, bucket_limit, seed)
+    return [
+        [rows[: sample_size(len(rows), cell_limit, multiple)] for rows in bucket]
+        for bucket in ordered
+    ]
+
+
+def make_book(
+    puzzles: PuzzleSelection,
+    themes: Dict,
+    min_rating=1000,
+    max_rating=2500,
+    step_size=500,
+    quantiles: Optional[int] = None,
+    problems=0,
+    page_number=500,
+    is_categorized=True,
+    tags: Optional[List[str]] = None,
+    seed: Optional[int] = None,
+    unique_positions=False,
+) -> List:
+    """
+    puzzles.make_book for a selection of a ShardStore, without pandas or
+    numpy. Books have the same structure, the puzzles drawn for a seed differ.
+    """
+    from positions import PositionRegistry, unique_records
+    from puzzles import book_layout
+    from records import memoize_rows
+
+    if quantiles:
+        edges = puzzles.quantile_edges(quantiles)
+    else:
+        edges = list(range(min_rating, max_rating, step_size))
+        edges.append(max_rating)
+
+    buckets = [puzzles.range(lo, hi) for lo, hi in zip(edges[:-1], edges[1:])]
+
+    if is_categorized:
+        categories = [
+            (tag, theme) for tag, theme in themes.items() if tags is None or tag in tags
+        ]
+        cells = [{tag} for tag, _ in categories]
+    else:
+        categories = None
+        cells = None if tags is None else [set(tags)]
+
+    profile = profiling.current()
+    with profile.stage("sampling", len(puzzles)):
+        if unique_positions:
+            # Repeated positions are replaced by the next rows, see
+            # puzzles.make_book
+            samples = stratified_order(
+                len(puzzles),
+                buckets,
+                cells,
+                puzzles.themes,
+                bucket_limit=page_number,
+                seed=seed,
+            )
+        else:
+            samples = stratified_sample(
+                len(puzzles),
+                buckets,
+                cells,
+                puzzles.themes,
+                bucket_limit=page_number,
+                cell_limit=problems,
+                multiple=3,
+                seed=seed,
+            )
+
+    positions = PositionRegistry() if unique_positions else None
+    puzzle_list = memoize_rows(puzzles.records)
+
+    def records(rows):
+        with profile.stage("records", len(rows)):
+            if positions is None:
+                return puzzle_list(rows)
+            count = sample_size(len(rows), problems, multiple=3)
+            return unique_records(rows, count, puzzle_list, positions, multiple=3)
+
+    return book_layout(edges, samples, categories, records)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Split the lichess puzzle database in shards by rating band, for puzzles.py --shards and the browser."
+    )
+    parser.add_argument(
+        "database",
+        type=Path,
+        help="Lichess puzzle database, csv or compressed csv (.bz2).",
+    )
+    parser.add_argument("output", type=Path, help="Directory of the shards.")
+    parser.add_argument(
+        "--band",
+        type=int,
+        default=100,
+        help="Rating points covered by each shard.",
+    )
+    args = parser.parse_args()
+
+    manifest = write_shards(args.database, args.output, band=args.band)
+    total = sum(shard["count"] for shard in manifest["shards"])
+    print(f"{total} puzzles in {len(manifest['shards'])} shards in {args.output}")
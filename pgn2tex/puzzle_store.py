@@ -0,0 +1,366 @@
+import sys
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+from puzzle_index import ThemeIndex, split_theme_lists
+from records import DERIVED_COLUMNS, PuzzleRecord
+
+# Squares in python-chess order, square = 8 * rank + file
+SQUARES = [f"{file}{rank}" for rank in "12345678" for file in "abcdefgh"]
+
+# Promotion piece of a packed move, index = python-chess piece type
+PROMOTIONS = ["", "p", "n", "b", "r", "q", "k"]
+_PROMOTION_CODES = np.zeros(256, dtype="uint16")
+for _piece, _letter in enumerate(PROMOTIONS[1:], start=1):
+    _PROMOTION_CODES[ord(_letter)] = _piece
+
+# Null moves ("0000") are packed as a1a1, which no other move can be
+NULL_MOVE = 0
+
+# Rows gathered at once when copying strings, bounds the temporary index
+_GATHER_ROWS = 1 << 16
+
+_SPACE = ord(" ")
+
+
+def narrow_offsets(offsets: np.ndarray) -> np.ndarray:
+    """
+    Offsets as int32 when they fit (buffers under 2 GiB), int64 otherwise.
+    """
+    if len(offsets) == 0 or offsets[-1] < 2**31:
+        return offsets.astype("int32")
+    return offsets.astype("int64")
+
+
+class Strings:
+    """
+    Column of strings stored as one utf-8 buffer and the offsets of each value
+    in it, instead of one python object per value.
+    """
+
+    __slots__ = ("data", "offsets")
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray) -> None:
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_list(cls, values: Iterable[str]):
+        encoded = [value.encode("utf-8") for value in values]
+        lengths = np.fromiter(map(len, encoded), dtype="int64", count=len(encoded))
+        offsets = narrow_offsets(np.concatenate(([0], np.cumsum(lengths))))
+        return cls(np.frombuffer(b"".join(encoded), dtype="uint8").copy(), offsets)
+
+    @classmethod
+    def gather(cls, data: np.ndarray, offsets: np.ndarray, rows=None):
+        """
+        Copy of the given rows (all when None) of the buffer data with offsets,
+        e.g. a memory mapped column of the puzzle cache.
+        """
+        if rows is None:
+            buffer = np.array(data[offsets[0] : offsets[-1]])
+            return cls(buffer, narrow_offsets(offsets - offsets[0]))
+
+        rows = np.asarray(rows, dtype="int64")
+        starts = offsets[rows]
+        lengths = offsets[rows + 1] - starts
+        new_offsets = np.concatenate(([0], np.cumsum(lengths))).astype("int64")
+        buffer = np.empty(int(new_offsets[-1]), dtype="uint8")
+        for first in range(0, len(rows), _GATHER_ROWS):
+            last = min(first + _GATHER_ROWS, len(rows))
+            begin, end = new_offsets[first], new_offsets[last]
+            index = np.repeat(
+                starts[first:last] - new_offsets[first:last], lengths[first:last]
+            )
+            buffer[begin:end] = data[index + np.arange(begin, end)]
+        return cls(buffer, narrow_offsets(new_offsets))
+
+    @classmethod
+    def concat(cls, columns: Sequence["Strings"]):
+        data = np.concatenate([c.data for c in columns] + [np.empty(0, "uint8")])
+        ends = [0]
+        for column in columns:
+            ends.append(ends[-1] + len(column.data))
+        offsets = np.concatenate(
+            [[0]]
+            + [c.offsets[1:].astype("int64") + end for c, end in zip(columns, ends)]
+        )
+        return cls(data, narrow_offsets(offsets))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row: int) -> str:
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return self.data[start:end].tobytes().decode("utf-8")
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes + self.offsets.nbytes
+
+
+def pack_moves(moves: Strings):
+    """
+    Pack the space separated uci moves of each row as one uint16 per move:
+    from square, to square << 6 and promotion piece type << 12. Returns the
+    packed moves of every row, one after the other, and the offset of the
+    moves of each row.
+    """
+    data = moves.data
+    row_starts = np.zeros(len(data) + 1, dtype=bool)
+    row_starts[moves.offsets[:-1]] = True
+    row_ends = np.zeros(len(data) + 1, dtype=bool)
+    row_ends[moves.offsets[1:]] = True
+
+    letter = data != _SPACE
+    before = np.concatenate(([True], ~letter)) | row_starts
+    after = np.concatenate((~letter, [True])) | row_ends
+    starts = np.flatnonzero(letter & before[:-1])
+    ends = np.flatnonzero(letter & after[1:]) + 1
+    lengths = ends - starts
+
+    if len(starts) and not np.isin(lengths, (4, 5)).all():
+        bad = starts[~np.isin(lengths, (4, 5))][0]
+        raise ValueError(f"Not an uci move at byte {bad} of the moves")
+
+    def square(offset):
+        file = data[starts + offset].astype("int16") - ord("a")
+        rank = data[starts + offset + 1].astype("int16") - ord("1")
+        return (rank * 8 + file).astype("uint16")
+
+    null = data[starts] == ord("0")
+    from_squares = np.where(null, 0, square(0))
+    to_squares = np.where(null, 0, square(2))
+    if len(starts) and (from_squares.max() > 63 or to_squares.max() > 63):
+        raise ValueError("Not an uci move in the moves")
+
+    promotions = np.zeros(len(starts), dtype="uint16")
+    promoted = lengths == 5
+    promotions[promoted] = _PROMOTION_CODES[data[starts[promoted] + 4]]
+
+    packed = from_squares | (to_squares << 6) | (promotions << 12)
+    offsets = narrow_offsets(np.searchsorted(starts, moves.offsets))
+    return packed.astype("uint16"), offsets
+
+
+def unpack_move(code: int) -> str:
+    if code == NULL_MOVE:
+        return "0000"
+    return SQUARES[code & 63] + SQUARES[(code >> 6) & 63] + PROMOTIONS[code >> 12]
+
+
+class PuzzleStore:
+    """
+    Compact in-memory puzzle table, an alternative to the DataFrame of
+    open_puzzles holding one python string per value:
+
+    - ids and fens in contiguous utf-8 buffers (Strings)
+    - moves packed as uint16 from / to / promotion codes
+    - themes dictionary encoded: one int32 code per row pointing to the
+      distinct theme lists, each stored as the ids of its tags in a flat
+      uint8 array rather than a python string, selections go through
+      theme_index()
+    - numeric columns as typed arrays
+
+    The derived fields of a precomputed cache are kept the same way. Rows are
+    only turned into PuzzleRecord when records() is called, for the puzzles
+    drawn in a book. GameUrl and OpeningTags are not kept, books do not use
+    them.
+    """
+
+    def __init__(
+        self,
+        ids: Strings,
+        fens: Strings,
+        moves: np.ndarray,
+        move_offsets: np.ndarray,
+        theme_codes: np.ndarray,
+        theme_lists: Sequence[str],
+        numeric: Dict[str, np.ndarray],
+        derived: Optional[Dict] = None,
+    ) -> None:
+        """
+        moves, move_offsets: see pack_moves
+        theme_codes: index in theme_lists of the themes of each row, -1 for
+            a row without themes
+        theme_lists: distinct Themes values, space separated tags, kept as
+            tag ids (see puzzle_index.split_theme_lists)
+        numeric: typed array of each numeric column, Rating at least
+        derived: Strings or array of each DERIVED_COLUMNS column, None when
+            they were not precomputed
+        """
+        self.ids = ids
+        self.fens = fens
+        self.moves = moves
+        self.move_offsets = move_offsets
+        self.theme_codes = theme_codes
+        self.tags, self.list_tags, self.list_offsets = split_theme_lists(theme_lists)
+        self.numeric = numeric
+        self.derived = derived
+
+    @classmethod
+    def from_cache(cls, cache, rows=None):
+        """
+        Store of the given rows (all when None) of a PuzzleCache.
+        """
+
+        def strings(name):
+            return Strings.gather(*cache.buffers(name), rows)
+
+        def values(array):
+            return np.array(array if rows is None else array[rows])
+
+        moves, move_offsets = pack_moves(strings("Moves"))
+        numeric = {name: values(cache.numeric(name)) for name in cache.meta["numeric"]}
+
+        derived = None
+        if cache.has_derived():
+            derived = {
+                name: strings(name) if kind == "string" else values(cache.numeric(name))
+                for name, kind in DERIVED_COLUMNS.items()
+            }
+
+        return cls(
+            strings("PuzzleId"),
+            strings("FEN"),
+            moves,
+            move_offsets,
+            values(cache.codes("Themes")),
+            cache.categories("Themes"),
+            numeric,
+            derived,
+        )
+
+    @classmethod
+    def from_frame(cls, frame, numeric_types: Dict[str, str]):
+        """
+        Store of the puzzles of a DataFrame with the lichess columns, numeric
+        columns are stored with numeric_types.
+        """
+        import pandas as pd
+
+        themes = pd.Categorical(frame["Themes"])
+        moves, move_offsets = pack_moves(
+            Strings.from_list(frame["Moves"].fillna("").astype(str))
+        )
+        return cls(
+            Strings.from_list(frame["PuzzleId"].astype(str)),
+            Strings.from_list(frame["FEN"].astype(str)),
+            moves,
+            move_offsets,
+            np.asarray(themes.codes, dtype="int32"),
+            [str(c) for c in themes.categories],
+            {
+                name: frame[name].fillna(0).astype(kind).to_numpy()
+                for name, kind in numeric_types.items()
+                if name in frame
+            },
+        )
+
+    @classmethod
+    def concat(cls, stores: Sequence["PuzzleStore"]):
+        """
+        Store of the rows of stores one after the other, e.g. the chunks of
+        the csv. Stores with derived columns can not be concatenated.
+        """
+        lists: Dict[str, int] = {}
+        codes = []
+        for store in stores:
+            remap = np.array(
+                [
+                    lists.setdefault(store.theme_list(code), len(lists))
+                    for code in range(len(store.list_offsets) - 1)
+                ]
+                + [-1],
+                dtype="int32",
+            )
+            codes.append(remap[store.theme_codes])
+
+        moves = [store.moves for store in stores]
+        move_offsets = [np.zeros(1, dtype="int64")]
+        for store in stores:
+            last = move_offsets[-1][-1]
+            move_offsets.append(store.move_offsets[1:].astype("int64") + last)
+
+        names = stores[0].numeric if stores else {}
+        return cls(
+            Strings.concat([store.ids for store in stores]),
+            Strings.concat([store.fens for store in stores]),
+            np.concatenate(moves + [np.empty(0, "uint16")]),
+            narrow_offsets(np.concatenate(move_offsets)),
+            np.concatenate(codes + [np.empty(0, "int32")]),
+            list(lists),
+            {
+                name: np.concatenate([store.numeric[name] for store in stores])
+                for name in names
+            },
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory held by the store: its arrays and the python strings of the
+        theme tags.
+        """
+        arrays = [self.moves, self.move_offsets, self.theme_codes]
+        arrays += [self.list_tags, self.list_offsets]
+        arrays += list(self.numeric.values())
+        total = self.ids.nbytes + self.fens.nbytes + sum(a.nbytes for a in arrays)
+        for column in (self.derived or {}).values():
+            total += column.nbytes
+        total += sys.getsizeof(self.tags)
+        return total + sum(sys.getsizeof(tag) for tag in self.tags)
+
+    @property
+    def ratings(self) -> np.ndarray:
+        return self.numeric["Rating"]
+
+    def theme_index(self) -> ThemeIndex:
+        return ThemeIndex.from_tag_lists(
+            self.theme_codes, self.tags, self.list_tags, self.list_offsets
+        )
+
+    def theme_list(self, code: int) -> str:
+        """
+        Distinct theme list code, as in the Themes column.
+        """
+        start, end = self.list_offsets[code], self.list_offsets[code + 1]
+        return " ".join(self.tags[tag] for tag in self.list_tags[start:end])
+
+    def themes(self, row: int) -> str:
+        code = self.theme_codes[row]
+        return self.theme_list(code) if code >= 0 else ""
+
+    def uci(self, row: int) -> str:
+        """
+        The Moves field of row, uci moves separated by spaces.
+        """
+        start, end = self.move_offsets[row], self.move_offsets[row + 1]
+        return " ".join(unpack_move(int(code)) for code in self.moves[start:end])
+
+    def record(self, row: int) -> PuzzleRecord:
+        row = int(row)
+        fen, moves, themes = self.fens[row], self.uci(row), self.themes(row)
+        if self.derived is None:
+            return PuzzleRecord.deferred(self.ids[row], fen, moves, themes)
+        d = self.derived
+        derived = (
+            d["StartFEN"][row],
+            d["DisplayFEN"][row],
+            bool(d["Turn"][row]),
+            int(d["NbMoves"][row]),
+            d["Solution"][row],
+            d["ShownThemes"][row],
+        )
+        return PuzzleRecord(self.ids[row], fen, moves, themes, *derived)
+
+    def records(self, rows) -> List[PuzzleRecord]:
+        """
+        Records of the given rows, in that order, built on demand. Without
+        precomputed fields they are deferred, see PuzzleRecord.deferred.
+        """
+        return [self.record(row) for row in rows]
@@ -1,24 +1,22 @@
-import pandas as pd
-from pathlib import Path
-import xml.etree.ElementTree as ET
-from typing import Dict, Tuple, Optional, List
-from string import Template
+import json
 import os
-import math
-
-import chess.pgn
-import chess
-import chess.svg
+from pathlib import Path
+from typing import Dict, Optional, List
+from functools import lru_cache
 
-from tqdm import tqdm
 from argparse import ArgumentParser, HelpFormatter
 
-from dataclasses import dataclass
-
-from utils import load_pgn, get_section_from_level
-from board_helpers import mk_book_from_list, mk_book_from_list_table_layout
+from dataclasses import asdict, dataclass
 from datetime import datetime
 
+import profiling
+
+# pandas, python-chess and the modules using them are imported where they are
+# needed, so --help and argument errors answer right away
+
+# Bump when the format of the precompiled themes changes
+THEMES_VERSION = 1
+
 
 @dataclass
 class PuzzleTheme:
@@ -27,22 +25,83 @@ class PuzzleTheme:
     desc: str
 
 
-def open_puzzles(path: Path):
-    puzzles = pd.read_csv(
-        path,
-        encoding='utf-8',
-        dtype={
-            "Rating": "float64",
-            "RatingDeviation": "float64",
-            "Popularity": "float64",
-            "NbPlays": "float64",
-        },
-        na_values = ["", "NA", "null"],  # Handle common non-numeric values as NaN
+def open_puzzles(
+    path: Path,
+    min_rating: Optional[int] = None,
+    max_rating: Optional[int] = None,
+    themes: Optional[List[str]] = None,
+    theme_query: Optional[str] = None,
+    cache=True,
+    chunksize=200_000,
+    precompute=False,
+    jobs=1,
+    compact=False,
+):
+    """
+    Load the puzzles with min_rating <= Rating < max_rating having at least
+    one of the given themes and matching the theme query, a boolean expression
+    such as "fork and not mate" (None disables a filter).
+
+    By default it goes through the columnar cache stored next to the csv, built
+    on first use and rebuilt when the csv changes, and only the matching rows
+    are decoded. Without cache the csv (or the .bz2 lichess ships) is streamed
+    by chunks and only the matching rows of each chunk are kept, so memory
+    depends on the size of the selection and not on the database.
+
+    With precompute the derived fields used by the renderers (see
+    records.PuzzleRecord) are computed once for the whole database, with jobs
+    processes, and stored in the cache.
+
+    With compact the puzzles are returned as a puzzle_store.PuzzleStore
+    instead of a DataFrame: packed moves, string buffers and typed arrays,
+    several times smaller, which make_book accepts as well.
+    """
+    import pandas as pd
+
+    from puzzle_cache import (
+        NUMERIC_COLUMNS,
+        PuzzleCache,
+        read_puzzle_chunks,
+        puzzle_mask,
     )
-    return puzzles
+    from puzzle_store import PuzzleStore
+
+    profile = profiling.current()
+
+    if cache:
+        store = PuzzleCache.open(path)
+        if precompute:
+            with profile.stage("precompute", len(store)):
+                store.precompute(jobs=jobs)
+        with profile.stage("filter", len(store)):
+            rows = store.select(min_rating, max_rating, themes, theme_query)
+        if compact:
+            with profile.stage("to_store", len(rows)):
+                return PuzzleStore.from_cache(store, rows)
+        with profile.stage("to_frame", len(rows)):
+            return store.to_frame(rows)
+
+    selected = []
+    chunks = profile.iterate("read csv", read_puzzle_chunks(path, chunksize))
+    for chunk in chunks:
+        with profile.stage("filter", len(chunk)):
+            mask = puzzle_mask(chunk, min_rating, max_rating, themes, theme_query)
+            selected.append(chunk[mask])
+        if compact:
+            # Only the packed rows of each chunk are kept
+            with profile.stage("to_store", len(selected[-1])):
+                selected[-1] = PuzzleStore.from_frame(selected[-1], NUMERIC_COLUMNS)
+
+    if compact:
+        return PuzzleStore.concat(selected)
+    if not selected:
+        return pd.DataFrame()
+    return pd.concat(selected, ignore_index=True)
 
 
 def open_themes_desc(path: Path) -> Dict[str, PuzzleTheme]:
+    import xml.etree.ElementTree as ET
+
     tree = ET.parse(path)
 
     themes = {}
@@ -57,7 +116,182 @@ def open_themes_desc(path: Path) -> Dict[str, PuzzleTheme]:
     return themes
 
 
-themes = open_themes_desc(Path("data/puzzleTheme.xml"))
+def make_book(
+    puzzles,
+    themes: Dict[str, PuzzleTheme],
+    min_rating=1000,
+    max_rating=2500,
+    step_size=500,
+    quantiles: Optional[int] = None,
+    problems=0,
+    page_number=500,
+    is_categorized=True,
+    tags: Optional[List[str]] = None,
+    seed: Optional[int] = None,
+    unique_positions=False,
+) -> List:
+    """
+    Structure of the book of the selected puzzles (a DataFrame or a
+    PuzzleStore, see open_puzzles), as given to board_helpers: one chapter per
+    rating range, split in one section per theme when is_categorized. tags are
+    the themes to keep (--theme), the other arguments are the ones of the
+    command line.
+    """
+    from positions import PositionRegistry, unique_records
+    from puzzle_index import RatingIndex, ThemeIndex
+    from puzzle_store import PuzzleStore
+    from records import memoize_rows, puzzle_records
+    from sampling import sample_size, stratified_order, stratified_sample
+
+    profile = profiling.current()
+    compact = isinstance(puzzles, PuzzleStore)
+
+    with profile.stage("index", len(puzzles)):
+        # Exact theme tag -> rows of puzzles, built once for all the buckets
+        if compact:
+            theme_index = puzzles.theme_index()
+            ratings = puzzles.ratings
+        else:
+            theme_index = ThemeIndex.from_themes(puzzles["Themes"])
+            ratings = puzzles["Rating"].to_numpy()
+        # Puzzles sorted by rating, each bucket is a slice of it
+        rating_index = RatingIndex.from_ratings(ratings)
+
+    if quantiles:
+        edges = rating_index.quantile_edges(quantiles)
+    else:
+        edges = list(range(min_rating, max_rating, step_size))
+        edges.append(max_rating)
+
+    buckets = [rating_index.range(lo, hi) for lo, hi in zip(edges[:-1], edges[1:])]
+
+    if is_categorized:
+        categories = [
+            (tag, theme)
+            for tag, theme in themes.items()
+            if tags is None or tag in tags
+        ]
+        cells = [theme_index.rows_with(tag) for tag, _ in categories]
+    else:
+        categories = None
+        cells = None if tags is None else [theme_index.any(tags)]
+
+    # Draw every (bucket, theme) sample at once. At most page_number puzzles
+    # of each bucket are considered and puzzles are displayed in 3 columns so
+    # the number of puzzles of each sample is a multiple of 3. With
+    # unique_positions every row of each (bucket, theme) is kept in the
+    # random order, the rows of repeated positions are replaced by the next
+    # ones when the records are built
+    with profile.stage("sampling", len(puzzles)):
+        if unique_positions:
+            samples = stratified_order(
+                len(puzzles), buckets, cells, bucket_limit=page_number, seed=seed
+            )
+        else:
+            samples = stratified_sample(
+                len(puzzles),
+                buckets,
+                cells,
+                bucket_limit=page_number,
+                cell_limit=problems,
+                multiple=3,
+                seed=seed,
+            )
+
+    # Positions of the puzzles already in the book, in the order of the book
+    positions = PositionRegistry() if unique_positions else None
+
+    # Records are deferred: the board work is done by the processes rendering
+    # the puzzles, and skipped for the fragments found in the fragment cache.
+    # A puzzle drawn in several sections is built once
+    @memoize_rows
+    def puzzle_list(rows):
+        if compact:
+            return puzzles.records(rows)
+        return puzzle_records(puzzles.iloc[rows])
+
+    def records(rows):
+        with profile.stage("records", len(rows)):
+            if positions is None:
+                return puzzle_list(rows)
+            count = sample_size(len(rows), problems, multiple=3)
+            return unique_records(rows, count, puzzle_list, positions, multiple=3)
+
+    return book_layout(edges, samples, categories, records)
+
+
+def book_layout(edges: List[int], samples: List, categories, records) -> List:
+    """
+    Chapters of the book, one per rating range [edges[i], edges[i + 1]) with
+    samples[i] the rows drawn for it: one section per (tag, theme) of
+    categories, or a single list of puzzles when categories is None.
+    records(rows) gives the puzzles of rows.
+    """
+    profile = profiling.current()
+    L = []
+
+    for (lo, hi), bucket_samples in zip(zip(edges[:-1], edges[1:]), samples):
+        title = f"{lo}-{hi} rated problems."
+        bucket = f"bucket {lo}-{hi}"
+        if categories is not None:
+            diff_L = []
+            for (tag, theme), rows in zip(categories, bucket_samples):
+                pt = records(rows) if len(rows) else []
+                if len(pt):
+                    diff_L.append((theme.name, "puzzles", pt, theme.desc))
+                    profile.count(bucket, "puzzles", len(pt))
+                    profile.count(bucket, "sections")
+
+            L.append((title, "list", diff_L, ""))
+        else:
+            rows = bucket_samples[0]
+            p = records(rows) if len(rows) else []
+            if len(p):
+                L.append((title, "puzzles", p, ""))
+                profile.count(bucket, "puzzles", len(p))
+
+    return L
+
+
+def themes_cache_path(path: Path) -> Path:
+    path = Path(path)
+    return path.with_name(path.name + ".json")
+
+
+@lru_cache(maxsize=None)
+def load_themes(path: Path) -> Dict[str, PuzzleTheme]:
+    """
+    Themes described in the lichess puzzleTheme.xml file found at path. They
+    are parsed once and stored as json next to the xml file, later calls read
+    the json back as long as the xml file does not change.
+    """
+    path = Path(path)
+    stat = os.stat(path)
+    source = [THEMES_VERSION, stat.st_size, stat.st_mtime_ns]
+    cache = themes_cache_path(path)
+
+    try:
+        with open(cache) as fd:
+            stored = json.load(fd)
+        if stored["source"] == source:
+            return {
+                theme["id"]: PuzzleTheme(**theme) for theme in stored["themes"]
+            }
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    themes = open_themes_desc(path)
+    try:
+        tmp = cache.with_name(cache.name + ".tmp")
+        with open(tmp, "w") as fd:
+            json.dump(
+                {"source": source, "themes": [asdict(t) for t in themes.values()]}, fd
+            )
+        os.replace(tmp, cache)
+    except OSError:
+        # Read-only data directory, the xml is parsed every time
+        pass
+    return themes
 
 if __name__ == "__main__":
     parser = ArgumentParser(
@@ -75,8 +309,20 @@ if __name__ == "__main__":
         "--theme",
         nargs="+",
         type=str,
-        help="Name of the themes to be used.",
-        choices=[tag for tag, _ in themes.items()],
+        help="Name of the themes to be used (tags of the theme descriptions file).",
+    )
+    parser.add_argument(
+        "--themes-desc",
+        type=Path,
+        help="Lichess puzzleTheme.xml file describing the themes.",
+        default=Path("data/puzzleTheme.xml"),
+    )
+    parser.add_argument(
+        "--theme-query",
+        "-q",
+        type=str,
+        help='Only keep puzzles matching a boolean theme expression, e.g. "fork and not (mate or endgame)".',
+        default=None,
     )
     parser.add_argument(
         "-m",
@@ -92,6 +338,12 @@ if __name__ == "__main__":
         help="Step size from problem ratings",
         default=500,
     )
+    parser.add_argument(
+        "--quantiles",
+        type=int,
+        help="Split the rating range into this number of buckets holding about the same number of puzzles instead of fixed steps.",
+        default=None,
+    )
     parser.add_argument(
         "-M",
         "--max-rating",
@@ -113,6 +365,14 @@ if __name__ == "__main__":
 
     parser.add_argument("--output", "-o", type=Path, help="Output file", default=None)
 
+    parser.add_argument(
+        "--database",
+        "-d",
+        type=Path,
+        help="Lichess puzzle database, csv or compressed csv (.bz2).",
+        default=Path("data/lichess_db_puzzle.csv"),
+    )
+
     # add argument page, default = 1
     parser.add_argument(
         "--page",
@@ -141,73 +401,198 @@ if __name__ == "__main__":
     )
     parser.set_defaults(is_categorized=True)
 
-    # print current start time
-    current_time = datetime.now().time()
-    print("Start Time:", current_time)
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Seed of the puzzle sampling, to reproduce a book.",
+        default=None,
+    )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        help="Number of processes used to render the puzzles.",
+        default=1,
+    )
 
-    puzzles = open_puzzles(Path("data/lichess_db_puzzle.csv"))
+    parser.add_argument(
+        "--fragment-cache",
+        type=Path,
+        help="Sqlite file caching the rendered puzzles between runs.",
+        default=None,
+    )
+    parser.add_argument(
+        "--fragment-cache-size",
+        type=int,
+        help="Maximum size of the fragment cache in MB, least recently used fragments are evicted.",
+        default=256,
+    )
 
-    L = []
+    parser.add_argument(
+        "--diagrams",
+        type=Path,
+        help="Directory of pre-rendered diagrams included instead of drawing the boards with skak. Diagrams are named after their content and reused between runs.",
+        default=None,
+    )
+    parser.add_argument(
+        "--diagram-format",
+        choices=["pdf", "svg"],  # diagrams.FORMATS
+        help="pdf needs cairosvg, svg needs the latex svg package and inkscape.",
+        default="pdf",
+    )
 
+    parser.add_argument(
+        "--unique-positions",
+        action="store_true",
+        help="Drop the puzzles whose position is already in the book.",
+    )
+    parser.add_argument(
+        "--chapters",
+        action="store_true",
+        help="Write each rating range to its own file in OUTPUT_chapters/, included by the output document with \\include, so build.py can compile the ranges in parallel.",
+    )
 
-    for diff in range(args.min_rating, args.max_rating, args.step_size):
-        # puzzles[Themes] is a string with themes separated by space
-        # remove all the themes except the first one
-        # only do it when args.theme is None
-#        if args.theme is None:
-#            puzzles["Themes"] = puzzles["Themes"].str.split(" ").str[0]
+    parser.add_argument(
+        "--precompute",
+        action="store_true",
+        help="Compute once the displayed position and solution of every puzzle and store them in the cache.",
+    )
 
-        p = puzzles[puzzles["Rating"] <= diff]
+    parser.add_argument(
+        "--shards",
+        type=str,
+        help="Directory or url of the puzzle shards written by puzzle_shards.py, selected without pandas instead of reading --database. The puzzles drawn for a seed differ.",
+        default=None,
+    )
 
-        if len(p) < args.page_number:
-            p = p.sample(len(p))
-        else:
-            p = p.sample(
-                args.page_number
-            )  # We take a subsample of the puzzles so the filtering is not too slow
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        help="Write the time, memory and counters of each stage to this json file.",
+        default=None,
+    )
 
-        if args.is_categorized:
-            diff_L = []
-            for tag, theme in themes.items():
-                if args.theme is not None and tag not in args.theme:
-                    continue
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        help="Parse the csv directly instead of using the columnar cache.",
+    )
 
-                pt = p[p["Themes"].str.contains(tag)]
+    # print current start time
+    current_time = datetime.now().time()
+    print("Start Time:", current_time)
 
-                if len(pt):
-                    if (args.problems is not None and args.problems > 0):
-                        sample_count = min(len(pt), args.problems)
-                    else:
-                        sample_count = len(pt)
-                    # puzzles are displayed in 3 columns
-                    # so we need to make sure that the number of puzzles is divisible by 3
-                    sample_count = sample_count - sample_count % 3
-                    if sample_count == 0:
-                        continue
-                    pt = pt.sample(sample_count).to_dict("records")
-                    diff_L.append((theme.name, "puzzles", pt, theme.desc))
+    args = parser.parse_args()
 
-            L.append((f"{diff} rated problems.", "list", diff_L, ""))
+    from board_helpers import iter_book_from_list_table_layout
+    from diagrams import DiagramStore, check_format
+    from fragment_cache import FragmentCache
+    from theme_query import ThemeQuery
+    from utils import insert_preamble, write_template
+
+    profile = profiling.start() if args.profile else profiling.current()
+
+    with profile.stage("themes"):
+        themes = {}
+        if args.is_categorized or args.theme or args.theme_query:
+            try:
+                themes = load_themes(args.themes_desc)
+            except OSError as error:
+                parser.error(f"cannot read the themes description: {error}")
+            unknown = [tag for tag in args.theme or [] if tag not in themes]
+            if unknown:
+                parser.error(f"unknown themes: {', '.join(unknown)}")
+        if args.theme_query:
+            try:
+                ThemeQuery(args.theme_query).check(themes)
+            except ValueError as error:
+                parser.error(str(error))
+
+    diagrams = None
+    if args.diagrams:
+        try:
+            check_format(args.diagram_format)
+        except ValueError as error:
+            parser.error(str(error))
+        output_dir = args.output.parent if args.output else Path(".")
+        prefix = Path(os.path.relpath(args.diagrams, output_dir)).as_posix()
+        diagrams = DiagramStore(args.diagrams, prefix, fmt=args.diagram_format)
+
+    with profile.stage("open_puzzles"):
+        if args.shards:
+            from puzzle_shards import ShardStore, make_book as make_shard_book
+
+            puzzles = ShardStore(args.shards).select(
+                args.min_rating, args.max_rating, args.theme, args.theme_query
+            )
+            build = make_shard_book
         else:
-            if args.theme is not None:
-                p = p[p["Themes"].str.contains("|".join(args.theme))]
+            puzzles = open_puzzles(
+                args.database,
+                min_rating=args.min_rating,
+                max_rating=args.max_rating,
+                themes=args.theme,
+                theme_query=args.theme_query,
+                cache=args.cache,
+                precompute=args.precompute,
+                jobs=args.jobs,
+                compact=True,
+            )
+            build = make_book
+
+    with profile.stage("make_book"):
+        L = build(
+            puzzles,
+            themes,
+            min_rating=args.min_rating,
+            max_rating=args.max_rating,
+            step_size=args.step_size,
+            quantiles=args.quantiles,
+            problems=args.problems,
+            page_number=args.page_number,
+            is_categorized=args.is_categorized,
+            tags=args.theme,
+            seed=args.seed,
+            unique_positions=args.unique_positions,
+        )
+
+    fragment_cache = (
+        FragmentCache(args.fragment_cache, max_size=args.fragment_cache_size * 2**20)
+        if args.fragment_cache
+        else None
+    )
 
-            if len(p):
-                if (args.problems is not None and args.problems > 0):
-                    sample_count = min(len(p), args.problems)
-                else:
-                    sample_count = len(p)
-                # puzzles are displayed in 3 columns
-                # so we need to make sure that the number of puzzles is divisible by 3
-                sample_count = sample_count - sample_count % 3
-                if sample_count == 0:
-                    continue
-                p = p.sample(sample_count).to_dict("records")
-                L.append((f"{diff} rated problems.", "puzzles", p, ""))
-
-    content = mk_book_from_list_table_layout(L, level=0, book=True, is_categorized=args.is_categorized)
+    def render(chapters):
+        content = iter_book_from_list_table_layout(
+            chapters,
+            level=0,
+            book=True,
+            is_categorized=args.is_categorized,
+            jobs=args.jobs,
+            cache=fragment_cache,
+            diagrams=diagrams,
+        )
+        # Timed as the fragments are written
+        return profile.iterate("render", content)
+
+    if args.chapters:
+        from study import chapter_name, iter_includes
+
+        # Chapters are laid out on their own, the file of each one holds
+        # exactly its part of the single file book
+        directory = args.output.with_name(args.output.stem + "_chapters")
+        directory.mkdir(parents=True, exist_ok=True)
+        names = []
+        for index, chapter in enumerate(L):
+            names.append({"name": chapter_name(index)})
+            with open(directory / f"{names[-1]['name']}.tex", "w", encoding='utf-8') as fd:
+                fd.writelines(render([chapter]))
+        relative = Path(os.path.relpath(directory, args.output.parent)).as_posix()
+        content = iter_includes(relative, names)
+    else:
+        content = render(L)
 
     if args.template is None:
         template = "$content"
@@ -215,9 +600,14 @@ if __name__ == "__main__":
         with args.template.open("r") as f:
             template = f.read()
 
-    template = Template(template)
+    if diagrams is not None and diagrams.fmt == "svg" and "{svg}" not in template:
+        try:
+            template = insert_preamble(template, "\\usepackage{svg}")
+        except ValueError:
+            # No preamble, the document including the output loads it
+            pass
 
-    frontpage_path = os.path.abspath(args.front_page) if args.front_page else None
+    frontpage_path = os.path.abspath(args.front_page) if args.front_page else ""
     # change path from \ to / for latex to work in Windows
     frontpage_path = frontpage_path.replace("\\", "/")
 
@@ -226,11 +616,20 @@ if __name__ == "__main__":
         if args.front_page
         else ""
     )
-    with open(args.output, "w", encoding='utf-8') as fd:
-        fd.write(template.substitute(frontpage=frontpage, content=content))
+    with profile.stage("write_template"), open(args.output, "w", encoding='utf-8') as fd:
+        write_template(fd, template, content, frontpage=frontpage)
+
+    if fragment_cache is not None:
+        fragment_cache.close()
+        print("Fragment cache:", fragment_cache.stats())
 
     # print current end time and total time taken
     end_time = datetime.now().time()
     print("End Time:", end_time)
 
+    if args.profile:
+        profile.write(args.profile)
+        print(profile.summary())
+        print("Profile written to", args.profile)
+
 
@@ -0,0 +1,253 @@
+from typing import Callable, List, Tuple
+
+import chess
+
+# Themes not displayed below the puzzles
+HIDDEN_THEMES = ["mate", "short", "long", "oneMove", "veryLong"]
+
+# Number of themes displayed below the puzzles
+SHOWN_THEMES = 5
+
+# Columns holding the derived fields when they were precomputed with the
+# database, see PuzzleCache.precompute
+DERIVED_COLUMNS = {
+    "StartFEN": "string",
+    "DisplayFEN": "string",
+    "Turn": "int8",
+    "NbMoves": "int8",
+    "Solution": "string",
+    "ShownThemes": "string",
+}
+
+# Fields of PuzzleRecord computed by derive
+DERIVED_FIELDS = (
+    "start_fen",
+    "display_fen",
+    "turn",
+    "num_moves",
+    "solution",
+    "shown_themes",
+)
+
+
+class PuzzleRecord:
+    """
+    Everything the renderers need to know about a puzzle. The board work
+    (parsing the fen, playing the opponent move, computing the san solution)
+    is done once per record, the renderers only format fields.
+
+    Records made by deferred only hold the lichess fields, the others are
+    derived on first use. A deferred record sent to a worker process is
+    derived there, and the fragments found in a FragmentCache never need it.
+    """
+
+    __slots__ = (
+        "puzzle_id",
+        "fen",
+        "moves",
+        "themes",
+        "start_fen",
+        "display_fen",
+        "turn",
+        "num_moves",
+        "solution",
+        "shown_themes",
+    )
+
+    def __init__(
+        self,
+        puzzle_id: str,
+        fen: str,
+        moves: str,
+        themes: str,
+        start_fen: str,
+        display_fen: str,
+        turn: bool,
+        num_moves: int,
+        solution: str,
+        shown_themes: str,
+    ) -> None:
+        """
+        puzzle_id, fen, moves, themes: the lichess fields
+        start_fen: fen of the position before the opponent move
+        display_fen: fen of the position to solve, after the opponent move
+        turn: side to move in the position to solve
+        num_moves: number of moves the solving side has to find
+        solution: san of the solution, escaped for latex
+        shown_themes: themes displayed below the puzzle
+        """
+        self.puzzle_id = puzzle_id
+        self.fen = fen
+        self.moves = moves
+        self.themes = themes
+        self.start_fen = start_fen
+        self.display_fen = display_fen
+        self.turn = turn
+        self.num_moves = num_moves
+        self.solution = solution
+        self.shown_themes = shown_themes
+
+    @classmethod
+    def deferred(cls, puzzle_id: str, fen: str, moves: str, themes: str):
+        """
+        Record of the lichess fields whose derived fields are computed when
+        one of them is first read.
+        """
+        record = cls.__new__(cls)
+        record.puzzle_id = puzzle_id
+        record.fen = fen
+        record.moves = moves
+        record.themes = themes
+        return record
+
+    def __getattr__(self, name: str):
+        # Only called for the slots which are not set yet
+        if name not in DERIVED_FIELDS:
+            raise AttributeError(name)
+        for field, value in zip(
+            DERIVED_FIELDS, derive(self.fen, self.moves, self.themes)
+        ):
+            setattr(self, field, value)
+        return getattr(self, name)
+
+    def __getstate__(self):
+        # Only the set fields, pickling a deferred record must not derive it
+        return {
+            name: object.__getattribute__(self, name)
+            for name in self.__slots__
+            if _is_set(self, name)
+        }
+
+    def __setstate__(self, state) -> None:
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def from_puzzle(cls, puzzle):
+        """
+        Build the record of a puzzle given as a mapping of the lichess
+        columns (dict, pandas row...). Derived columns are used when present.
+        """
+        themes = puzzle["Themes"] if isinstance(puzzle["Themes"], str) else ""
+        if "DisplayFEN" in puzzle:
+            derived = (
+                puzzle["StartFEN"],
+                puzzle["DisplayFEN"],
+                bool(puzzle["Turn"]),
+                int(puzzle["NbMoves"]),
+                puzzle["Solution"],
+                puzzle["ShownThemes"],
+            )
+        else:
+            derived = derive(puzzle["FEN"], puzzle["Moves"], themes)
+        return cls(puzzle["PuzzleId"], puzzle["FEN"], puzzle["Moves"], themes, *derived)
+
+
+def _is_set(record: PuzzleRecord, name: str) -> bool:
+    try:
+        object.__getattribute__(record, name)
+    except AttributeError:
+        return False
+    return True
+
+
+def derive(fen: str, moves: str, themes: str) -> Tuple[str, str, bool, int, str, str]:
+    """
+    Derived fields of a puzzle: start fen, displayed fen, side to move, number
+    of moves, escaped san solution and displayed themes.
+    """
+    board = chess.Board(fen=fen)
+    start_fen = board.fen()
+
+    moves = [chess.Move.from_uci(move) for move in moves.split(" ")]
+    # calculate number of moves needed for one side to solve the puzzle
+    # based on len of moves variable
+    # example: len = 1, 2 --> need 1 move
+    # len = 3, 4 --> need 2 moves
+    num_moves = len(moves) // 2
+
+    # The first move is played by the opponent
+    board.push(moves[0])
+    # escape the # character
+    solution = board.variation_san(moves[1:]).replace("#", "\\#")
+
+    shown = [theme for theme in themes.split(" ") if theme not in HIDDEN_THEMES]
+    shown_themes = " ".join(shown[:SHOWN_THEMES])
+
+    return start_fen, board.fen(), board.turn, num_moves, solution, shown_themes
+
+
+def derive_many(fens: List[str], moves: List[str], themes: List) -> List[Tuple]:
+    return [
+        derive(f, m, t if isinstance(t, str) else "")
+        for f, m, t in zip(fens, moves, themes)
+    ]
+
+
+def memoize_rows(build: Callable) -> Callable:
+    """
+    Wrap build(rows), giving the records of a list of rows, so that each row
+    is built once: a puzzle shown in several sections of a book is the same
+    record, derived at most once.
+    """
+    built = {}
+
+    def records(rows) -> List[PuzzleRecord]:
+        missing = [row for row in dict.fromkeys(rows) if row not in built]
+        if missing:
+            built.update(zip(missing, build(missing)))
+        return [built[row] for row in rows]
+
+    return records
+
+
+def as_record(puzzle) -> PuzzleRecord:
+    if isinstance(puzzle, PuzzleRecord):
+        return puzzle
+    return PuzzleRecord.from_puzzle(puzzle)
+
+
+def puzzle_records(frame) -> List[PuzzleRecord]:
+    """
+    Records of the puzzles of a DataFrame, using its derived columns when it
+    has them, deferred records otherwise.
+    """
+    columns = ["PuzzleId", "FEN", "Moves", "Themes"]
+    if all(name in frame.columns for name in DERIVED_COLUMNS):
+        columns += list(DERIVED_COLUMNS)
+        return [
+            PuzzleRecord(
+                puzzle_id,
+                fen,
+                moves,
+                themes if isinstance(themes, str) else "",
+                start_fen,
+                display_fen,
+                bool(turn),
+                int(num_moves),
+                solution,
+                shown_themes,
+            )
+            for (
+                puzzle_id,
+                fen,
+                moves,
+                themes,
+                start_fen,
+                display_fen,
+                turn,
+                num_moves,
+                solution,
+                shown_themes,
+            ) in zip(*(frame[name].tolist() for name in columns))
+        ]
+
+    return [
+        PuzzleRecord.deferred(p, f, m, t if isinstance(t, str) else "")
+        for p, f, m, t in zip(
+            frame["PuzzleId"].tolist(),
+            frame["FEN"].tolist(),
+            frame["Moves"].tolist(),
+            frame["Themes"].tolist(),
+        )
+    ]
@@ -0,0 +1,114 @@
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+
+def _ranks(groups: np.ndarray, keys: np.ndarray):
+    """
+    Sort items by group then key. Returns the sorting permutation and the rank
+    of each sorted item inside its group.
+    """
+    order = np.lexsort((keys, groups))
+    sorted_groups = groups[order]
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    lengths = np.diff(np.r_[starts, len(order)])
+    ranks = np.arange(len(order)) - np.repeat(starts, lengths)
+    return order, ranks
+
+
+def stratified_order(
+    size: int,
+    buckets: Sequence[np.ndarray],
+    cells: Optional[Sequence[np.ndarray]] = None,
+    bucket_limit: Optional[int] = None,
+    seed: Optional[int] = None,
+) -> List[List[np.ndarray]]:
+    """
+    Rows of every (bucket, cell) pair, in random order.
+
+    Each candidate row gets one random key and the rows are sorted by it, so
+    all the pairs follow a single random permutation computed in a single
+    pass over the candidates. Drawing the first rows of each pair gives the
+    samples of stratified_sample, the next ones can replace drawn rows which
+    are rejected (see positions.unique_records).
+
+    size: number of candidate rows, rows are identified by 0 <= id < size
+    buckets: rows of each bucket (rating range), a row is in at most one bucket
+    cells: rows of each cell (theme), a row may be in several cells. None for a
+        single cell holding every row
+    bucket_limit: only this number of rows of each bucket are considered,
+        before they are split into cells
+    seed: seed of the random generator, to reproduce a run
+
+    Returns ordered with ordered[b][c] the rows of bucket b and cell c.
+    """
+    rng = np.random.default_rng(seed)
+    keys = rng.random(size)
+
+    bucket_of = np.full(size, -1, dtype="int64")
+    for b, rows in enumerate(buckets):
+        bucket_of[rows] = b
+
+    # Subsample each bucket: keep its bucket_limit rows with the smallest keys
+    candidates = np.flatnonzero(bucket_of >= 0)
+    if bucket_limit is not None and bucket_limit > 0:
+        order, ranks = _ranks(bucket_of[candidates], keys[candidates])
+        candidates = np.sort(candidates[order[ranks < bucket_limit]])
+    kept = np.zeros(size, dtype=bool)
+    kept[candidates] = True
+
+    # One (row, cell) pair per kept row and cell it belongs to
+    if cells is None:
+        cells = [candidates]
+    pair_rows = np.concatenate(
+        [np.asarray(rows, dtype="int64") for rows in cells] + [np.empty(0, "int64")]
+    )
+    pair_cells = np.repeat(np.arange(len(cells)), [len(rows) for rows in cells])
+    selected = kept[pair_rows]
+    pair_rows = pair_rows[selected]
+    pair_groups = bucket_of[pair_rows] * len(cells) + pair_cells[selected]
+
+    counts = np.bincount(pair_groups, minlength=len(buckets) * len(cells))
+    order, _ = _ranks(pair_groups, keys[pair_rows])
+    ordered = np.split(pair_rows[order], np.cumsum(counts)[:-1])
+
+    return [ordered[b * len(cells) : (b + 1) * len(cells)] for b in range(len(buckets))]
+
+
+def sample_size(available: int, cell_limit: Optional[int] = None, multiple=1) -> int:
+    """
+    Number of rows drawn from a (bucket, cell) of available rows: at most
+    cell_limit (None or 0 for no limit), rounded down to a multiple of
+    multiple.
+    """
+    count = available
+    if cell_limit is not None and cell_limit > 0:
+        count = min(count, cell_limit)
+    return count - count % multiple
+
+
+def stratified_sample(
+    size: int,
+    buckets: Sequence[np.ndarray],
+    cells: Optional[Sequence[np.ndarray]] = None,
+    bucket_limit: Optional[int] = None,
+    cell_limit: Optional[int] = None,
+    multiple: int = 1,
+    seed: Optional[int] = None,
+) -> List[List[np.ndarray]]:
+    """
+    Sample rows for every (bucket, cell) pair at once: the first rows of each
+    pair in the order of stratified_order, see it for the arguments.
+
+    cell_limit: maximum number of rows per (bucket, cell)
+    multiple: the number of rows of a (bucket, cell) is rounded down to a
+        multiple of it (puzzles are displayed by rows of 3)
+
+    Returns samples with samples[b][c] the rows drawn for bucket b and cell c,
+    in random order.
+    """
+    ordered = stratified_order(size, buckets, cells, bucket_limit, seed)
+    return [
+        [rows[: sample_size(len(rows), cell_limit, multiple)] for rows in bucket]
+        for bucket in ordered
+    ]
@@ -0,0 +1,423 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional
+
+from puzzle_cache import PuzzleCache
+from puzzle_store import PuzzleStore
+from puzzles import load_themes, make_book
+from board_helpers import iter_book_from_list_table_layout
+from theme_query import ThemeQuery
+from utils import write_template
+
+TEMPLATES = Path(__file__).resolve().parent / "templates"
+
+# Options of a book request and their default, the ones of puzzles.py
+DEFAULTS = {
+    "min_rating": 1000,
+    "max_rating": 2500,
+    "step_size": 500,
+    "quantiles": None,
+    "problems": 0,
+    "page_number": 500,
+    "categorized": True,
+    "themes": None,
+    "theme_query": None,
+    "seed": None,
+    "unique_positions": False,
+    "template": None,
+}
+
+# Size of the chunks of the streamed books
+CHUNK_SIZE = 1 << 16
+
+# Chunks a worker can produce ahead of the connection sending them
+QUEUED_CHUNKS = 16
+
+
+class BadRequest(Exception):
+    pass
+
+
+def parse_spec(spec, themes: Dict, templates: Path) -> Dict:
+    """
+    Check a book request, a json object holding some of the DEFAULTS keys,
+    and fill in the missing options. Raises BadRequest on invalid requests.
+    """
+    if not isinstance(spec, dict):
+        raise BadRequest("The request must be a json object")
+    unknown = [key for key in spec if key not in DEFAULTS]
+    if unknown:
+        raise BadRequest(f"Unknown options: {', '.join(unknown)}")
+    options = {**DEFAULTS, **spec}
+
+    for key in ("min_rating", "max_rating", "step_size", "problems", "page_number"):
+        if not _is_integer(options[key]) or options[key] < 0:
+            raise BadRequest(f"{key} must be a positive integer")
+    if options["step_size"] == 0:
+        raise BadRequest("step_size must be a positive integer")
+    if options["quantiles"] is not None and (
+        not _is_integer(options["quantiles"]) or options["quantiles"] < 1
+    ):
+        raise BadRequest("quantiles must be a positive integer")
+    if options["seed"] is not None and (
+        not _is_integer(options["seed"]) or options["seed"] < 0
+    ):
+        raise BadRequest("seed must be a positive integer")
+
+    for key in ("categorized", "unique_positions"):
+        if not isinstance(options[key], bool):
+            raise BadRequest(f"{key} must be true or false")
+
+    if options["themes"] is not None:
+        if not isinstance(options["themes"], list):
+            raise BadRequest("themes must be a list of theme tags")
+        missing = [tag for tag in options["themes"] if tag not in themes]
+        if missing:
+            raise BadRequest(f"Unknown themes: {', '.join(map(str, missing))}")
+
+    if options["theme_query"] is not None:
+        if not isinstance(options["theme_query"], str):
+            raise BadRequest("theme_query must be a string")
+        try:
+            ThemeQuery(options["theme_query"]).check(themes)
+        except ValueError as error:
+            raise BadRequest(str(error))
+
+    if options["template"] is not None:
+        # Only the templates of the server, by name
+        name = Path(str(options["template"])).name
+        if not (templates / name).is_file():
+            raise BadRequest(f"Unknown template {options['template']}")
+        options["template"] = name
+    return options
+
+
+def _is_integer(value) -> bool:
+    # json true and false are bool, a subclass of int
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+# State of the worker processes, loaded once by _init_worker
+_store: Optional[PuzzleCache] = None
+_themes: Dict = {}
+_templates = TEMPLATES
+
+
+def _init_worker(database: Path, themes_desc: Path, templates: Path) -> None:
+    global _store, _themes, _templates
+    _store = PuzzleCache.open(database)
+    _store.theme_index()
+    _store.rating_index()
+    _themes = load_themes(themes_desc)
+    _templates = templates
+
+
+class _ChunkWriter:
+    """
+    File-like object sending what is written to a queue, utf-8 encoded in
+    chunks of about CHUNK_SIZE bytes.
+    """
+
+    def __init__(self, chunks) -> None:
+        self.chunks = chunks
+        self.pending = []
+        self.size = 0
+
+    def write(self, text: str) -> None:
+        self.pending.append(text)
+        self.size += len(text)
+        if self.size >= CHUNK_SIZE:
+            self.flush()
+
+    def writelines(self, texts) -> None:
+        for text in texts:
+            self.write(text)
+
+    def flush(self) -> None:
+        if self.pending:
+            self.chunks.put("".join(self.pending).encode("utf-8"))
+        self.pending = []
+        self.size = 0
+
+
+def build_book(options: Dict, chunks) -> None:
+    """
+    Write the latex of the book described by options (see parse_spec), from
+    the puzzle store of the worker, to the queue chunks as it is rendered.
+    None is put last, even on errors, which are raised once it is sent.
+    """
+    try:
+        _write_book(options, _ChunkWriter(chunks))
+    finally:
+        chunks.put(None)
+
+
+def _write_book(options: Dict, fd: _ChunkWriter) -> None:
+    rows = _store.select(
+        options["min_rating"],
+        options["max_rating"],
+        options["themes"],
+        options["theme_query"],
+    )
+    puzzles = PuzzleStore.from_cache(_store, rows)
+    book = make_book(
+        puzzles,
+        _themes,
+        min_rating=options["min_rating"],
+        max_rating=options["max_rating"],
+        step_size=options["step_size"],
+        quantiles=options["quantiles"],
+        problems=options["problems"],
+        page_number=options["page_number"],
+        is_categorized=options["categorized"],
+        tags=options["themes"],
+        seed=options["seed"],
+        unique_positions=options["unique_positions"],
+    )
+    content = iter_book_from_list_table_layout(
+        book, level=0, book=True, is_categorized=options["categorized"]
+    )
+
+    template = "$content"
+    if options["template"] is not None:
+        template = (_templates / options["template"]).read_text()
+    write_template(fd, template, content, frontpage="")
+    fd.flush()
+
+
+class BookServer:
+    """
+    Puzzle book service: the puzzle store, its indexes and the themes are
+    loaded once by each process of a pool, books are then built on request
+    without reading the database again.
+
+    It speaks a minimal HTTP/1.1, over tcp or a unix socket:
+        POST /book  json options (see DEFAULTS), answers the latex of the
+                    book, streamed in chunks
+        GET /health json statistics of the server
+    """
+
+    def __init__(
+        self, database: Path, themes_desc: Path, jobs=1, templates=TEMPLATES
+    ) -> None:
+        self.templates = Path(templates)
+        # Built or checked once here rather than by every worker
+        store = PuzzleCache.open(database)
+        self.puzzles = len(store)
+        self.themes = load_themes(themes_desc)
+        self.jobs = jobs
+        # Queues of the chunks of the books, shared with the workers
+        self.manager = multiprocessing.Manager()
+        self.pool = ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_worker,
+            initargs=(Path(database), Path(themes_desc), self.templates),
+        )
+        self.books = 0
+        self.failures = 0
+        self.busy_seconds = 0.0
+        self.started = time.time()
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            method, target, body = await read_request(reader)
+            if method == "GET" and target == "/health":
+                await send(writer, 200, json.dumps(self.health()).encode("utf-8"))
+            elif method == "POST" and target == "/book":
+                await self.book(writer, body)
+            else:
+                await send(writer, 404, b'{"error": "Not found"}')
+        except BadRequest as error:
+            await send(writer, 400, json.dumps({"error": str(error)}).encode("utf-8"))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def book(self, writer: asyncio.StreamWriter, body: bytes) -> None:
+        try:
+            spec = json.loads(body or b"{}")
+        except ValueError:
+            raise BadRequest("The request is not valid json")
+        options = parse_spec(spec, self.themes, self.templates)
+
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        chunks = self.manager.Queue(maxsize=QUEUED_CHUNKS)
+        future = self.pool.submit(build_book, options, chunks)
+        done = asyncio.wrap_future(future)
+
+        chunk = await loop.run_in_executor(None, _next_chunk, chunks, future)
+        if chunk is None:
+            # Nothing written yet, a failure still gets its status
+            try:
+                await done
+            except Exception as error:
+                self.failures += 1
+                await send(
+                    writer, 500, json.dumps({"error": str(error)}).encode("utf-8")
+                )
+                return
+
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: application/x-tex; charset=utf-8\r\n"
+            b"Transfer-Encoding: chunked\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+        try:
+            while chunk is not None:
+                writer.write(b"%x\r\n" % len(chunk) + chunk + b"\r\n")
+                await writer.drain()
+                chunk = await loop.run_in_executor(None, _next_chunk, chunks, future)
+        except ConnectionError:
+            # The worker waits on the full queue until the book is consumed
+            await loop.run_in_executor(None, _drain, chunks, future)
+            raise
+        try:
+            await done
+        except Exception:
+            # Too late for a status, the answer ends without its last chunk
+            self.failures += 1
+            return
+        self.busy_seconds += time.perf_counter() - start
+        self.books += 1
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    def health(self) -> Dict:
+        return {
+            "puzzles": self.puzzles,
+            "workers": self.jobs,
+            "books": self.books,
+            "failures": self.failures,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "uptime": round(time.time() - self.started, 3),
+        }
+
+    async def serve(self, host="127.0.0.1", port=8765, socket=None) -> None:
+        if socket is not None:
+            server = await asyncio.start_unix_server(self.handle, path=str(socket))
+            where = socket
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            where = f"http://{host}:{port}"
+        print(f"Serving {self.puzzles} puzzles on {where} with {self.jobs} workers")
+        async with server:
+            await server.serve_forever()
+
+    def close(self) -> None:
+        self.pool.shutdown()
+        self.manager.shutdown()
+
+
+def _next_chunk(chunks, future: Future) -> Optional[bytes]:
+    """
+    Next chunk of a book from the queue its worker fills, None at its end or
+    when the worker died without ending it.
+    """
+    while True:
+        try:
+            return chunks.get(timeout=1)
+        except queue.Empty:
+            if future.done():
+                return None
+
+
+def _drain(chunks, future: Future) -> None:
+    while _next_chunk(chunks, future) is not None:
+        pass
+
+
+async def read_request(reader: asyncio.StreamReader):
+    """
+    Method, target and body of an HTTP request.
+    """
+    line = await reader.readline()
+    try:
+        method, target, _ = line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise BadRequest("Malformed request line")
+
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            try:
+                length = int(value)
+            except ValueError:
+                raise BadRequest("Malformed Content-Length")
+    body = await reader.readexactly(length) if length else b""
+    return method, target, body
+
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Server Error"}
+
+
+async def send(writer: asyncio.StreamWriter, status: int, body: bytes) -> None:
+    writer.write(
+        f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n".encode("latin-1") + body
+    )
+    await writer.drain()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve puzzle books over HTTP, the puzzle database is loaded once. See book_client.py."
+    )
+    parser.add_argument(
+        "--database",
+        "-d",
+        type=Path,
+        help="Lichess puzzle database, csv or compressed csv (.bz2).",
+        default=Path("data/lichess_db_puzzle.csv"),
+    )
+    parser.add_argument(
+        "--themes-desc",
+        type=Path,
+        help="Lichess puzzleTheme.xml file describing the themes.",
+        default=Path("data/puzzleTheme.xml"),
+    )
+    parser.add_argument(
+        "--templates",
+        type=Path,
+        help="Directory of the templates requests can name.",
+        default=TEMPLATES,
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        help="Number of processes building books.",
+        default=os.cpu_count() or 1,
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--socket", type=Path, default=None, help="Listen on this unix socket instead."
+    )
+
+    args = parser.parse_args()
+
+    server = BookServer(args.database, args.themes_desc, args.jobs, args.templates)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
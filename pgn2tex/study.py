@@ -1,15 +1,37 @@
-from typing import Tuple, Dict, Iterator, List, Optional
+from typing import Callable, Tuple, Dict, Iterator, List, Optional, TextIO
 import chess
 import chess.pgn
 import chess.svg
-import uuid
-import copy
-from string import Template
 import os
 import argparse
+import hashlib
+import itertools
+import json
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
 
-from utils import load_pgn, get_section_from_level
+import profiling
+from diagrams import FORMATS, Diagram, DiagramStore, check_format
+from pgn_index import PgnIndex
+from positions import PositionRegistry, position_label
+from utils import (
+    add_includeonly,
+    game_offsets,
+    get_section_from_level,
+    insert_preamble,
+    scan_headers,
+    write_template,
+)
+from study_visitor import StudyVisitor, iter_diagram
+
+# Version of the chapter latex, part of the chapter hashes of incremental
+# builds: bump it when the conversion changes so every chapter is rebuilt
+CHAPTER_VERSION = 1
+
+# Width of the pre-rendered diagrams, the size of the skak boards
+DIAGRAM_WIDTH = "160pt"
 
 
 class PgnBook:
@@ -17,252 +39,395 @@ class PgnBook:
     Class to represent a book parsed from a PGN file.
     """
 
-    def __init__(self, path: Path, book=True, players=False) -> None:
+    def __init__(
+        self,
+        path: Path,
+        book=True,
+        players=False,
+        games: Optional[List[Tuple[int, int]]] = None,
+        diagrams: Optional[DiagramStore] = None,
+        positions: Optional[PositionRegistry] = None,
+    ) -> None:
         """
         path: path to the pgn file.
         book: wether or not we should use a latex book class or an article class
+        games: position in the file and offset of the games to convert, every
+            game of the file when None (see pgn_index.PgnIndex.select)
+        diagrams: store of pre-rendered diagrams included instead of the skak
+            boards, None to draw the boards with skak
+        positions: registry of the positions already displayed, a position
+            displayed again refers to its first diagram instead. The chapters
+            then have to be converted in order, by a single process
         """
         self.path = path
         self.book = book
+        self.games = games
+        self.diagrams = diagrams
+        self.positions = positions
 
         self.add_players = players
 
         self.count = 1
 
+    def game_id(self) -> str:
+        """
+        Id of the current game in the latex code, it only depends on the
+        position of the game in the file so the output is reproducible.
+        """
+        return f"game{self.count}"
+
+    def tracks_positions(self) -> bool:
+        """
+        Whether the boards need the position after each mainline move.
+        """
+        return self.diagrams is not None or self.positions is not None
+
+    def iter_board(
+        self,
+        game_id: str,
+        arrows: List[chess.svg.Arrow],
+        board_fen: Optional[str] = None,
+        move: Optional[chess.Move] = None,
+        key: Optional[int] = None,
+    ) -> Iterator[str]:
+        """
+        Board of a mainline position: drawn by skak, included from the
+        diagrams or, for a position already displayed and without arrows, a
+        reference to its first diagram. board_fen, move and key (see
+        tracks_positions) are the position, the move leading to it and its
+        Zobrist hash.
+        """
+        if self.positions is not None:
+            first = self.positions.add(key)
+            if first is not None and not arrows:
+                yield "\\textit{Same position as page \\pageref{" + first + "}}"
+                return
+            if first is None:
+                yield "\\label{" + position_label(key) + "}"
+
+        if self.diagrams is None:
+            yield from iter_diagram(game_id, arrows)
+        else:
+            diagram = Diagram.of(board_fen, move, arrows)
+            yield self.diagrams.latex(diagram, DIAGRAM_WIDTH)
+
     def mk_chapter(self, game: chess.pgn.Game) -> str:
+        return "".join(self.iter_chapter(game))
+
+    def iter_chapter(self, game: chess.pgn.Game) -> Iterator[str]:
+        """
+        Build a chapter or a first level section from a parsed game. It is
+        replayed through the StudyVisitor of read_chapter, so a parsed game
+        and the same game read from the file give the same latex.
         """
-        Build a chapter or a first level section. Called for each game
-        of the pgn file. It starts the walk through the game and its
-        variations
+        fragments = []
+        game.accept(StudyVisitor(self, fragments.append))
+        yield from fragments
+
+    def iter_heading(self, headers: chess.pgn.Headers) -> Iterator[str]:
+        """
+        Title of the chapter and players of the game.
         """
-        latex = ""
-        title = game.headers["Event"]
+        title = headers["Event"]
 
         # Get the latex code for the section title
-        latex += get_section_from_level(title, level=0, book=self.book) + "\n"
+        yield get_section_from_level(title, level=0, book=self.book) + "\n"
 
         # Used to add the QR code that point to the website where the game
         # can be found in an online analysis tool. Usually lichess
-        latex += "\\thispagestyle{fancy} \n"
-        latex += "\\rhead{"
-        latex += "\\qrcode{" + game.headers["Site"] + "} } \n \n"
+        yield "\\thispagestyle{fancy} \n"
+        yield "\\rhead{"
+        yield "\\qrcode{" + headers["Site"] + "} } \n \n"
 
         # When exporting a game instead of a "study"
         if self.add_players:
-            latex += "\\begin{center} \n"
-            latex += "\\begin{tabular}{C{0.5\\textwidth}  C{0.5\\textwidth}} \n"
-            latex += "\\includegraphics[width=0.2\\textwidth]{img/white_knight_logo.png} &  \\includegraphics[width=0.2\\textwidth]{img/black_knight_logo.png} \\\\ \n"
+            yield "\\begin{center} \n"
+            yield "\\begin{tabular}{C{0.5\\textwidth}  C{0.5\\textwidth}} \n"
+            yield "\\includegraphics[width=0.2\\textwidth]{img/white_knight_logo.png} &  \\includegraphics[width=0.2\\textwidth]{img/black_knight_logo.png} \\\\ \n"
 
-            latex += f"{game.headers['White']} & {game.headers['Black']} \\\\ \n"
+            yield f"{headers['White']} & {headers['Black']} \\\\ \n"
 
-            latex += f"{game.headers['WhiteElo']} & {game.headers['BlackElo']} \\\\ \n"
+            yield f"{headers['WhiteElo']} & {headers['BlackElo']} \\\\ \n"
             # team
 
-            if "WhiteTeam" in game.headers and "BlackTeam" in game.headers:
-                latex += (
-                    f"{game.headers['WhiteTeam']} & {game.headers['BlackTeam']} \\\\ \n"
-                )
+            if "WhiteTeam" in headers and "BlackTeam" in headers:
+                yield f"{headers['WhiteTeam']} & {headers['BlackTeam']} \\\\ \n"
 
-            latex += "\\end{tabular} \n"
-            latex += "\\end{center} \n \n"
+            yield "\\end{tabular} \n"
+            yield "\\end{center} \n \n"
 
-        # Initializes the board. It's used to record the moves
-        # and generate san notation of the moves
-        board = game.board()
+    def latex(self, jobs=1) -> str:
+        return "".join(self.iter_latex(jobs))
 
-        # Walk through the game
-        latex += self.walk_game(board, game, level=0)
+    def read_chapter(self, fd: TextIO, write: Callable[[str], None]) -> bool:
+        """
+        Convert the next game of fd to a chapter, the latex is given to write
+        while the game is parsed. Returns False at the end of the file.
+        """
+        profile = profiling.current()
+        visitor = StudyVisitor(self, write)
+        with profile.stage("chapters") as stage:
+            found = chess.pgn.read_game(fd, Visitor=lambda: visitor) is not None
+            stage.items = visitor.nodes
+        if found:
+            chapter = f"chapter {self.count + 1}"
+            profile.count(chapter, "nodes", visitor.nodes)
+            profile.count(chapter, "diagrams", visitor.boards)
+        return found
+
+    def iter_offsets(self) -> Iterator[Tuple[int, int]]:
+        """
+        Position in the file and offset of the games to convert.
+        """
+        if self.games is None:
+            return enumerate(game_offsets(self.path))
+        return iter(self.games)
 
-        return latex
+    def read_chapters(self, fd: TextIO, write: Callable[[str], None]) -> Iterator[int]:
+        """
+        Convert the games to chapters one after the other, giving the latex to
+        write. Yields the position of each game once its chapter is written.
+        """
+        if self.games is None:
+            self.count = 0
+            while self.read_chapter(fd, write):
+                yield self.count
+                self.count += 1
+            return
+
+        for index, offset in self.games:
+            fd.seek(offset)
+            self.count = index
+            self.read_chapter(fd, write)
+            yield index
+
+    def iter_chapters(self, jobs=2) -> Iterator[str]:
+        """
+        Latex of each chapter, in the order of the file. The games are located
+        with a scan of their headers and converted by a pool of jobs processes.
+        """
+        profile = profiling.current()
+        tasks = (
+            (
+                self.path,
+                offset,
+                index,
+                self.book,
+                self.add_players,
+                self.diagrams,
+                profile.enabled,
+            )
+            for index, offset in self.iter_offsets()
+        )
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            for latex, stats in pool.map(_render_chapter, tasks):
+                if stats is not None:
+                    profile.merge(stats)
+                yield latex
 
-    def walk_variation(
-        self,
-        current_var: List[chess.Move],
-        board: chess.Board,
-        node: chess.pgn.GameNode,
-        start_var=False,
-        first=False,
-    ) -> str:
+    def write_latex(self, write: Callable[[str], None], jobs=1) -> None:
         """
-        Function used to walk through variations (not the mainline). It supports
-        infinitely nested subvariations and inside variations comments.
-
-        current_var: list of moves currently stacked, waiting to be displayed
-        board: current state of the board
-        node: current game node
-        start_var: if its the start of a new variation
-        first: if it's the first step of the variation deviating from mainline
+        Latex of every game of the pgn file, one chapter per game, given to
+        write fragment by fragment as the file is parsed. With jobs > 1 the
+        chapters are converted in parallel, see iter_chapters, unless the
+        repeated positions are tracked.
         """
-        latex = ""
-
-        current_var.append(node.move)
-
-        # If we start a variation we add the starting comment to the text
-        # if node.starts_variation:
-        # latex += node.starting_comment + "\n \n"
-
-        # node.variations contains the mainline at index 0,
-        # If it has variations from here, ie more than 1 variation
-        # We display the moves we have stacked until now
-        # And we start a bullet point list, one entry per possible variations
-        # from here
-        if len(node.variations) > 1:
-            board_save = copy.deepcopy(board)
-            latex += "\\variation{" + board.variation_san(current_var) + "} \n"
-
-            if not first:
-                latex += node.comment + "\n"
-            for mv in current_var:
-                board_save.push(mv)
-            latex += "\\begin{variants} \n"
-            # If we are the first deviation, we exclude the mainline since it's
-            # Already taken care of in the mainline
-            if not first:
-                latex += (
-                    "\\item " + self.walk_variation([], board_save, node.next()) + "\n"
-                )
-            # Add an entry per possible variations
-            for v in node.variations[1:]:
-                latex += "\\item " + self.walk_variation([], board_save, v)
-            latex += "\\end{variants} \n"
-        # If there is a comment here, we flush the moves stacked untile now
-        # we add the comment in the middle of the variation and then continue
-        elif node.comment and not first:
-            board_save = copy.deepcopy(board)
-            latex += "\\variation{" + board.variation_san(current_var) + "} \n"
-            node.set_arrows([])
-            node.set_eval(score=None)
-            latex += node.comment + "\n"
-            for mv in current_var:
-                board_save.push(mv)
-            next_node = node.next()
-            if next_node:
-                latex += self.walk_variation([], board_save, next_node)
-
-        # If there are no comments or different variations we just stack
-        # one more move if there is one, or flush the moves if we reached the
-        # end of the variation
-        else:
-            if not first:
-                next_node = node.next()
-                if next_node is not None:
-                    latex += self.walk_variation(current_var, board, next_node)
-                else:
-                    latex += "\\variation{" + board.variation_san(current_var) + "} \n"
-            else:
-                return ""
+        if jobs > 1 and self.positions is None:
+            for chapter in self.iter_chapters(jobs):
+                write(chapter)
+                write("\n")
+            return
 
-        return latex
+        with open(self.path) as fd:
+            for _ in self.read_chapters(fd, write):
+                write("\n")
 
-    def walk_game(self, board: chess.Board, game: chess.pgn.GameNode, level=0):
+    def iter_latex(self, jobs=1) -> Iterator[str]:
         """
-        Go throug the mainline of a game and run walk_variation when necessary.
-        Displays boards and comments only when necessary ie when there is a comment
-        arrows on the board or different variations.
-        Otherwise stacks the moves to be displayed at once next time it's required
+        Latex of every game of the pgn file, one chapter per game, yielded
+        fragment by fragment. The fragments of a game are yielded once it is
+        parsed, see write_latex to write them while parsing. With jobs > 1 the
+        chapters are converted in parallel, see iter_chapters.
         """
-        latex = ""
-        to_push = []
-
-        # Uniq id used to identify a game in the latex code
-        # Probably not the best way to do it but still good enough
-        game_id = str(uuid.uuid4())
-
-        # Get arrows/circles from the comment and remove it so we
-        # can display the comments without these.
-        arrows = game.arrows()
-        game.set_arrows([])
-        game.set_eval(score=None)
-
-        # First add the comment for the whole game as introduction
-
-        latex += game.comment + "\n \n"
-
-        # We use a long table to make two columns one with the boards and the
-        # other with the comments
-        latex += "\\begin{longtable}{p{0.5\\textwidth} | p{0.5\\textwidth}} \n"
-
-        # New game with xskak
-        latex += "\\newchessgame[id=" + game_id + ","
-        # Setup board from initial fen
-        latex += (
-            "setfen="
-            + board.fen()
-            + f", player={'w' if board.turn == chess.WHITE else 'b'},"
-        )
-        latex += "]\n"
-
-        # Now we iterate over the mainline
-        for node in game.mainline():
-            # Stack move
-            to_push.append(node.move)
-            # If we want to display something
-            node.set_eval(score=None)
-            if node.comment or (len(node.variations) > 1) or node.is_end():
-                latex += "\\mainline{" + board.variation_san(to_push) + "} \n \n"
-                arrows = node.arrows()
-                node.set_arrows([])
-                for m in to_push:
-                    board.push(m)
-
-                # Display the board
-                latex += "\\chessboard[lastmoveid =" + game_id + ","
-                latex += "setfen=\\xskakgetgame{lastfen},"
-
-                # Display circles and arrows
-                for a in arrows:
-                    if a.tail != a.head:
-                        continue
-                    latex += f"pgfstyle=border, color={a.color},"
-                    latex += "markfield={" + chess.square_name(a.head) + "},"
-
-                for a in arrows:
-                    if a.tail == a.head:
-                        continue
-
-                    latex += f"pgfstyle=straightmove, color={a.color},"
-                    latex += f"markmove={chess.square_name(a.tail)}-{chess.square_name(a.head)},"
-
-                # Highlight last move
-                latex += "pgfstyle=color, color=red!50, colorbackfields={\\xskakget{moveto}, \\xskakget{movefrom}},"
-
-                latex += "]"
-
-                # Add comment on the right column
-                latex += " & " + node.comment + "\n \n"
-
-                # We make a copy of the board not to perturb recursive calls
-                boardt = copy.deepcopy(board)
-                # We remove the last move: walk_variation begins at the very
-                # name node we are in now
-                boardt.pop()
-                # Add variation in the right column
-                latex += self.walk_variation(
-                    [], boardt, node, start_var=True, first=True
+        if jobs > 1 and self.positions is None:
+            for chapter in self.iter_chapters(jobs):
+                yield chapter
+                yield "\n"
+            return
+
+        with open(self.path) as fd:
+            fragments = []
+            for _ in self.read_chapters(fd, fragments.append):
+                yield from fragments
+                yield "\n"
+                fragments.clear()
+
+    def singles(self, jobs=1) -> List[str]:
+        if jobs > 1 and self.positions is None:
+            return list(self.iter_chapters(jobs))
+
+        result = []
+        with open(self.path) as fd:
+            fragments = []
+            for _ in self.read_chapters(fd, fragments.append):
+                result.append("".join(fragments))
+                fragments.clear()
+
+        return result
+
+    def chapter_keys(self) -> List[Tuple[int, int, str, str]]:
+        """
+        Position, offset, title and hash of each game to convert. The hash
+        covers the pgn text of the game and the options its chapter depends
+        on, an unchanged hash means an unchanged chapter.
+        """
+        scanned = list(scan_headers(self.path))
+        ends = [offset for offset, _ in scanned[1:]] + [os.path.getsize(self.path)]
+        games = self.games
+        if games is None:
+            games = [(index, offset) for index, (offset, _) in enumerate(scanned)]
+        options = [CHAPTER_VERSION, self.book, self.add_players]
+        if self.diagrams is not None:
+            options.append(repr(self.diagrams))
+        options = json.dumps(options)
+
+        keys = []
+        with open(self.path, "rb") as fd:
+            for index, offset in games:
+                sha = hashlib.sha256(f"{options}\0{index}\0".encode("utf-8"))
+                fd.seek(offset)
+                sha.update(fd.read(ends[index] - offset))
+                title = scanned[index][1]["Event"]
+                keys.append((index, offset, title, sha.hexdigest()))
+        return keys
+
+    def write_chapters(self, directory: Path, jobs=1) -> Dict:
+        """
+        Incremental conversion: each chapter is written to its own file in
+        directory and only the chapters whose hash changed since the last run
+        are converted again (by a pool of jobs processes). The manifest of the
+        chapters, also written to directory/manifest.json, is returned.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        previous = read_manifest(directory) or {"chapters": []}
+        known = {chapter["name"]: chapter["hash"] for chapter in previous["chapters"]}
+
+        chapters = []
+        tasks = []
+        for index, offset, title, key in self.chapter_keys():
+            name = chapter_name(index)
+            changed = known.get(name) != key or not (directory / f"{name}.tex").exists()
+            chapters.append(
+                {
+                    "name": name,
+                    "number": index + 1,
+                    "title": title,
+                    "hash": key,
+                    "changed": changed,
+                }
+            )
+            if changed:
+                tasks.append(
+                    (
+                        self.path,
+                        offset,
+                        index,
+                        self.book,
+                        self.add_players,
+                        self.diagrams,
+                    )
                 )
-                latex += " \\\\ \n"
 
-                to_push = []
+        names = [chapter["name"] for chapter in chapters if chapter["changed"]]
+        profile = profiling.current()
+        if jobs > 1 and len(tasks) > 1:
+            # The workers return their profile to merge with this one
+            tasks = [task + (profile.enabled,) for task in tasks]
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                results = pool.map(_render_chapter, tasks)
+                for name, (latex, stats) in zip(names, results):
+                    if stats is not None:
+                        profile.merge(stats)
+                    _write_file(directory / f"{name}.tex", latex + "\n")
+        else:
+            for name, task in zip(names, tasks):
+                latex, _ = _render_chapter(task + (False,))
+                _write_file(directory / f"{name}.tex", latex + "\n")
+
+        # Chapters of games that are not converted anymore
+        current = {chapter["name"] for chapter in chapters}
+        removed = [name for name in known if name not in current]
+        for name in removed:
+            for suffix in (".tex", ".aux"):
+                if (directory / f"{name}{suffix}").exists():
+                    (directory / f"{name}{suffix}").unlink()
+
+        manifest = {
+            "version": CHAPTER_VERSION,
+            "source": str(self.path),
+            "chapters": chapters,
+            "changed": names,
+            "removed": removed,
+        }
+        _write_file(directory / "manifest.json", json.dumps(manifest, indent=2))
+        return manifest
+
+
+def chapter_name(index: int) -> str:
+    """
+    Name of the file of the chapter of the game at position index, numbered
+    from 1 like the --game selector.
+    """
+    return f"chapter{index + 1:03d}"
 
-        latex += "\\end{longtable} \n"
 
-        return latex
+def read_manifest(directory: Path) -> Optional[Dict]:
+    try:
+        with open(Path(directory) / "manifest.json") as fd:
+            manifest = json.load(fd)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != CHAPTER_VERSION:
+        return None
+    return manifest
 
-    def latex(self) -> str:
-        latex = ""
-        self.count = 0
-        for game in load_pgn(self.path):
-            latex += self.mk_chapter(game)
-            latex += "\n"
-            self.count += 1
-        return latex
 
-    def singles(self) -> List[str]:
-        result = []
-        for game in load_pgn(self.path):
-            result.append(self.mk_chapter(game))
+def _write_file(path: Path, text: str) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w") as fd:
+        fd.write(text)
+    os.replace(tmp, path)
 
-        return result
+
+def iter_includes(directory: str, chapters: List[Dict]) -> Iterator[str]:
+    """
+    Content of the master document of an incremental build: one \\include per
+    chapter, directory is relative to the master document.
+    """
+    for chapter in chapters:
+        yield "\\include{" + f"{directory}/{chapter['name']}" + "}\n"
+
+
+def _render_chapter(task) -> Tuple[str, Optional[Dict]]:
+    """
+    Latex of the chapter of the game at offset in the pgn file, index is the
+    position of the game in the file. The diagrams of the chapter, if any, are
+    rendered by the same process. With profiled, the profile of the
+    conversion (see profiling.Profile.to_dict) is returned with it.
+    """
+    path, offset, index, book, players, diagrams, profiled = task
+    pgn_book = PgnBook(path, book=book, players=players, diagrams=diagrams)
+    pgn_book.count = index
+    fragments = []
+    with profiling.profiled() if profiled else nullcontext() as profile:
+        with open(path) as fd:
+            fd.seek(offset)
+            pgn_book.read_chapter(fd, fragments.append)
+        if diagrams is not None:
+            with profiling.current().stage("diagrams"):
+                diagrams.render()
+    return "".join(fragments), profile.to_dict() if profiled else None
 
 
 if __name__ == "__main__":
@@ -296,15 +461,108 @@ if __name__ == "__main__":
 
     parser.add_argument("-o", "--output", type=Path, default="output.tex")
 
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of processes converting the chapters of a study.",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        "-i",
+        action="store_true",
+        help="Study mode: write each chapter to its own file in OUTPUT_chapters/, included by the output document, and only convert again the chapters whose game or options changed since the last run.",
+    )
+    parser.add_argument(
+        "--include-only",
+        nargs="+",
+        metavar="CHAPTER",
+        help="With --incremental, only compile these chapters (numbers of the games in the file, or 'changed' for the chapters converted by this run) with \\includeonly.",
+    )
+
+    selection = parser.add_argument_group(
+        "game selection",
+        "Only convert the games matching every given selector. The games are "
+        "found through an index of the headers stored next to the pgn file "
+        "(FILE.index), built on first use.",
+    )
+    selection.add_argument(
+        "--game",
+        "-g",
+        type=int,
+        action="append",
+        help="Number of a game in the file, starting at 1. Can be repeated.",
+    )
+    selection.add_argument("--event", help="Part of the event name.")
+    selection.add_argument("--player", help="Part of the name of one of the players.")
+    selection.add_argument("--eco", help="Start of the ECO code of the opening.")
+
+    parser.add_argument(
+        "--diagrams",
+        type=Path,
+        default=None,
+        help="Directory of pre-rendered diagrams included instead of drawing the boards with skak. Diagrams are named after their content and reused between runs.",
+    )
+    parser.add_argument(
+        "--diagram-format",
+        choices=FORMATS,
+        default="pdf",
+        help="pdf needs cairosvg, svg needs the latex svg package and inkscape.",
+    )
+    parser.add_argument(
+        "--unique-positions",
+        action="store_true",
+        help="Display a position shown earlier in the book (transpositions) as a reference to its first board. The games are then converted by a single process.",
+    )
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        default=None,
+        help="Write the time, memory and counters of each stage to this json file.",
+    )
+
     args = parser.parse_args()
 
+    profile = profiling.start() if args.profile else profiling.current()
+
+    games = None
+    if args.game or args.event or args.player or args.eco:
+        with profile.stage("select games"), PgnIndex.open(args.file) as index:
+            games = index.select(
+                games=None if args.game is None else [n - 1 for n in args.game],
+                event=args.event,
+                player=args.player,
+                eco=args.eco,
+            )
+        if not games:
+            parser.error("no game matches the selection")
+
     if args.template is None:
         template = "$content"
     else:
         with args.template.open("r") as f:
             template = f.read()
 
-    template = Template(template)
+    if args.unique_positions and args.incremental:
+        parser.error("--unique-positions needs every chapter, not --incremental")
+    positions = PositionRegistry() if args.unique_positions else None
+
+    diagrams = None
+    if args.diagrams:
+        try:
+            check_format(args.diagram_format)
+        except ValueError as error:
+            parser.error(str(error))
+        prefix = Path(os.path.relpath(args.diagrams, args.output.parent)).as_posix()
+        diagrams = DiagramStore(args.diagrams, prefix, fmt=args.diagram_format)
+        if args.diagram_format == "svg" and "{svg}" not in template:
+            try:
+                template = insert_preamble(template, "\\usepackage{svg}")
+            except ValueError:
+                # No preamble, the document including the output loads it
+                pass
 
     frontpage = (
         ("\\includepdf[pages=1, noautoscale]{%s}" % os.path.abspath(args.front_page))
@@ -315,20 +573,91 @@ if __name__ == "__main__":
     # Single game
     # uses a latex article class and section for each game
     if args.mode == "single":
-        book = PgnBook(args.file, book=False, players=args.players)
+        # Only the first game is converted, it is located without parsing the
+        # rest of the file
+        if games is None:
+            games = list(itertools.islice(enumerate(game_offsets(args.file)), 1))
+        book = PgnBook(
+            args.file,
+            book=False,
+            players=args.players,
+            games=games[:1],
+            diagrams=diagrams,
+            positions=positions,
+        )
 
-        with open(args.output, "w") as fd:
-            fd.write(
-                template.substitute(frontpage=frontpage, content=book.singles()[0])
-            )
+        with profile.stage("write_template"), open(args.output, "w") as fd:
+            write_template(fd, template, book.singles(), frontpage=frontpage)
 
     # When exporting a whole study it uses a book class and a chapter for each game
+    elif args.mode == "study" and args.incremental:
+        book = PgnBook(
+            args.file,
+            book=True,
+            players=args.players,
+            games=games,
+            diagrams=diagrams,
+            positions=positions,
+        )
+        directory = args.output.with_name(args.output.stem + "_chapters")
+        manifest = book.write_chapters(directory, jobs=args.jobs)
+        relative = Path(os.path.relpath(directory, args.output.parent)).as_posix()
+
+        if args.include_only:
+            names = []
+            for chapter in args.include_only:
+                if chapter == "changed":
+                    names += manifest["changed"]
+                elif chapter.isdigit():
+                    names.append(chapter_name(int(chapter) - 1))
+                else:
+                    parser.error(f"invalid chapter {chapter}")
+            try:
+                template = add_includeonly(
+                    template, [f"{relative}/{name}" for name in dict.fromkeys(names)]
+                )
+            except ValueError as error:
+                parser.error(str(error))
+
+        with profile.stage("write_template"), open(args.output, "w") as fd:
+            write_template(
+                fd,
+                template,
+                iter_includes(relative, manifest["chapters"]),
+                frontpage=frontpage,
+            )
+        print(
+            f"{len(manifest['changed'])} of {len(manifest['chapters'])} chapters converted, manifest in {directory / 'manifest.json'}"
+        )
+
     elif args.mode == "study":
-        book = PgnBook(args.file, book=True, players=args.players)
-
-        with open(args.output, "w") as fd:
-            fd.write(template.substitute(frontpage=frontpage, content=book.latex()))
-    if args.mode == "study":
-        book = PgnBook(args.file, book=True)
-        with open(args.output, "w") as fd:
-            fd.write(template.substitute(frontpage=frontpage, content=book.latex()))
+        book = PgnBook(
+            args.file,
+            book=True,
+            players=args.players,
+            games=games,
+            diagrams=diagrams,
+            positions=positions,
+        )
+
+        with profile.stage("write_template"), open(args.output, "w") as fd:
+            write_template(
+                fd,
+                template,
+                partial(book.write_latex, jobs=args.jobs),
+                frontpage=frontpage,
+            )
+
+    if diagrams is not None:
+        # Diagrams of the chapters converted by this process, the others are
+        # rendered by the processes converting them
+        with profile.stage("diagrams") as stage:
+            stage.items = diagrams.render(jobs=args.jobs)
+
+    if positions is not None:
+        print(f"{positions.repeated} repeated positions")
+
+    if args.profile:
+        profile.write(args.profile)
+        print(profile.summary())
+        print("Profile written to", args.profile)
@@ -0,0 +1,400 @@
+import logging
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import chess
+import chess.pgn
+import chess.svg
+
+from positions import position_key
+
+LOGGER = logging.getLogger(__name__)
+
+# Side to move, move number and san of a move, see san_entry
+SanEntry = Tuple[chess.Color, int, str]
+
+
+def san_entry(board: chess.Board, move: chess.Move) -> SanEntry:
+    """
+    What variation_san needs to know about a move played from board.
+    """
+    return board.turn, board.fullmove_number, board.san(move)
+
+
+def variation_san(entries: List[SanEntry]) -> str:
+    """
+    Same text as chess.Board.variation_san for the moves of entries, without
+    replaying them.
+    """
+    san = []
+    for turn, number, move_san in entries:
+        if turn == chess.WHITE:
+            san.append(f"{number}. {move_san}")
+        elif not san:
+            san.append(f"{number}...{move_san}")
+        else:
+            san.append(move_san)
+    return " ".join(san)
+
+
+def iter_game_start(game_id: str, comment: str, board: chess.Board) -> Iterator[str]:
+    """
+    Introduction of a game: its comment and the start of the table holding the
+    boards and the comments.
+    """
+    # First add the comment for the whole game as introduction
+
+    yield comment + "\n \n"
+
+    # We use a long table to make two columns one with the boards and the
+    # other with the comments
+    yield "\\begin{longtable}{p{0.5\\textwidth} | p{0.5\\textwidth}} \n"
+
+    # New game with xskak
+    yield "\\newchessgame[id=" + game_id + ","
+    # Setup board from initial fen
+    yield (
+        "setfen="
+        + board.fen()
+        + f", player={'w' if board.turn == chess.WHITE else 'b'},"
+    )
+    yield "]\n"
+
+
+def iter_diagram(game_id: str, arrows: List[chess.svg.Arrow]) -> Iterator[str]:
+    """
+    Board of the last mainline move displayed, with its circles and arrows.
+    """
+    # Display the board
+    yield "\\chessboard[lastmoveid =" + game_id + ","
+    yield "setfen=\\xskakgetgame{lastfen},"
+
+    # Display circles and arrows
+    for a in arrows:
+        if a.tail != a.head:
+            continue
+        yield f"pgfstyle=border, color={a.color},"
+        yield "markfield={" + chess.square_name(a.head) + "},"
+
+    for a in arrows:
+        if a.tail == a.head:
+            continue
+
+        yield f"pgfstyle=straightmove, color={a.color},"
+        yield f"markmove={chess.square_name(a.tail)}-{chess.square_name(a.head)},"
+
+    # Highlight last move
+    yield "pgfstyle=color, color=red!50, colorbackfields={\\xskakget{moveto}, \\xskakget{movefrom}},"
+
+    yield "]"
+
+
+Write = Callable[[str], None]
+
+
+def _discard(fragment: str) -> None:
+    pass
+
+
+class _Node:
+    """
+    What is kept of a move while its line is parsed: its san and its comment.
+    With pre-rendered diagrams or a position registry, mainline moves also
+    keep the move and the position after it.
+    """
+
+    __slots__ = ("entry", "comment", "move", "board_fen", "key")
+
+    def __init__(self, entry: SanEntry) -> None:
+        self.entry = entry
+        self.comment = ""
+        self.move: Optional[chess.Move] = None
+        self.board_fen: Optional[str] = None
+        self.key: Optional[int] = None
+
+
+class _Line:
+    """
+    A line being parsed: the mainline or a variation. Only the last two moves
+    of the line are kept, the ones before are either written or stacked as san
+    waiting to be displayed.
+    """
+
+    __slots__ = (
+        "parent",
+        "mainline",
+        "write",
+        "pending",
+        "prev",
+        "branched",
+        "node",
+        "closers",
+        "after",
+    )
+
+    def __init__(self, parent: Optional["_Line"], mainline=False, write=_discard):
+        """
+        parent: line the variation deviates from, None for the mainline
+        write: where the latex of the line goes, set when its first move is
+            parsed. Variations that are not displayed keep _discard
+        """
+        self.parent = parent
+        self.mainline = mainline
+        self.write = write
+        # san of the moves stacked, waiting to be displayed
+        self.pending: List[SanEntry] = []
+        # Move before node, it has node as first child and possibly some
+        # alternatives (branched)
+        self.prev: Optional[_Node] = None
+        self.branched = False
+        # Last move of the line
+        self.node: Optional[_Node] = None
+        # Latex of the alternatives of the variation moves that branched.
+        # They are displayed after the end of the line
+        self.closers: List[List[str]] = []
+        # Latex of the alternatives to the first move of the line, displayed
+        # right after the line
+        self.after: List[str] = []
+
+
+class StudyVisitor(chess.pgn.BaseVisitor):
+    """
+    Single pass conversion of a game to latex, used with chess.pgn.read_game.
+    It writes the latex while the pgn is parsed, without building the game
+    tree. A game already parsed is converted with Game.accept, see
+    PgnBook.iter_chapter. Lines are kept on an explicit
+    stack so deep variations do not recurse.
+
+    The output order of the latex and the order of the pgn differ in one place:
+    the alternatives of a variation move are displayed after the rest of the
+    variation. Their latex is held until then, so memory only grows with these
+    nested alternatives, not with the size of the game.
+
+    Variations starting before any move of their parent line are not displayed,
+    like the alternatives to the first move of the game.
+    """
+
+    def __init__(self, book, write: Write) -> None:
+        """
+        book: PgnBook giving the chapter headings
+        write: function called with each latex fragment
+        """
+        self.book = book
+        self.write = write
+        # Node used to strip the annotations of comments with python-chess
+        self.scratch = chess.pgn.Game()
+        # Moves visited and boards displayed, see profiling
+        self.nodes = 0
+        self.boards = 0
+
+    def begin_game(self) -> None:
+        # Game.accept does not call begin_headers
+        self.headers = chess.pgn.Headers()
+        self.board: Optional[chess.Board] = None
+        self.game_comment = ""
+        self.started = False
+        self.in_variation = False
+        self.lines = [_Line(None, mainline=True, write=self.write)]
+
+        # Id used to identify a game in the latex code
+        self.game_id = self.book.game_id()
+
+    def begin_headers(self) -> chess.pgn.Headers:
+        self.headers = chess.pgn.Headers()
+        return self.headers
+
+    def visit_header(self, tagname: str, tagvalue: str) -> None:
+        self.headers[tagname] = tagvalue
+
+    def visit_board(self, board: chess.Board) -> None:
+        # First call: the initial position, once the headers are known
+        if self.board is None:
+            self.board = board.copy(stack=False)
+            for fragment in self.book.iter_heading(self.headers):
+                self.write(fragment)
+
+    def visit_comment(self, comment: str) -> None:
+        # Same attribution of the comments as chess.pgn.GameBuilder, starting
+        # comments are not displayed
+        mainline = self.lines[0]
+        if len(self.lines) == 1 and mainline.node is None:
+            self.game_comment = " ".join(filter(None, [self.game_comment, comment]))
+        elif self.in_variation and self.lines[-1].node is not None:
+            node = self.lines[-1].node
+            node.comment = " ".join(filter(None, [node.comment, comment]))
+
+    def begin_variation(self) -> None:
+        self.in_variation = False
+        self.lines.append(_Line(self.lines[-1]))
+
+    def end_variation(self) -> None:
+        self.end_line(self.lines.pop())
+
+    def visit_move(self, board: chess.Board, move: chess.Move) -> None:
+        self.in_variation = True
+        self.nodes += 1
+        if not self.started:
+            self.start()
+
+        line = self.lines[-1]
+        node = _Node(san_entry(board, move))
+        if line.mainline and self.book.tracks_positions():
+            node.move = move
+            board.push(move)
+            node.board_fen = board.board_fen()
+            if self.book.positions is not None:
+                node.key = position_key(board)
+            board.pop()
+        if line.node is None:
+            if not line.mainline:
+                self.open_variation(line)
+        else:
+            # node is the first child of line.node, it has no more
+            # alternatives to come once a move follows node
+            self.settle(line)
+            line.prev = line.node
+            line.branched = False
+        line.node = node
+
+    def end_game(self) -> None:
+        if self.board is None:
+            # python-chess could not set the game up
+            return
+        if not self.started:
+            self.start()
+        # Unclosed variations of a truncated game
+        while len(self.lines) > 1:
+            self.end_line(self.lines.pop())
+        self.end_line(self.lines[0])
+        self.write("\\end{longtable} \n")
+
+    def handle_error(self, error: Exception) -> None:
+        # Same as chess.pgn.GameBuilder, the rest of the variation is skipped
+        LOGGER.error("%s while parsing %r", error, self.headers)
+
+    def result(self) -> Optional[chess.pgn.Headers]:
+        return self.headers
+
+    def strip(self, comment: str, arrows=True, evaluation=True) -> str:
+        """
+        Comment without its arrows and / or evaluation annotations.
+        """
+        self.scratch.comment = comment
+        if arrows:
+            self.scratch.set_arrows([])
+        if evaluation:
+            self.scratch.set_eval(score=None)
+        return self.scratch.comment
+
+    def arrows(self, comment: str) -> List[chess.svg.Arrow]:
+        self.scratch.comment = comment
+        return self.scratch.arrows()
+
+    def start(self) -> None:
+        self.started = True
+        comment = self.strip(self.game_comment)
+        for fragment in iter_game_start(self.game_id, comment, self.board):
+            self.write(fragment)
+
+    def open_variation(self, line: _Line) -> None:
+        """
+        Called on the first move of a variation: find where its latex goes.
+        """
+        parent = line.parent
+        if parent.write is _discard or parent.node is None:
+            return
+
+        if parent.prev is None:
+            # Alternative to the first move of parent, displayed after it
+            if parent.mainline:
+                return
+            line.write = parent.after.append
+        else:
+            # Alternative to parent.node, parent.prev branches
+            if not parent.branched:
+                parent.branched = True
+                self.branch(parent)
+            line.write = parent.write if parent.mainline else parent.closers[-1].append
+        line.write("\\item ")
+
+    def flush_mainline(self, line: _Line, node: _Node) -> None:
+        """
+        Display the mainline moves stacked until node, the board and the
+        comment of node.
+        """
+        write = line.write
+        write("\\mainline{" + variation_san(line.pending + [node.entry]) + "} \n \n")
+        comment = self.strip(node.comment, arrows=False)
+        arrows = self.arrows(comment)
+        self.boards += 1
+        for fragment in self.book.iter_board(
+            self.game_id, arrows, node.board_fen, node.move, node.key
+        ):
+            write(fragment)
+        # Add comment on the right column
+        write(" & " + self.strip(comment, evaluation=False) + "\n \n")
+        line.pending = []
+
+    def flush_variation(self, line: _Line, node: _Node) -> None:
+        line.write("\\variation{" + variation_san(line.pending + [node.entry]) + "} \n")
+        line.pending = []
+
+    def branch(self, line: _Line) -> None:
+        """
+        line.prev has alternatives: display the moves stacked until it and open
+        the list of its variations.
+        """
+        node = line.prev
+        if line.mainline:
+            self.flush_mainline(line, node)
+            line.write("\\variation{" + variation_san([node.entry]) + "} \n")
+            line.write("\\begin{variants} \n")
+        else:
+            self.flush_variation(line, node)
+            line.write(node.comment + "\n")
+            line.write("\\begin{variants} \n")
+            # The rest of the line is the first entry
+            line.write("\\item ")
+            line.closers.append([])
+
+    def settle(self, line: _Line) -> None:
+        """
+        Display line.prev, it won't get more alternatives.
+        """
+        node = line.prev
+        if node is None:
+            return
+        if line.branched:
+            if line.mainline:
+                line.write("\\end{variants} \n")
+                line.write(" \\\\ \n")
+        elif line.mainline:
+            if self.strip(node.comment, arrows=False):
+                self.flush_mainline(line, node)
+                line.write(" \\\\ \n")
+            else:
+                line.pending.append(node.entry)
+        elif node.comment:
+            # Flush the moves stacked until now, add the comment in the
+            # middle of the variation and then continue
+            self.flush_variation(line, node)
+            line.write(self.strip(node.comment) + "\n")
+        else:
+            line.pending.append(node.entry)
+
+    def end_line(self, line: _Line) -> None:
+        if line.node is None:
+            return
+        self.settle(line)
+
+        node = line.node
+        if line.mainline:
+            self.flush_mainline(line, node)
+            line.write(" \\\\ \n")
+            return
+
+        self.flush_variation(line, node)
+        if node.comment:
+            line.write(self.strip(node.comment) + "\n")
+        for entries in reversed(line.closers):
+            line.write("\n" + "".join(entries) + "\\end{variants} \n")
+        line.write("".join(line.after))
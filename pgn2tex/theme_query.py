@@ -0,0 +1,136 @@
+import re
+from typing import Callable, Iterable, Set, Tuple
+
+_TOKENS = re.compile(r"\s*(\(|\)|[^\s()]+)")
+
+# Parsed expression: ("tag", name), ("not", node), ("and", left, right) or
+# ("or", left, right)
+Node = Tuple
+
+
+class ThemeQuery:
+    """
+    Boolean theme expression, made of theme tags, and / or / not and
+    parentheses, for instance "fork and not (mate or endgame)". The
+    expression is parsed once, with the standard library only, and evaluated
+    by the backends: row id sets of puzzle_index.ThemeIndex, tag sets of the
+    shards.
+
+    expression := term (or term)*
+    term := factor (and factor)*
+    factor := not factor | ( expression ) | tag
+
+    Raises ValueError on invalid expressions.
+    """
+
+    def __init__(self, expression: str) -> None:
+        self.expression = expression
+        self.tokens = _TOKENS.findall(expression)
+        self.position = 0
+        self.tree = self.parse_expression()
+        if self.peek() is not None:
+            raise ValueError(
+                f"Unexpected '{self.peek()}' in theme query: {self.expression}"
+            )
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise ValueError(f"Unexpected end of theme query: {self.expression}")
+        self.position += 1
+        return token
+
+    def parse_expression(self) -> Node:
+        node = self.parse_term()
+        while self.peek() is not None and self.peek().lower() == "or":
+            self.next()
+            node = ("or", node, self.parse_term())
+        return node
+
+    def parse_term(self) -> Node:
+        node = self.parse_factor()
+        while self.peek() is not None and self.peek().lower() == "and":
+            self.next()
+            node = ("and", node, self.parse_factor())
+        return node
+
+    def parse_factor(self) -> Node:
+        token = self.next()
+        if token.lower() == "not":
+            return ("not", self.parse_factor())
+        if token == "(":
+            node = self.parse_expression()
+            if self.next() != ")":
+                raise ValueError(f"Missing ')' in theme query: {self.expression}")
+            return node
+        if token == ")" or token.lower() in ("and", "or"):
+            raise ValueError(f"Unexpected '{token}' in theme query: {self.expression}")
+        return ("tag", token)
+
+    def tags(self) -> Set[str]:
+        """
+        Theme tags the expression refers to.
+        """
+        found = set()
+        stack = [self.tree]
+        while stack:
+            node = stack.pop()
+            if node[0] == "tag":
+                found.add(node[1])
+            else:
+                stack.extend(node[1:])
+        return found
+
+    def check(self, known: Iterable[str]) -> None:
+        """
+        Raise ValueError when the expression refers to tags not in known,
+        a misspelt tag would otherwise silently match no puzzle.
+        """
+        unknown = sorted(self.tags().difference(known))
+        if unknown:
+            raise ValueError(f"Unknown themes in theme query: {', '.join(unknown)}")
+
+    def evaluate(
+        self,
+        tag: Callable,
+        union: Callable,
+        intersection: Callable,
+        complement: Callable,
+    ):
+        """
+        Value of the expression, from the value of each tag and the set
+        operations of the backend, applied left to right.
+        """
+
+        def value(node):
+            kind = node[0]
+            if kind == "tag":
+                return tag(node[1])
+            if kind == "not":
+                return complement(value(node[1]))
+            operation = union if kind == "or" else intersection
+            return operation(value(node[1]), value(node[2]))
+
+        return value(self.tree)
+
+    def matches(self, tags: Set[str]) -> bool:
+        """
+        Whether a puzzle with the given set of tags matches the expression.
+        """
+
+        def value(node):
+            kind = node[0]
+            if kind == "tag":
+                return node[1] in tags
+            if kind == "not":
+                return not value(node[1])
+            if kind == "or":
+                return value(node[1]) or value(node[2])
+            return value(node[1]) and value(node[2])
+
+        return value(self.tree)
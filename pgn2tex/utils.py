@@ -2,7 +2,9 @@ import chess
 import chess.pgn
 import chess.svg
 
-from typing import Iterator, Tuple, Dict, List, Optional
+import re
+from string import Template
+from typing import IO, Callable, Iterable, Iterator, Tuple, Dict, List, Optional, Union
 from pathlib import Path
 
 
@@ -14,6 +16,29 @@ def load_pgn(path: Path) -> Iterator[chess.pgn.Game]:
             game = chess.pgn.read_game(fd)
 
 
+def scan_headers(path: Path) -> Iterator[Tuple[int, chess.pgn.Headers]]:
+    """
+    Offset and headers of each game of a pgn file, the moves are skipped
+    without being parsed. A game is read back with fd.seek(offset) followed by
+    chess.pgn.read_game.
+    """
+    with open(path) as fd:
+        while True:
+            offset = fd.tell()
+            headers = chess.pgn.read_headers(fd)
+            if headers is None:
+                return
+            yield offset, headers
+
+
+def game_offsets(path: Path) -> Iterator[int]:
+    """
+    Offsets of the games of a pgn file, see scan_headers.
+    """
+    for offset, headers in scan_headers(path):
+        yield offset
+
+
 def get_section_from_level(title, level, book=False) -> str:
 
     if book:
@@ -29,3 +54,67 @@ def get_section_from_level(title, level, book=False) -> str:
         return "\\subsubsection{" + title + "}"
     else:
         return title + "."
+
+
+_DOCUMENTCLASS = re.compile(r"^\\documentclass.*$", re.MULTILINE)
+
+
+def insert_preamble(template: str, preamble: str) -> str:
+    """
+    Insert preamble code in template, right after its \\documentclass.
+    """
+    match = _DOCUMENTCLASS.search(template)
+    if match is None:
+        raise ValueError("The template has no \\documentclass")
+    return template[: match.end()] + "\n" + preamble + template[match.end() :]
+
+
+def add_includeonly(template: str, files: List[str]) -> str:
+    """
+    Add an \\includeonly of the given files to the preamble of template.
+    """
+    return insert_preamble(template, "\\includeonly{" + ",".join(files) + "}")
+
+
+def write_template(
+    fd: IO[str],
+    template: str,
+    content: Union[Iterable[str], Callable[[Callable[[str], None]], None]],
+    **values,
+):
+    """
+    Write the template to fd with $content replaced by the content fragments.
+    The fragments are written as they are produced instead of being joined
+    into one string first, so memory does not grow with the document. content
+    is either an iterable of fragments or a function called with fd.write to
+    write them. The other placeholders are substituted with values.
+
+    Placeholders are found with the pattern of string.Template, so $$ escapes
+    and errors behave as with Template.substitute. When $content appears
+    several times the fragments are kept to be written at each of them.
+    """
+    pieces = []
+    position = 0
+    for match in Template.pattern.finditer(template):
+        if "content" in (match.group("named"), match.group("braced")):
+            pieces.append(template[position : match.start()])
+            position = match.end()
+    pieces.append(template[position:])
+    # Substituted before writing anything, like Template.substitute fails
+    texts = [Template(piece).substitute(**values) for piece in pieces]
+
+    if len(texts) > 2:
+        if callable(content):
+            fragments: List[str] = []
+            content(fragments.append)
+            content = fragments
+        else:
+            content = list(content)
+
+    fd.write(texts[0])
+    for text in texts[1:]:
+        if callable(content):
+            content(fd.write)
+        else:
+            fd.writelines(content)
+        fd.write(text)
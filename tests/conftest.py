@@ -0,0 +1,27 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# The modules of pgn2tex import each other as top level modules, like when
+# the scripts are run as python pgn2tex/puzzles.py
+sys.path.insert(0, str(ROOT / "pgn2tex"))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+
+@pytest.fixture(scope="session")
+def puzzle_data(tmp_path_factory):
+    """
+    Synthetic lichess puzzle csv and themes description, see
+    benchmarks/generate.py.
+    """
+    import generate
+
+    directory = tmp_path_factory.mktemp("data")
+    database = directory / "lichess_db_puzzle.csv"
+    themes_desc = directory / "puzzleTheme.xml"
+    generate.write_puzzles(database, 600, seed=1, pool=100)
+    generate.write_themes(themes_desc)
+    return database, themes_desc
@@ -0,0 +1,65 @@
+"""
+Minimal UCI engine for the tests of annotate.py. It answers at once with a
+score and a best line computed from the position only, so the evaluations
+are deterministic, and appends the fen of every analysed position to the
+file given as first argument.
+
+    python tests/stub_uci.py analysed.log
+"""
+
+import sys
+
+import chess
+
+
+def evaluate(board: chess.Board):
+    """
+    Score in centipawns and best line (4 plies) of board.
+    """
+    line = []
+    scratch = board.copy()
+    for _ in range(4):
+        moves = sorted(scratch.legal_moves, key=lambda move: move.uci())
+        if not moves:
+            break
+        line.append(moves[0])
+        scratch.push(moves[0])
+    return len(board.piece_map()) * 37 % 300 - 150, line
+
+
+def main(log) -> None:
+    board = chess.Board()
+    for command in sys.stdin:
+        words = command.split()
+        if not words:
+            continue
+        if words[0] == "uci":
+            print("id name Stub 1\nid author pgn2tex\nuciok", flush=True)
+        elif words[0] == "isready":
+            print("readyok", flush=True)
+        elif words[0] == "position":
+            moves = words.index("moves") if "moves" in words else len(words)
+            if words[1] == "startpos":
+                board = chess.Board()
+            else:
+                board = chess.Board(" ".join(words[2:moves]))
+            for move in words[moves + 1 :]:
+                board.push_uci(move)
+        elif words[0] == "go":
+            depth = int(words[words.index("depth") + 1]) if "depth" in words else 1
+            if log is not None:
+                print(board.fen(), file=log, flush=True)
+            score, line = evaluate(board)
+            pv = " ".join(move.uci() for move in line)
+            print(f"info depth {depth} score cp {score} pv {pv}", flush=True)
+            print(f"bestmove {line[0].uci()}", flush=True)
+        elif words[0] == "quit":
+            break
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "a") as log:
+            main(log)
+    else:
+        main(None)
@@ -0,0 +1,94 @@
+import sys
+from pathlib import Path
+
+import chess.pgn
+import pytest
+
+from annotate import EnginePool, EvalCache, annotate_games, annotate_pgn
+
+STUB = Path(__file__).resolve().parent / "stub_uci.py"
+
+# The second game transposes into the positions of the first one, the last
+# game repeats the first one
+STUDY = """[Event "First"]
+
+1. e4 { Kept as is } e5 2. Nf3 { [%cal Gb1c3] } Nc6 3. Bb5 (3. Bc4 Bc5) a6 *
+
+[Event "Transposition"]
+
+1. Nf3 Nc6 2. e4 e5 3. Bb5 a6 *
+
+[Event "Repeated"]
+
+1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 *
+"""
+
+
+@pytest.fixture
+def study(tmp_path):
+    path = tmp_path / "study.pgn"
+    path.write_text(STUDY)
+    return path
+
+
+def engine(log: Path, engines=1) -> EnginePool:
+    return EnginePool([sys.executable, str(STUB), str(log)], engines=engines)
+
+
+def analysed(log: Path):
+    return log.read_text().splitlines() if log.exists() else []
+
+
+def read_games(path: Path):
+    with open(path) as fd:
+        return list(iter(lambda: chess.pgn.read_game(fd), None))
+
+
+def test_repeated_positions_are_analysed_once(study, tmp_path):
+    log = tmp_path / "engine.log"
+    games = read_games(study)
+    with engine(log) as pool:
+        stats = annotate_games(games, pool, depth=3, nodes="all")
+    positions = analysed(log)
+    assert len(positions) == len(set(positions)) == stats["positions"]
+    assert stats["analysed"] == stats["positions"] < stats["nodes"]
+
+
+def test_comments_are_kept(study, tmp_path):
+    output = tmp_path / "annotated.pgn"
+    with engine(tmp_path / "engine.log") as pool:
+        annotate_pgn(study, output, pool, depth=3, nodes="all")
+    first = read_games(output)[0]
+    nodes = list(first.mainline())
+    assert nodes[0].comment == "Kept as is"
+    # Arrows are drawn, not written: the node is annotated and keeps them
+    assert nodes[2].arrows()
+    assert nodes[2].comment.startswith("[%cal Gb1c3] ")
+    assert "/3 " in nodes[2].comment
+    assert all("/3 " in node.comment for node in nodes[1:])
+
+
+def test_cache_hits_skip_the_engine(study, tmp_path):
+    log = tmp_path / "engine.log"
+    outputs = [tmp_path / "first.pgn", tmp_path / "second.pgn"]
+    with EvalCache(tmp_path / "evals.sqlite") as cache:
+        with engine(log) as pool:
+            first = annotate_pgn(study, outputs[0], pool, cache, depth=3, nodes="all")
+        count = len(analysed(log))
+        with engine(log) as pool:
+            second = annotate_pgn(study, outputs[1], pool, cache, depth=3, nodes="all")
+    assert first["analysed"] == count > 0
+    assert second["analysed"] == 0
+    assert second["cached"] == second["positions"] == first["positions"]
+    assert len(analysed(log)) == count
+    assert outputs[0].read_text() == outputs[1].read_text()
+
+
+def test_several_engines_give_the_same_output(study, tmp_path):
+    outputs = []
+    for engines in (1, 3):
+        output = tmp_path / f"engines{engines}.pgn"
+        with engine(tmp_path / f"engine{engines}.log", engines) as pool:
+            annotate_pgn(study, output, pool, depth=3, nodes="all", batch=2)
+        outputs.append(output.read_text())
+    assert outputs[0] == outputs[1]
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+from batch import ManifestError, plan, puzzle_count, read_manifest, run
+
+
+def manifest(puzzle_data, *books, **defaults):
+    database, themes_desc = puzzle_data
+    return {
+        "database": str(database),
+        "themes_desc": str(themes_desc),
+        "defaults": {"min_rating": 1000, "max_rating": 2000, **defaults},
+        "books": list(books),
+    }
+
+
+@pytest.mark.parametrize(
+    "book, message",
+    [
+        ({"seed": "abc"}, "seed must be a positive integer"),
+        ({"theme_query": "fork and (mate"}, "Unexpected end of theme query"),
+        ({"theme_query": "frok"}, "Unknown themes in theme query"),
+    ],
+)
+def test_invalid_books_fail_before_writing(tmp_path, puzzle_data, book, message):
+    books = [{"output": "first.tex"}, {"output": "second.tex", **book}]
+    with pytest.raises(ManifestError, match=f"Book 2 \\(second.tex\\): {message}"):
+        plan(manifest(puzzle_data, *books), tmp_path)
+    assert not list(tmp_path.iterdir())
+
+
+def test_reported_counts_are_per_book(tmp_path, puzzle_data):
+    path = tmp_path / "books.json"
+    books = [
+        {"output": "small.tex", "problems": 3},
+        {"output": "large.tex", "problems": 9},
+    ]
+    path.write_text(json.dumps(manifest(puzzle_data, *books, seed=1)))
+    settings, planned = plan(read_manifest(path), tmp_path)
+
+    counts = {output.name: count for output, count, _ in run(settings, planned)}
+    assert 0 < counts["small.tex"] < counts["large.tex"]
+    for name, count in counts.items():
+        # One solution per puzzle
+        assert (tmp_path / name).read_text().count("\\label{solution-") == count
+
+
+def test_puzzle_count():
+    book = [
+        (
+            "1000-1500",
+            "list",
+            [("Fork", "puzzles", [1, 2, 3], ""), ("Pin", "puzzles", [4], "")],
+            "",
+        ),
+        ("1500-2000", "puzzles", [5, 6], ""),
+    ]
+    assert puzzle_count(book) == 6
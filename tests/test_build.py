@@ -0,0 +1,50 @@
+import shutil
+
+import pytest
+
+from build import build, split_units, unit_source
+
+MASTER = r"""\documentclass{book}
+\begin{document}
+\tableofcontents
+\include{chapters/chapter001}
+\include{chapters/chapter002}
+\include{chapters/chapter003}
+\end{document}
+"""
+
+
+def test_split_units():
+    assert split_units(MASTER, 2) == [
+        ["chapters/chapter001", "chapters/chapter002"],
+        ["chapters/chapter003"],
+    ]
+    assert split_units("\\documentclass{book}\n", 2) == []
+
+
+def test_unit_source_marks_every_chapter():
+    source = unit_source(MASTER, ["chapters/chapter002"])
+    assert "\\includeonly{chapters/chapter002}" in source
+    # Its definition, the end of the document, before the first chapter and
+    # after each chapter
+    assert source.count("\\pgnbuildmark") == 2 + 1 + 3
+
+
+@pytest.mark.skipif(shutil.which("xelatex") is None, reason="needs xelatex")
+def test_parallel_build(tmp_path):
+    (tmp_path / "chapters").mkdir()
+    for number in range(1, 4):
+        (tmp_path / "chapters" / f"chapter{number:03d}.tex").write_text(
+            f"\\chapter{{Chapter {number}}}\\label{{c{number}}}\n"
+            f"See page \\pageref{{c{4 - number}}}.\n"
+        )
+    master = tmp_path / "book.tex"
+    master.write_text(MASTER)
+
+    timings = build(master, jobs=2, unit_size=1, log=lambda *_: None)
+    assert (tmp_path / "book.pdf").stat().st_size > 0
+    assert len(timings["units"]) == 3
+
+    # Nothing changed, no unit is compiled again
+    timings = build(master, jobs=2, unit_size=1, log=lambda *_: None)
+    assert all(unit["passes"] == 0 for unit in timings["units"].values())
@@ -0,0 +1,25 @@
+import csv
+
+from puzzle_cache import PuzzleCache
+from puzzles import open_puzzles
+
+
+def test_unrated_puzzles_are_never_selected(tmp_path, puzzle_data):
+    database, _ = puzzle_data
+    with open(database, newline="") as fd:
+        rows = list(csv.DictReader(fd))
+    unrated = {rows[0]["PuzzleId"], rows[10]["PuzzleId"]}
+    for row in rows:
+        if row["PuzzleId"] in unrated:
+            row["Rating"] = ""
+    path = tmp_path / "puzzles.csv"
+    with open(path, "w", newline="") as fd:
+        writer = csv.DictWriter(fd, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    assert len(PuzzleCache.open(path)) == len(rows) - len(unrated)
+    for cache in (True, False):
+        selected = set(open_puzzles(path, min_rating=0, cache=cache)["PuzzleId"])
+        assert len(selected) == len(rows) - len(unrated)
+        assert not selected & unrated
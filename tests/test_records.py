@@ -0,0 +1,94 @@
+import pickle
+
+import pytest
+
+import records
+from board_helpers import iter_book_from_list_table_layout
+from fragment_cache import FragmentCache
+from puzzles import load_themes, make_book, open_puzzles
+from records import PuzzleRecord, derive
+
+
+@pytest.fixture
+def derive_calls(monkeypatch):
+    """
+    Fens of the puzzles derived while the test runs.
+    """
+    calls = []
+
+    def counted(fen, moves, themes):
+        calls.append(fen)
+        return derive(fen, moves, themes)
+
+    monkeypatch.setattr(records, "derive", counted)
+    return calls
+
+
+def book(puzzle_data):
+    database, themes_desc = puzzle_data
+    puzzles = open_puzzles(database, 1000, 2000, compact=True)
+    return make_book(
+        puzzles,
+        load_themes(themes_desc),
+        min_rating=1000,
+        max_rating=2000,
+        step_size=500,
+        problems=6,
+        seed=1,
+    )
+
+
+def render(L, cache=None):
+    return "".join(iter_book_from_list_table_layout(L, cache=cache))
+
+
+def book_records(L):
+    return [r for _, _, sections, _ in L for _, _, rs, _ in sections for r in rs]
+
+
+def test_deferred_record_is_derived_on_first_use(derive_calls):
+    fen = "r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3"
+    record = PuzzleRecord.deferred("abc", fen, "f1b5 a7a6 b5a4", "opening short")
+    copy = pickle.loads(pickle.dumps(record))
+    assert derive_calls == []
+
+    expected = derive(fen, "f1b5 a7a6 b5a4", "opening short")
+    assert tuple(getattr(record, f) for f in records.DERIVED_FIELDS) == expected
+    assert record.solution == "3...a6 4. Ba4"
+    assert tuple(getattr(copy, f) for f in records.DERIVED_FIELDS) == expected
+    assert len(derive_calls) == 2
+
+
+def test_repeated_puzzles_are_derived_once(puzzle_data, derive_calls):
+    L = book(puzzle_data)
+    assert derive_calls == []
+
+    shown = book_records(L)
+    render(L)
+    ids = [r.puzzle_id for r in shown]
+    # The synthetic puzzles have several themes, some are in several sections
+    assert len(set(ids)) < len(ids)
+    assert len(derive_calls) == len(set(ids))
+    assert len({id(r) for r in shown}) == len(set(ids))
+
+
+def test_cached_fragments_skip_derive(puzzle_data, tmp_path, monkeypatch):
+    path = tmp_path / "fragments.db"
+    with FragmentCache(path) as cache:
+        cold = render(book(puzzle_data), cache)
+
+    def fail(*args):
+        raise AssertionError("derive called on a warm cache")
+
+    monkeypatch.setattr(records, "derive", fail)
+    with FragmentCache(path) as cache:
+        warm = render(book(puzzle_data), cache)
+        assert cache.stats()["misses"] == 0
+    assert warm == cold
+
+
+def test_pool_renders_deferred_records(puzzle_data):
+    L = book(puzzle_data)
+    assert render(L) == "".join(
+        iter_book_from_list_table_layout(book(puzzle_data), jobs=2)
+    )
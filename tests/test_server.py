@@ -0,0 +1,37 @@
+from pathlib import Path
+
+import pytest
+
+from server import TEMPLATES, BadRequest, parse_spec
+
+THEMES = {"fork": None, "mate": None}
+
+
+@pytest.mark.parametrize(
+    "spec, message",
+    [
+        ({"seed": "abc"}, "seed must be a positive integer"),
+        ({"seed": True}, "seed must be a positive integer"),
+        ({"seed": -1}, "seed must be a positive integer"),
+        ({"problems": True}, "problems must be a positive integer"),
+        ({"quantiles": False}, "quantiles must be a positive integer"),
+        ({"theme_query": 3}, "theme_query must be a string"),
+        ({"theme_query": "fork and (mate"}, "Unexpected end of theme query"),
+        ({"theme_query": "frok"}, "Unknown themes in theme query: frok"),
+        ({"themes": ["frok"]}, "Unknown themes: frok"),
+    ],
+)
+def test_invalid_specs(spec, message):
+    with pytest.raises(BadRequest, match=message):
+        parse_spec(spec, THEMES, TEMPLATES)
+
+
+def test_valid_spec():
+    options = parse_spec(
+        {"seed": 3, "theme_query": "fork and not mate", "template": "book.tex"},
+        THEMES,
+        Path(TEMPLATES),
+    )
+    assert options["seed"] == 3
+    assert options["template"] == "book.tex"
+    assert options["min_rating"] == 1000
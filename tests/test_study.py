@@ -0,0 +1,115 @@
+import chess.pgn
+import pytest
+
+from diagrams import DiagramStore
+from positions import PositionRegistry
+from study import PgnBook, chapter_name
+
+
+@pytest.fixture
+def study(tmp_path):
+    import generate
+
+    path = tmp_path / "study.pgn"
+    generate.write_study(path, 5, depth=2, branching=0.3, comments=0.3, seed=3)
+    return path
+
+
+def latex(path, jobs):
+    fragments = []
+    PgnBook(path, book=True).write_latex(fragments.append, jobs=jobs)
+    return "".join(fragments)
+
+
+def test_parallel_conversion_is_identical(study):
+    single = latex(study, jobs=1)
+    assert single.count("\\chapter") == 5
+    assert latex(study, jobs=3) == single
+    assert "".join(PgnBook(study).iter_latex(jobs=3)) == single
+    assert PgnBook(study).singles(jobs=3) == PgnBook(study).singles(jobs=1)
+
+
+def edit_game(path, number, comment):
+    with open(path) as fd:
+        games = list(iter(lambda: chess.pgn.read_game(fd), None))
+    games[number - 1].variations[0].comment = comment
+    with open(path, "w") as fd:
+        for game in games:
+            print(game, file=fd, end="\n\n")
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_incremental_chapters(study, tmp_path, jobs):
+    directory = tmp_path / "chapters"
+    manifest = PgnBook(study).write_chapters(directory, jobs=jobs)
+    names = [chapter_name(i) for i in range(5)]
+    assert manifest["changed"] == names
+    singles = PgnBook(study).singles(jobs=1)
+    for name, chapter in zip(names, singles):
+        assert (directory / f"{name}.tex").read_text() == chapter + "\n"
+
+    # Unchanged chapters are reused, their files are not written again
+    stamps = {name: (directory / f"{name}.tex").stat().st_mtime_ns for name in names}
+    manifest = PgnBook(study).write_chapters(directory, jobs=jobs)
+    assert manifest["changed"] == []
+    assert not any(chapter["changed"] for chapter in manifest["chapters"])
+    for name in names:
+        assert (directory / f"{name}.tex").stat().st_mtime_ns == stamps[name]
+
+    # Only the edited game is converted again
+    edit_game(study, 2, "An edited comment")
+    manifest = PgnBook(study).write_chapters(directory, jobs=jobs)
+    assert manifest["changed"] == [chapter_name(1)]
+    assert "An edited comment" in (directory / f"{chapter_name(1)}.tex").read_text()
+    for name in names[:1] + names[2:]:
+        assert (directory / f"{name}.tex").stat().st_mtime_ns == stamps[name]
+    singles = PgnBook(study).singles(jobs=1)
+    for name, chapter in zip(names, singles):
+        assert (directory / f"{name}.tex").read_text() == chapter + "\n"
+
+
+ANNOTATED = """[Event "Annotated"]
+[Site "https://lichess.org/study/abc"]
+[Result "*"]
+
+{ Intro [%cal Ge2e4] } 1. e4 $1 { Best by test [%cal Gg1f3,Rd2d4] } ( 1. d4 d5 $2 { Queen pawn } 2. c4 ( 2. Nf3 Nf6 { Quiet } ) 2... e6 ) 1... e5 $6 2. Nf3 { [%csl Rf3] } 2... Nc6 3. Bb5 ( 3. Bc4 { Italian } Bc5 ( 3... Nf6 4. Ng5 { Fried } ) 4. c3 ) ( 3. d4 exd4 ) 3... a6 { Morphy [%eval 0.3] } 4. Ba4 Nf6 5. O-O *
+
+[Event "Repeated"]
+[Site "https://lichess.org/study/def"]
+[FEN "4k3/8/8/8/8/8/4P3/4K3 w - - 0 1"]
+[SetUp "1"]
+[Result "*"]
+
+1. e4 { Push } ( 1. e3 $5 { Slow } ( 1. Kd2 ) ) 1... Kd7 ( { Starting } 1... Ke7 2. e5 ) 2. Ke2 Kd6 3. Kd3 { Here } Kd7 4. Ke3 Kd6 5. Kd3 { Again } Kd7 6. Ke3 *
+"""
+
+
+@pytest.mark.parametrize("diagrams", [False, True])
+@pytest.mark.parametrize("unique", [False, True])
+def test_parsed_games_convert_like_the_file(tmp_path, diagrams, unique):
+    path = tmp_path / "annotated.pgn"
+    path.write_text(ANNOTATED)
+
+    def book():
+        return PgnBook(
+            path,
+            diagrams=(
+                DiagramStore(tmp_path / "diagrams", "diagrams") if diagrams else None
+            ),
+            positions=PositionRegistry() if unique else None,
+        )
+
+    with open(path) as fd:
+        games = list(iter(lambda: chess.pgn.read_game(fd), None))
+    assert len(games) == 2
+
+    read, parsed = book(), book()
+    with open(path) as fd:
+        for count, game in enumerate(games):
+            fragments = []
+            read.count = parsed.count = count
+            assert read.read_chapter(fd, fragments.append)
+            chapter = "".join(fragments)
+            assert parsed.mk_chapter(game) == chapter
+    # 5. Kd3 comes back to the position of 3. Kd3
+    assert ("Same position as page" in chapter) == unique
@@ -0,0 +1,50 @@
+import re
+
+import pytest
+
+from puzzle_index import ThemeIndex
+from theme_query import ThemeQuery
+
+THEMES = ["fork mate", "fork", "mate endgame", "pin", "", "fork endgame"]
+
+QUERIES = [
+    "fork",
+    "fork and not (mate or endgame)",
+    "not fork",
+    "mate or pin and endgame",
+    "FORK",
+    "(fork or pin) and not endgame",
+]
+
+
+@pytest.mark.parametrize("expression", QUERIES)
+def test_index_and_tag_sets_agree(expression):
+    index = ThemeIndex.from_themes(THEMES)
+    query = ThemeQuery(expression)
+    expected = [
+        row for row, tags in enumerate(THEMES) if query.matches(set(tags.split()))
+    ]
+    assert list(index.query(expression)) == expected
+
+
+@pytest.mark.parametrize(
+    "expression, message",
+    [
+        ("fork and (mate", "Unexpected end"),
+        ("fork mate", "Unexpected 'mate'"),
+        ("and fork", "Unexpected 'and'"),
+        ("(fork mate)", "Missing ')'"),
+        ("", "Unexpected end"),
+    ],
+)
+def test_invalid_expressions(expression, message):
+    with pytest.raises(ValueError, match=re.escape(message)):
+        ThemeQuery(expression)
+
+
+def test_unknown_tags():
+    query = ThemeQuery("frok or not (mate and pinn)")
+    assert query.tags() == {"frok", "mate", "pinn"}
+    with pytest.raises(ValueError, match="frok, pinn"):
+        query.check(["fork", "mate", "pin"])
+    ThemeQuery("fork or mate").check(["fork", "mate"])
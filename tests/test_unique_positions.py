@@ -0,0 +1,58 @@
+import pytest
+
+from positions import fen_key
+from puzzles import load_themes, make_book, open_puzzles
+
+PROBLEMS = 6
+
+
+def sections(book):
+    for _, _, items, _ in book:
+        for _, _, records, _ in items:
+            yield records
+
+
+@pytest.fixture(scope="module")
+def unique_book(puzzle_data):
+    database, themes_desc = puzzle_data
+    themes = load_themes(themes_desc)
+    puzzles = open_puzzles(database, 1000, 2000, compact=True)
+    book = make_book(
+        puzzles,
+        themes,
+        min_rating=1000,
+        max_rating=2000,
+        step_size=500,
+        problems=PROBLEMS,
+        seed=1,
+        unique_positions=True,
+    )
+    return puzzles, themes, book
+
+
+def test_positions_appear_once(unique_book):
+    _, _, book = unique_book
+    keys = [fen_key(r.display_fen) for records in sections(book) for r in records]
+    assert keys
+    assert len(keys) == len(set(keys))
+
+
+def test_short_sections_have_no_unused_position(unique_book):
+    puzzles, themes, book = unique_book
+    shown = {fen_key(r.display_fen) for records in sections(book) for r in records}
+    by_name = {theme.name: tag for tag, theme in themes.items()}
+    index = puzzles.theme_index()
+    for lo, hi, chapter in zip([1000, 1500], [1500, 2000], book):
+        in_range = {
+            row for row in range(len(puzzles)) if lo <= puzzles.ratings[row] < hi
+        }
+        for name, _, records, _ in chapter[2]:
+            assert len(records) % 3 == 0
+            if len(records) == PROBLEMS:
+                continue
+            candidates = in_range.intersection(index.rows_with(by_name[name]))
+            unused = {
+                fen_key(r.display_fen) for r in puzzles.records(sorted(candidates))
+            } - shown
+            # Less than a row of 3 puzzles left
+            assert len(unused) < 3
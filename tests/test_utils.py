@@ -0,0 +1,44 @@
+import io
+from string import Template
+
+import pytest
+
+from utils import write_template
+
+TEMPLATES = [
+    "no placeholder",
+    "$content",
+    "before ${content} after $frontpage",
+    "price $$content and $content",
+    "$$$content$$",
+    "$content twice $content",
+    "${content}s $frontpage ${content}",
+]
+
+
+def written(template, content, **values):
+    fd = io.StringIO()
+    write_template(fd, template, content, **values)
+    return fd.getvalue()
+
+
+@pytest.mark.parametrize("template", TEMPLATES)
+def test_same_as_substitute(template):
+    fragments = ["a", "b", "c"]
+    expected = Template(template).substitute(content="abc", frontpage="FP")
+    assert written(template, iter(fragments), frontpage="FP") == expected
+    assert (
+        written(template, lambda write: [write(f) for f in fragments], frontpage="FP")
+        == expected
+    )
+
+
+@pytest.mark.parametrize(
+    "template, error",
+    [("$content $missing", KeyError), ("$content $ 1", ValueError)],
+)
+def test_errors_before_writing(template, error):
+    fd = io.StringIO()
+    with pytest.raises(error):
+        write_template(fd, template, ["abc"])
+    assert fd.getvalue() == ""